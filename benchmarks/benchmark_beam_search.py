@@ -0,0 +1,120 @@
+#
+# Copyright (c) 2021 The Board of Trustees of the Leland Stanford Junior University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Measure the decoding speed (examples/sec) of beam search with a trained `TransformerLSTM` model, for several beam sizes.
+
+Example:
+    python3 benchmarks/benchmark_beam_search.py --path <model_dir> --data <data_dir> --tasks almond \
+        --num_beams 1 4 8 --genienlp_args="--evaluate valid --val_batch_size 1000"
+"""
+
+import argparse
+import shlex
+import time
+
+import torch
+
+from genienlp import predict
+from genienlp.arguments import check_and_update_generation_args
+from genienlp.tasks.registry import get_tasks
+from genienlp.util import get_devices, load_config_json, set_seed
+
+
+def parse_argv():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--path', required=True, type=str, help='directory of the trained model')
+    parser.add_argument('--data', required=True, type=str, help='directory where the data of the tasks resides')
+    parser.add_argument('--tasks', nargs='+', default=['almond'], type=str, help='tasks to benchmark')
+    parser.add_argument('--num_beams', nargs='+', default=[1, 4, 8], type=int, help='beam sizes to benchmark')
+    parser.add_argument(
+        '--repeat', default=3, type=int, help='number of runs for each configuration; the best one is reported'
+    )
+    parser.add_argument(
+        '--genienlp_args', default='', type=str, help='additional `genienlp predict` arguments used to load the model and data'
+    )
+    return parser.parse_args()
+
+
+def main():
+    bench_args = parse_argv()
+
+    genienlp_parser = argparse.ArgumentParser()
+    predict.parse_argv(genienlp_parser)
+    args = genienlp_parser.parse_args(
+        ['--path', bench_args.path, '--data', bench_args.data, '--tasks', *bench_args.tasks]
+        + shlex.split(bench_args.genienlp_args)
+    )
+    load_config_json(args)
+    check_and_update_generation_args(args)
+    predict.check_args(args)
+    predict.set_default_values(args)
+    if args.model != 'TransformerLSTM':
+        raise ValueError(f'This benchmark requires a TransformerLSTM model, but {args.path} contains a {args.model} model')
+
+    set_seed(args)
+    args.tasks = list(get_tasks(args.task_names, args).values())
+    device = get_devices(args.devices)[0]
+
+    model = predict.load_model(args, device)
+    val_sets = predict.prepare_data(args, device, args.pred_src_languages[0])
+    iters = predict.prepare_data_iterators(args, val_sets, model.numericalizer, device)
+
+    with torch.no_grad():
+        for task, language, it, _ in iters:
+            batches = list(it)
+            num_examples = sum(len(batch.example_id) for batch in batches)
+            for num_beams in bench_args.num_beams:
+                best_time = float('inf')
+                for _ in range(bench_args.repeat):
+                    t0 = time.perf_counter()
+                    for batch in batches:
+                        model.generate(
+                            batch,
+                            max_output_length=args.max_output_length,
+                            num_outputs=1,
+                            temperature=1.0,
+                            repetition_penalty=1.0,
+                            top_k=0,
+                            top_p=1.0,
+                            num_beams=num_beams,
+                            num_beam_groups=1,
+                            diversity_penalty=0.0,
+                            no_repeat_ngram_size=0,
+                            do_sample=False,
+                        )
+                    if device.type == 'cuda':
+                        torch.cuda.synchronize(device)
+                    best_time = min(best_time, time.perf_counter() - t0)
+                name = task.name if language is None else f'{task.name}_{language}'
+                print(f'{name}: num_beams={num_beams}: {num_examples} examples, {num_examples / best_time:.1f} examples/sec')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+#
+# Copyright (c) 2021 The Board of Trustees of the Leland Stanford Junior University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Measure the throughput of example construction (lines/sec) of almond tasks, as done by `AlmondDataset` when loading data.
+
+Example:
+    python3 benchmarks/benchmark_example_construction.py --data tests/dataset/almond/train.tsv --tasks almond \
+        --genienlp_args="--almond_detokenize_sentence"
+"""
+
+import argparse
+import os
+import shlex
+import time
+
+from genienlp import arguments
+from genienlp.data_utils.almond_utils import create_examples_from_file
+from genienlp.tasks.almond_dataset import EXAMPLE_BATCH_SIZE
+from genienlp.tasks.registry import get_tasks
+
+
+def parse_argv():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--data', required=True, type=str, help='tab-separated dataset file to read')
+    parser.add_argument('--tasks', nargs='+', default=['almond'], type=str, help='tasks to benchmark')
+    parser.add_argument(
+        '--example_batch_sizes',
+        nargs='+',
+        default=[1, EXAMPLE_BATCH_SIZE],
+        type=int,
+        help='number of lines whose examples are constructed together',
+    )
+    parser.add_argument(
+        '--repeat', default=3, type=int, help='number of runs for each configuration; the best one is reported'
+    )
+    parser.add_argument(
+        '--genienlp_args', default='', type=str, help='additional `genienlp train` arguments used to initialize the tasks'
+    )
+    return parser.parse_args()
+
+
+def main():
+    bench_args = parse_argv()
+
+    genienlp_parser = argparse.ArgumentParser()
+    arguments.parse_argv(genienlp_parser)
+    args = genienlp_parser.parse_args(
+        ['--train_tasks', *bench_args.tasks, '--save', '.'] + shlex.split(bench_args.genienlp_args)
+    )
+
+    with open(bench_args.data, 'r', encoding='utf-8') as fp:
+        num_lines = sum(1 for _ in fp)
+    dir_name = os.path.basename(os.path.dirname(bench_args.data))
+
+    for name, task in get_tasks(bench_args.tasks, args).items():
+        for example_batch_size in bench_args.example_batch_sizes:
+            best_time = float('inf')
+            for _ in range(bench_args.repeat):
+                t0 = time.perf_counter()
+                examples = create_examples_from_file(
+                    {
+                        'in_file': bench_args.data,
+                        'chunk_size': num_lines,
+                        'dir_name': dir_name,
+                        'example_batch_size': example_batch_size,
+                        'make_process_examples': task._make_examples,
+                        'kwargs': {},
+                    }
+                )
+                best_time = min(best_time, time.perf_counter() - t0)
+            print(
+                f'{name}: example_batch_size={example_batch_size}: {len(examples)} examples, '
+                f'{num_lines / best_time:.0f} lines/sec'
+            )
+
+
+if __name__ == '__main__':
+    main()
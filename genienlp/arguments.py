@@ -154,6 +154,27 @@ def parse_argv(parser):
         '--val_tasks', nargs='+', type=str, dest='val_task_names', help='tasks to collect evaluation metrics for'
     )
     parser.add_argument('--val_every', default=1000, type=int, help='how often to run validation in # of iterations')
+    parser.add_argument(
+        '--fast_val_size',
+        default=None,
+        type=int,
+        help='If set, validation uses a fixed random subset of this many examples from each validation set, '
+        'except every --full_val_every iterations',
+    )
+    parser.add_argument(
+        '--full_val_every',
+        default=None,
+        type=int,
+        help='how often to run validation on the full validation sets when using --fast_val_size, in # of iterations. '
+        'If set, only full validations are used to select the best checkpoint',
+    )
+    parser.add_argument(
+        '--val_device',
+        default=None,
+        type=int,
+        help='If set, validation runs on a snapshot of the model on this device (-1 for CPU) in the background, '
+        'while training continues on --devices. The best checkpoint is saved when its validation finishes',
+    )
     parser.add_argument(
         '--val_batch_size',
         nargs='+',
@@ -161,6 +182,12 @@ def parse_argv(parser):
         type=int,
         help='Number of tokens in each batch for validation, corresponding to tasks in --val_tasks',
     )
+    parser.add_argument(
+        '--autotune_batch_size',
+        action='store_true',
+        help='Before training, replace --train_batch_tokens and --val_batch_size with their largest power-of-two multiples '
+        'that fit in GPU memory, by probing batches of the longest examples of each dataset',
+    )
 
     parser.add_argument(
         '--sentence_batching', action='store_true', help='Batch same sentences together (used for multilingual tasks)'
@@ -289,6 +316,24 @@ def parse_argv(parser):
         action='store_true',
         help='Use model parallelization by spliting model weights across available gpus',
     )
+    parser.add_argument(
+        '--distributed',
+        action='store_true',
+        help='Use distributed data parallel training, with one process per device in --devices. '
+        'Processes are spawned automatically, unless genienlp is started by a launcher like torchrun (e.g. to train on multiple nodes)',
+    )
+    parser.add_argument(
+        '--dist_backend',
+        default=None,
+        choices=['nccl', 'gloo'],
+        help='Backend used for communication between processes in distributed training. Defaults to nccl on GPUs and gloo on CPUs',
+    )
+    parser.add_argument(
+        '--shard_optimizer_state',
+        action='store_true',
+        help='Split the optimizer state (e.g. Adam moments) across the processes of distributed training, '
+        'so each process only keeps the state of its share of the parameters',
+    )
     parser.add_argument(
         '--mp_device_ratio',
         default=None,
@@ -331,6 +376,19 @@ def parse_argv(parser):
         type=int,
         help='Number of accumulation steps. Useful to effectively get larger batch sizes.',
     )
+    parser.add_argument(
+        '--mixed_precision',
+        action='store_true',
+        help='If True, will use mixed precision for training: float16 with dynamic loss scaling on GPUs, and bfloat16 on CPUs. '
+        'This reduces memory consumption and is especially faster on GPUs like NVIDIA V100 and T4.',
+    )
+    parser.add_argument(
+        '--gradient_checkpointing',
+        action='store_true',
+        help='If True, will not store intermediate activations of the encoder and decoder layers during the forward pass, '
+        'and recompute them during the backward pass instead. This trades some compute for a much lower memory consumption, '
+        'which allows larger values of --train_batch_tokens.',
+    )
 
     # Loss Truncation; introduced in https://arxiv.org/abs/2004.14589
     parser.add_argument(
@@ -385,7 +443,9 @@ def parse_argv(parser):
 
     parser.add_argument('--skip_cache', action='store_true', help='whether to use existing cached splits or generate new ones')
     parser.add_argument(
-        '--cache_input_data', action='store_true', help='Cache examples from input data for faster subsequent trainings'
+        '--cache_input_data',
+        action='store_true',
+        help='Cache examples from input data, and their numericalized version, for faster subsequent trainings and predictions',
     )
     parser.add_argument('--use_curriculum', action='store_true', help='Use curriculum learning')
     parser.add_argument(
@@ -624,6 +684,24 @@ def post_parse_train_specific(args):
         elif args.model == 'TransformerSeq2Seq' and args.pretrained_model not in MODEL_PARALLEL_SUPPORTED_MODELS:
             raise ValueError('Only the following models have model_parallel support: ', MODEL_PARALLEL_SUPPORTED_MODELS)
 
+    if args.distributed and args.model_parallel:
+        raise ValueError('Distributed training and model parallel cannot be used together')
+
+    if args.shard_optimizer_state and not args.distributed:
+        raise ValueError('--shard_optimizer_state can only be used with --distributed')
+
+    if args.autotune_batch_size and args.model_parallel:
+        raise ValueError('Tuning batch sizes is not supported with model parallel')
+
+    if args.val_device is not None and (args.distributed or args.model_parallel):
+        raise ValueError('Validating in the background is not supported with distributed training or model parallel')
+
+    if args.full_val_every is not None:
+        if args.fast_val_size is None:
+            raise ValueError('--full_val_every should only be used with --fast_val_size')
+        if args.full_val_every % args.val_every != 0:
+            raise ValueError('--full_val_every should be a multiple of --val_every')
+
     if args.mp_device_ratio is not None:
         if len(args.mp_device_ratio) != len(args.devices):
             raise ValueError('When using model_parallel number of provided devices must match the number of mp_device_ratio')
@@ -95,6 +95,15 @@ def is_cjk_char(cp):
 
 ENTITY_REGEX = re.compile('^[A-Z]+_')
 
+# space-separated tokens that are entities (see `is_entity`), and additionally devices and entity markers
+# (see `is_device` and `is_entity_marker`), which are special tokens when found in program fields
+ENTITY_TOKEN_REGEX = re.compile('(?<![^ ])[A-Z]+_[^ ]*')
+PROGRAM_TOKEN_REGEX = re.compile('(?<![^ ])(?:@|\\^\\^)[^ ]*')
+ENTITY_OR_PROGRAM_TOKEN_REGEX = re.compile('(?<![^ ])(?:[A-Z]+_|@|\\^\\^)[^ ]*')
+
+# spaces before punctuation tokens, which attach to the previous token when detokenizing a sentence
+PUNCTUATION_SPACE_REGEX = re.compile(" (?=[,.?!:)\\]}](?: |$)|')")
+
 
 def is_entity(token):
     return ENTITY_REGEX.match(token) is not None
@@ -124,41 +133,27 @@ def process_id(ex):
     return id_
 
 
+# a character class matching any of the characters accepted by `is_cjk_char`
+CJK_CHAR_CLASS = (
+    '[' + ''.join(chr(cp) for cp in CJK_ADDONS) + ''.join(f'{chr(beg)}-{chr(end)}' for beg, end in CJK_RANGES) + ']'
+)
+# positions where `tokenize_cjk_chars` inserts a space:
+# after a cjk char not followed by a space, and between a non-cjk char and a cjk char
+CJK_TOKENIZE_REGEX = re.compile(f'(?<={CJK_CHAR_CLASS})(?=[^ ])|(?<=[^{CJK_CHAR_CLASS[1:-1]}])(?={CJK_CHAR_CLASS})')
+# spaces removed by `detokenize_cjk_chars`: those between two cjk chars
+CJK_DETOKENIZE_REGEX = re.compile(f'(?<={CJK_CHAR_CLASS}) (?={CJK_CHAR_CLASS})')
+
+
 def tokenize_cjk_chars(sentence):
-    output = []
-    i = 0
-    while i < len(sentence):
-        output.append(sentence[i])
-        if is_cjk_char(ord(sentence[i])) and i + 1 < len(sentence) and sentence[i + 1] != ' ':
-            output.append(' ')
-        elif not is_cjk_char(ord(sentence[i])) and i + 1 < len(sentence) and is_cjk_char(ord(sentence[i + 1])):
-            output.append(' ')
-        i += 1
-
-    output = "".join(output)
+    output = CJK_TOKENIZE_REGEX.sub(' ', sentence)
     output = output.replace('  ', ' ')
 
     return output
 
 
 def detokenize_cjk_chars(sentence):
-    output = []
-    i = 0
-    while i < len(sentence):
-        output.append(sentence[i])
-        # skip space after cjk chars only if followed by another cjk char
-        if (
-            is_cjk_char(ord(sentence[i]))
-            and i + 1 < len(sentence)
-            and sentence[i + 1] == ' '
-            and i + 2 < len(sentence)
-            and is_cjk_char(ord(sentence[i + 2]))
-        ):
-            i += 2
-        else:
-            i += 1
-
-    return "".join(output)
+    # skip space after cjk chars only if followed by another cjk char
+    return CJK_DETOKENIZE_REGEX.sub('', sentence)
 
 
 def chunk_file(input_src, chunk_files, chunk_size, num_chunks):
@@ -179,40 +174,33 @@ def chunk_file(input_src, chunk_files, chunk_size, num_chunks):
 
 
 def create_examples_from_file(args):
+    """
+    Read the first `chunk_size` lines of `in_file` and construct examples for them, `example_batch_size` lines at a time.
+    `make_process_examples` receives a list of lines, each split into its tab-separated parts, and returns a list of examples
+    (potentially more than one per line, e.g. when using --translate_example_split)
+    """
     path = args['in_file']
     chunk_size = args['chunk_size']
     dir_name = args['dir_name']
     example_batch_size = args['example_batch_size']
-    make_process_example = args['make_process_example']
+    make_process_examples = args['make_process_examples']
     kwargs = args['kwargs']
 
     chunk_examples = []
 
     batch = []
-    last_batch = False
-    for i, line in progress_bar(enumerate(open(path, 'r', encoding='utf-8')), desc='Reading dataset'):
-        parts = line.strip().split('\t')
-        batch.append(parts)
-        if len(chunk_examples) + example_batch_size > chunk_size:
-            # trim batch
-            batch = batch[: chunk_size - len(chunk_examples)]
-            last_batch = True
-        if len(batch) % example_batch_size != 0 and not last_batch:
-            continue
-
-        # TODO remote database lookup is faster when multiple examples are sent in one HTTP request
-        # For now we only do one at a time; support processing examples as a batch
-        assert len(batch) == 1
-        batch = batch[0]
-        examples = make_process_example(batch, dir_name, **kwargs)
-        if isinstance(examples, list):
-            # account for extra examples created when using --translate_example_split
-            chunk_size += len(examples) - 1
-            chunk_examples.extend(examples)
-        else:
-            chunk_examples.append(examples)
-        batch = []
-        if len(chunk_examples) >= chunk_size:
-            break
+    num_lines = 0
+    with open(path, 'r', encoding='utf-8') as fp:
+        for line in progress_bar(fp, desc='Reading dataset', total=chunk_size):
+            if num_lines == chunk_size:
+                break
+            batch.append(line.strip().split('\t'))
+            num_lines += 1
+            if len(batch) == example_batch_size:
+                chunk_examples.extend(make_process_examples(batch, dir_name, **kwargs))
+                batch = []
+
+    if batch:
+        chunk_examples.extend(make_process_examples(batch, dir_name, **kwargs))
 
     return chunk_examples
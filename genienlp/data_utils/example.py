@@ -28,8 +28,9 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import unicodedata
-from typing import Iterable, List, NamedTuple, Union
+from typing import Iterable, List, NamedTuple, Optional, Union
 
+import numpy as np
 import torch
 
 
@@ -41,42 +42,60 @@ class SequentialField(NamedTuple):
     value: Union[torch.tensor, List[int]]
     length: Union[torch.tensor, int]
     limited: Union[torch.tensor, List[int]]
-    feature: Union[torch.tensor, List[List[int]], None]
+    feature: Union[torch.tensor, np.ndarray, None]
 
 
 VALID_ENTITY_ATTRIBUTES = ('type_id', 'type_prob', 'qid')
 
 
-# Entity is defined per token
-# Each attribute contains a list of possible values for that entity
-class Entity(object):
-    def __init__(
-        self,
-        type_id: List[int] = None,
-        type_prob: List[float] = None,
-        qid: List[int] = None,
-    ):
-        self.type_id = type_id
-        self.type_prob = type_prob
-        self.qid = qid
+class EntityFeatures(NamedTuple):
+    """
+    NED features of all tokens of a sentence. Each attribute is an array with one row per token and `max_features_size` columns
+    """
 
-    def __eq__(self, other):
-        return self.__dict__ == other.__dict__
+    type_id: np.ndarray
+    type_prob: np.ndarray
+    qid: np.ndarray
 
-    def flatten(self):
-        result = []
-        for field in VALID_ENTITY_ATTRIBUTES:
-            field_val = getattr(self, field)
-            if field_val:
-                result += field_val
-        return result
+    @staticmethod
+    def from_lists(type_ids: List[List[int]], type_probs: List[List[float]], qids: List[List[int]]):
+        return EntityFeatures(
+            type_id=np.array(type_ids, dtype=np.int64),
+            type_prob=np.array(type_probs, dtype=np.float32),
+            qid=np.array(qids, dtype=np.int64),
+        )
 
     @staticmethod
-    def get_pad_entity(max_features_size):
-        pad_feature = Entity()
-        for i, field in enumerate(VALID_ENTITY_ATTRIBUTES):
-            setattr(pad_feature, field, [0] * max_features_size)
-        return pad_feature
+    def get_pad(num_tokens, max_features_size):
+        return EntityFeatures(
+            type_id=np.zeros((num_tokens, max_features_size), dtype=np.int64),
+            type_prob=np.zeros((num_tokens, max_features_size), dtype=np.float32),
+            qid=np.zeros((num_tokens, max_features_size), dtype=np.int64),
+        )
+
+    @staticmethod
+    def concatenate(all_features: Iterable['EntityFeatures']):
+        all_features = list(all_features)
+        return EntityFeatures(*(np.concatenate(arrays, axis=0) for arrays in zip(*all_features)))
+
+    @property
+    def num_tokens(self):
+        return self.type_id.shape[0]
+
+    def take(self, indices):
+        """
+        Returns the features of tokens at `indices`, e.g. to repeat the features of a word for each of its word pieces
+        """
+        return EntityFeatures(*(array[indices] for array in self))
+
+    def same_entity(self, i, j):
+        return all(np.array_equal(array[i], array[j]) for array in self)
+
+    def flatten(self):
+        """
+        Concatenates all attributes of each token, in the order of VALID_ENTITY_ATTRIBUTES
+        """
+        return np.concatenate([getattr(self, field).astype(np.float32) for field in VALID_ENTITY_ATTRIBUTES], axis=1)
 
 
 class Example(object):
@@ -88,9 +107,9 @@ class Example(object):
         self,
         example_id: str,
         context: str,
-        context_feature: List[Entity],
+        context_feature: Optional[EntityFeatures],
         question: str,
-        question_feature: List[Entity],
+        question_feature: Optional[EntityFeatures],
         answer: str,
     ):
 
@@ -118,10 +137,43 @@ class Example(object):
             if argname != 'answer':
                 # we use a placeholder for features here
                 # the features will be produced and overridden via bootleg or database
-                args.append([])
+                args.append(None)
 
         return Example(*args)
 
+    @staticmethod
+    def from_raw_batch(
+        example_ids: List[str],
+        contexts: List[str],
+        questions: List[str],
+        answers: List[str],
+        preprocess=identity,
+        lower=False,
+    ):
+        """
+        Batched version of `from_raw()`. `preprocess` is called once per field, with the sentences of all examples
+        """
+        answers = [unicodedata.normalize('NFD', answer) for answer in answers]
+
+        all_fields = []
+        for argname, args in (('context', contexts), ('question', questions), ('answer', answers)):
+            args = [unicodedata.normalize('NFD', arg) for arg in args]
+            if lower:
+                args = [arg.lower() for arg in args]
+
+            sentences = preprocess(
+                [arg.rstrip('\n') for arg in args], field_name=argname, answers=answers, example_ids=example_ids
+            )
+
+            all_fields.append(sentences)
+
+        # we use placeholders for features here
+        # the features will be produced and overridden via bootleg or database
+        return [
+            Example(example_id, context, None, question, None, answer)
+            for example_id, context, question, answer in zip(example_ids, *all_fields)
+        ]
+
 
 class NumericalizedExamples(NamedTuple):
     """
@@ -143,29 +195,26 @@ class NumericalizedExamples(NamedTuple):
             pad_feature = []
         else:
             sep_token = ' ' + numericalizer.sep_token + ' '
-            pad_feature = [Entity.get_pad_entity(args.max_features_size)]
+            pad_feature = [EntityFeatures.get_pad(1, args.max_features_size)]
 
         # we keep the result of concatenation of question and context fields in these arrays temporarily. The numericalized versions will live on in self.context
         all_context_plus_questions = []
         all_context_plus_question_features = []
 
+        # otherwise, features are already processed and added to input as text
+        use_features = args.do_ned and args.add_entities_to_text == 'no'
+
         for ex in examples:
             context_plus_question = ex.context + sep_token + ex.question if len(ex.question) else ex.context
             all_context_plus_questions.append(context_plus_question)
 
-            # concatenate question and context features with a separator, but no need for a separator if there are no features to begin with
-            context_plus_question_feature = (
-                ex.context_feature + pad_feature + ex.question_feature
-                if len(ex.question_feature) + len(ex.context_feature) > 0
-                else []
-            )
-            all_context_plus_question_features.append(context_plus_question_feature)
+            if use_features:
+                # concatenate question and context features with a separator
+                all_context_plus_question_features.append(
+                    EntityFeatures.concatenate([ex.context_feature, *pad_feature, ex.question_feature])
+                )
 
-        if args.do_ned and args.add_entities_to_text == 'no':
-            features = all_context_plus_question_features
-        else:
-            # features are already processed and added to input as text
-            features = None
+        features = all_context_plus_question_features if use_features else None
 
         tokenized_contexts = numericalizer.encode_batch(all_context_plus_questions, field_name='context', features=features)
 
@@ -222,8 +271,8 @@ class NumericalizedExamples(NamedTuple):
             context_values.append(torch.tensor(batch.context.value, device=device))
             context_lengths.append(torch.tensor(batch.context.length, device=device))
             context_limiteds.append(torch.tensor(batch.context.limited, device=device))
-            if batch.context.feature:
-                context_features.append(torch.tensor(batch.context.feature, device=device))
+            if batch.context.feature is not None:
+                context_features.append(torch.as_tensor(batch.context.feature, device=device))
 
             answer_values.append(torch.tensor(batch.answer.value, device=device))
             answer_lengths.append(torch.tensor(batch.answer.length, device=device))
@@ -250,3 +299,29 @@ class NumericalizedExamples(NamedTuple):
         answer = SequentialField(value=answer_values, length=answer_lengths, limited=answer_limiteds, feature=None)
 
         return NumericalizedExamples(example_id=example_id, context=context, answer=answer)
+
+    def split(self, num_chunks: int) -> List['NumericalizedExamples']:
+        """
+        Split a collated batch into `num_chunks` batches of consecutive examples (fewer if there are not enough examples)
+        """
+        chunk_size = -(-len(self.example_id) // num_chunks)
+
+        def split_field(field: SequentialField):
+            features = field.feature.split(chunk_size) if isinstance(field.feature, torch.Tensor) else None
+            return [
+                SequentialField(
+                    value=value,
+                    length=length,
+                    limited=limited,
+                    feature=features[i] if features is not None else field.feature,
+                )
+                for i, (value, length, limited) in enumerate(
+                    zip(field.value.split(chunk_size), field.length.split(chunk_size), field.limited.split(chunk_size))
+                )
+            ]
+
+        example_ids = [self.example_id[i : i + chunk_size] for i in range(0, len(self.example_id), chunk_size)]
+        return [
+            NumericalizedExamples(example_id=example_id, context=context, answer=answer)
+            for example_id, context, answer in zip(example_ids, split_field(self.context), split_field(self.answer))
+        ]
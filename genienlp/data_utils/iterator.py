@@ -41,12 +41,16 @@ _warned_for_batch_size = False
 class LengthSortedIterator(torch.utils.data.Sampler):
     """ """
 
-    def __init__(self, data_source, batch_size, sort, shuffle_and_repeat, sort_key_fn, batch_size_fn, groups=1):
+    def __init__(
+        self, data_source, batch_size, sort, shuffle_and_repeat, sort_key_fn, batch_size_fn, groups=1, rank=0, world_size=1
+    ):
         """
         batch_size: can be number of tokens or number of examples, the type is inferred from batch_size_fn
         sort: if False, disables sorting and uses the original order. Useful for evaluation.
         shuffle_and_repeat: if True, the order of returned examples are semi-shuffled, and there is no end to the iterator
         groups: used for sentence batching
+        rank, world_size: used for distributed training. All processes go through the same sequence of batches
+            (given the same random seed), and each one returns every `world_size`-th batch starting from its `rank`
         """
         if groups is None:
             groups = 1
@@ -56,6 +60,8 @@ class LengthSortedIterator(torch.utils.data.Sampler):
         self.sort_key = sort_key_fn
         self.batch_size_fn = batch_size_fn
         self.groups = groups
+        self.rank = rank
+        self.world_size = world_size
 
         if sort:
             # sort while keeping track of the original order
@@ -75,9 +81,12 @@ class LengthSortedIterator(torch.utils.data.Sampler):
         self.last_batch_start_index = 0
         self.last_batch_start_index = self._get_next_batch_start_index()
 
+        self.no_skip = not self.shuffle_and_repeat
+        self._compute_length()
+
+    def _compute_length(self):
         if not self.shuffle_and_repeat:
             # do not allow skipping examples during validation/ prediction
-            self.no_skip = True
             # quickly iterate over self to calculate length
             self.length = 0
             for _ in self:
@@ -86,18 +95,59 @@ class LengthSortedIterator(torch.utils.data.Sampler):
             self.last_batch_start_index = 0
             self.last_batch_start_index = self._get_next_batch_start_index()
         else:
-            self.no_skip = False
             self.length = len(self.data_source)
 
     def __len__(self):
         return self.length
 
+    def set_batch_size(self, batch_size):
+        # keep whole groups together
+        self.batch_size = max(batch_size - batch_size % self.groups, self.groups)
+        self._compute_length()
+
+    def first_batch(self, batch_size):
+        """
+        Returns the indices of the batch of at most `batch_size` that starts with the first example that fits in it, i.e. the
+        longest one if sorted, without changing the position of the iterator
+        """
+        batch_of_indices = []
+        for candidate_index in range(len(self.data_source)):
+            if not batch_of_indices and self.batch_size_fn([self.data_source[candidate_index]]) > batch_size:
+                continue
+            candidate_batch = [self.data_source[i] for i in batch_of_indices] + [self.data_source[candidate_index]]
+            if self.batch_size_fn(candidate_batch) > batch_size:
+                break
+            batch_of_indices.append(candidate_index)
+        # keep whole groups together
+        return batch_of_indices[: len(batch_of_indices) - len(batch_of_indices) % self.groups]
+
+    def state_dict(self):
+        """
+        The position of this iterator. Batch start positions are drawn from python's global `random` when
+        `shuffle_and_repeat` is True, so its state needs to be saved as well to reproduce the following batches
+        """
+        return {'last_batch_start_index': self.last_batch_start_index}
+
+    def load_state_dict(self, state_dict):
+        self.last_batch_start_index = state_dict['last_batch_start_index']
+
     def __iter__(self):
         self.last_batch_start_index = 0
         self.last_batch_start_index = self._get_next_batch_start_index()
         return self
 
     def __next__(self):
+        for _ in range(self.rank + 1):
+            batch_of_indices = self._next_batch()
+        # skip the batches of the following processes
+        for _ in range(self.world_size - self.rank - 1):
+            try:
+                self._next_batch()
+            except StopIteration:
+                break
+        return batch_of_indices
+
+    def _next_batch(self):
         batch_of_indices = []
         current_batch_size = 0
         candidate_index = self._get_next_batch_start_index()
@@ -28,13 +28,16 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import functools
+import hashlib
 import json
 import logging
 import os
 import re
 from collections import Counter, defaultdict
-from typing import List, Tuple
+from typing import Dict, List, Optional, Tuple
 
+import numpy as np
+import torch
 from pathos import multiprocessing
 from torch.nn.utils.rnn import pad_sequence
 from transformers import (
@@ -59,7 +62,7 @@ from transformers import (
 
 from ..util import get_devices
 from .decoder_vocab import DecoderVocabulary
-from .example import Entity, SequentialField
+from .example import EntityFeatures, SequentialField
 
 logger = logging.getLogger(__name__)
 
@@ -91,6 +94,9 @@ ALLOWED_FAST_TOKENIZERS_IF_PREPROCESSING = {
 # for input batches smaller than this value, multiprocessing will not be used due to its overhead
 MULTIPROCESSING_THRESHOLD = 5000
 
+# number of strings tokenized together when counting wordpieces for the decoder vocabulary
+VOCAB_TOKENIZATION_BATCH_SIZE = 1000
+
 
 class TransformerNumericalizer(object):
     """
@@ -98,8 +104,10 @@ class TransformerNumericalizer(object):
     """
 
     _special_tokens_to_word_map: List[Tuple[str, str]]
-    _special_tokens_to_word_regexes: List[Tuple[re.Pattern, str]]
-    _words_to_special_token_regexes: List[Tuple[re.Pattern, str]]
+    _special_tokens_to_word_dict: Dict[str, str]
+    _words_to_special_token_dict: Dict[str, str]
+    _special_tokens_to_word_regex: Optional[re.Pattern]
+    _words_to_special_token_regex: Optional[re.Pattern]
 
     def __init__(
         self, pretrained_tokenizer, args, max_generative_vocab, config, src_lang, tgt_lang, vocab_sets, tasks, save_dir=None
@@ -117,10 +125,13 @@ class TransformerNumericalizer(object):
 
         # map a special token to a space-separated sequence of words
         self._special_tokens_to_word_map = []
-        # same, but the token is a regular expression matching that token using \b
-        self._special_tokens_to_word_regexes = []
-        # map a space-separated sequence of words to a special token matching that sequence of words using regex
-        self._words_to_special_token_regexes = []
+        # same, as dictionaries in both directions, used to look up the replacement of a match
+        self._special_tokens_to_word_dict = {}
+        self._words_to_special_token_dict = {}
+        # a single regular expression matching any special token (resp. any sequence of words mapping to a special token)
+        # so that a sentence is rewritten in one scan regardless of the number of special tokens
+        self._special_tokens_to_word_regex = None
+        self._words_to_special_token_regex = None
 
         self.args = args
 
@@ -284,12 +295,7 @@ class TransformerNumericalizer(object):
             # in this pass, we
             # 1) tokenize everything, to ensure we account for all added tokens
             # 2) we construct a counter of wordpieces in the answers, for the decoder vocabulary
-            decoder_words = Counter()
-            for dataset in vocab_sets:
-                for example in dataset:
-                    decoder_words.update(self._tokenizer.tokenize(example.context))
-                    decoder_words.update(self._tokenizer.tokenize(example.question))
-                    decoder_words.update(self._tokenizer.tokenize(example.answer))
+            decoder_words = self._count_decoder_words(vocab_sets)
 
             # add the required special tokens, if not present already
             # note: if the tokens are not present, it means they are not used natively
@@ -312,6 +318,97 @@ class TransformerNumericalizer(object):
                 for word, _freq in decoder_words.most_common(self.max_generative_vocab)
             ]
 
+    def _count_decoder_words(self, vocab_sets):
+        """
+        Count the wordpieces of all context, question and answer fields in `vocab_sets`.
+        Strings are tokenized in batches, and large datasets are split into chunks counted in parallel.
+        The counter is cached under `--cache`, keyed by a hash of the data, the tokenizer class (fast and slow tokenizers can
+        split words differently) and its vocabulary.
+        """
+        all_strings = [
+            text
+            for dataset in vocab_sets
+            for example in dataset
+            for text in (example.context, example.question, example.answer)
+        ]
+
+        data_hash = hashlib.sha1()
+        data_hash.update(
+            json.dumps(
+                [
+                    self._pretrained_name,
+                    type(self._tokenizer).__name__,
+                    self._preprocess_special_tokens,
+                    sorted(self._tokenizer.get_added_vocab().items()),
+                ]
+            ).encode('utf-8')
+        )
+        for text in all_strings:
+            data_hash.update(text.encode('utf-8') + b'\0')
+        cache_name = os.path.join(self.args.cache, 'decoder_words', data_hash.hexdigest())
+
+        if os.path.exists(cache_name) and not self.args.skip_cache:
+            logger.info(f'Loading cached decoder vocabulary counts from {cache_name}')
+            return torch.load(cache_name)
+
+        chunks = [
+            all_strings[i : i + VOCAB_TOKENIZATION_BATCH_SIZE]
+            for i in range(0, len(all_strings), VOCAB_TOKENIZATION_BATCH_SIZE)
+        ]
+        if len(all_strings) > MULTIPROCESSING_THRESHOLD:
+            # We need to set this so that `tokenizers` package does not complain about detecting forks.
+            os.environ['TOKENIZERS_PARALLELISM'] = "true"
+            multiprocessing_factor = multiprocessing.cpu_count() // len(get_devices(self.args.devices))
+            logger.info('multiprocessing factor for building the decoder vocabulary is %d', multiprocessing_factor)
+            with multiprocessing.Pool(multiprocessing_factor) as p:
+                partial_counts = p.map(self._count_wordpieces, chunks)
+        else:
+            partial_counts = map(self._count_wordpieces, chunks)
+
+        decoder_words = Counter()
+        for counts in partial_counts:
+            decoder_words.update(counts)
+
+        if self.args.cache_input_data:
+            os.makedirs(os.path.dirname(cache_name), exist_ok=True)
+            logger.info(f'Caching decoder vocabulary counts to {cache_name}')
+            torch.save(decoder_words, cache_name)
+
+        return decoder_words
+
+    def _count_wordpieces(self, strings):
+        counts = Counter()
+        if self._use_fast():
+            # same wordpieces as `tokenize`, but computed for the whole batch at once
+            for encoding in self._tokenizer.batch_encode_plus(strings, add_special_tokens=False).encodings:
+                counts.update(encoding.tokens)
+        else:
+            for text in strings:
+                counts.update(self._tokenizer.tokenize(text))
+        return counts
+
+    def fingerprint(self):
+        """
+        A hash of everything that determines how a string is numericalized: the tokenizer and its vocabulary (including
+        tokens added by `build_vocab` and `grow_vocab`), special token preprocessing, input prefix and decoder vocabulary.
+        It changes whenever the vocabulary grows, so numericalized data cached under it is invalidated automatically.
+        """
+        state = [
+            self._pretrained_name,
+            type(self._tokenizer).__name__,
+            len(self._tokenizer),
+            sorted(self._tokenizer.get_added_vocab().items()),
+            sorted((key, str(value)) for key, value in self._tokenizer.special_tokens_map.items()),
+            self._preprocess_special_tokens,
+            self._special_tokens_to_word_map,
+            self.input_prefix,
+            self._tokenizer.src_lang,
+            self._tokenizer.tgt_lang,
+            self.max_generative_vocab,
+            self._decoder_words if self.max_generative_vocab is not None else None,
+        ]
+        return hashlib.sha1(json.dumps(state).encode('utf-8')).hexdigest()
+
     def grow_vocab(self, tasks):
         if self._preprocess_special_tokens:
             # if we're preprocessing special tokens, we cannot extend the vocabulary
@@ -320,8 +417,9 @@ class TransformerNumericalizer(object):
             return
 
         # add the new special tokens from the task
+        # they are sorted so that separate processes growing the vocabulary from the same tasks assign them the same ids
         for task in tasks:
-            self._tokenizer.add_tokens(list(task.special_tokens))
+            self._tokenizer.add_tokens(sorted(task.special_tokens))
 
     def _build_special_tokens_maps(self, special_tokens):
         # we automatically construct the mapping from special tokens to the shortest unambiguous
@@ -403,13 +501,26 @@ class TransformerNumericalizer(object):
             self._special_tokens_to_word_map.append((token, word_sequences[0]))
 
     def _build_special_tokens_regexes(self):
-        for token, words in self._special_tokens_to_word_map:
-            # match requiring (at the beginning of the string or preceded by a space (positive lookbehind))
-            # and (at the end of the string or followed by a space (positive lookahead))
-            token_re = re.compile("(^|(?<= ))" + re.escape(token) + "(^|(?= ))")
-            self._special_tokens_to_word_regexes.append((token_re, words))
-            word_re = re.compile("(^|(?<= ))" + re.escape(words) + "($|(?= ))")
-            self._words_to_special_token_regexes.append((word_re, token))
+        self._special_tokens_to_word_dict = {token: words for token, words in self._special_tokens_to_word_map}
+        self._words_to_special_token_dict = {words: token for token, words in self._special_tokens_to_word_map}
+        if not self._special_tokens_to_word_map:
+            return
+
+        def alternation(strings):
+            # longer alternatives come first, so the longest candidate wins when several match at the same position
+            return '|'.join(re.escape(string) for string in sorted(strings, key=len, reverse=True))
+
+        # match requiring (at the beginning of the string or preceded by a space (positive lookbehind))
+        # and followed by a space (positive lookahead)
+        # note: tokens at the very end of the sentence are left untouched, which existing models were trained with
+        self._special_tokens_to_word_regex = re.compile(
+            "(?:^|(?<= ))(" + alternation(self._special_tokens_to_word_dict.keys()) + ")(?= )"
+        )
+        # match requiring (at the beginning of the string or preceded by a space (positive lookbehind))
+        # and (at the end of the string or followed by a space (positive lookahead))
+        self._words_to_special_token_regex = re.compile(
+            "(?:^|(?<= ))(" + alternation(self._words_to_special_token_dict.keys()) + ")(?=$| )"
+        )
 
     def _init_token_ids(self):
         self.pad_first = self._tokenizer.padding_side == 'left'
@@ -555,7 +666,7 @@ class TransformerNumericalizer(object):
         Inputs:
             sentences: a list of sentences to encode
             field_name: text field name (options: context, question, answer)
-            features: for each sentence we have a list of features per token (used for NED)
+            features: for each sentence, the `EntityFeatures` of its tokens (used for NED)
         """
         # We need to set this so that `tokenizers` package does not complain about detecting forks.
         os.environ['TOKENIZERS_PARALLELISM'] = "true"
@@ -564,7 +675,7 @@ class TransformerNumericalizer(object):
             features = []
             extract_word_pieces = False
         else:
-            assert all([len(sentence.split()) == len(feature) for sentence, feature in zip(sentences, features)])
+            assert all([len(sentence.split()) == feature.num_tokens for sentence, feature in zip(sentences, features)])
             extract_word_pieces = True
 
         batch_size = len(sentences)
@@ -599,16 +710,13 @@ class TransformerNumericalizer(object):
             if features:
                 for i, (sentence, index2expansion) in enumerate(zip(sentences, index2expansions)):
                     feat = features[i]
-                    new_feat = []
-                    keys = set(index2expansion.keys())
-                    for j in range(len(feat)):
-                        repeat = 1
-                        if j in keys:
-                            repeat = index2expansion[j]
-
-                        new_feat.extend(feat[j] * repeat)
+                    # repeat the features of each special token for all the words it expands to
+                    repeats = np.ones(feat.num_tokens, dtype=np.int64)
+                    for j, expansion in index2expansion.items():
+                        repeats[j] = expansion
+                    new_feat = feat.take(np.repeat(np.arange(feat.num_tokens), repeats))
 
-                    assert len(new_feat) == len(sentence.split(' '))
+                    assert new_feat.num_tokens == len(sentence.split(' '))
 
                     all_input_features.append(new_feat)
 
@@ -688,20 +796,16 @@ class TransformerNumericalizer(object):
 
         if features:
             for i in range(batch_size):
-                wp_features = []
                 wp_tokenized = all_wp_tokenized[i]
 
                 feat = features[i]
 
                 # first token is always not a piece
-                is_wp = [0] + [int(self._tokenizer.is_piece_fn(wp)) for wp in wp_tokenized[1:]]
-                k = -1
-                for j, wp in enumerate(wp_tokenized):
-                    if not is_wp[j]:
-                        k += 1
-                    wp_features.append(feat[k])
+                is_word_start = [1] + [int(not self._tokenizer.is_piece_fn(wp)) for wp in wp_tokenized[1:]]
+                # each word piece gets the features of the word it belongs to
+                wp_features = feat.take(np.cumsum(is_word_start, dtype=np.int64) - 1)
 
-                assert len(wp_tokenized) == len(wp_features)
+                assert len(wp_tokenized) == wp_features.num_tokens
 
                 all_input_features.append(wp_features)
 
@@ -717,8 +821,13 @@ class TransformerNumericalizer(object):
                 special_tokens_mask = batch_special_tokens_mask[i]
                 num_prefix_special_tokens, num_suffix_special_tokens = self.get_num_special_tokens(special_tokens_mask)
 
-                pad_feat = Entity.get_pad_entity(self.args.max_features_size)
-                feat = [pad_feat] * num_prefix_special_tokens + feat + [pad_feat] * num_suffix_special_tokens
+                feat = EntityFeatures.concatenate(
+                    [
+                        EntityFeatures.get_pad(num_prefix_special_tokens, self.args.max_features_size),
+                        feat,
+                        EntityFeatures.get_pad(num_suffix_special_tokens, self.args.max_features_size),
+                    ]
+                )
 
                 batch_features.append(feat)
 
@@ -735,8 +844,8 @@ class TransformerNumericalizer(object):
         sequential_fields = []
         for i in range(batch_size):
             if features:
-                feature = [feat.flatten() for feat in batch_features[i]]
-                assert len(batch_numerical[i]) == len(feature)
+                feature = batch_features[i].flatten()
+                assert len(batch_numerical[i]) == feature.shape[0]
             else:
                 feature = None
 
@@ -752,14 +861,17 @@ class TransformerNumericalizer(object):
 
     def _apply_special_token_preprocessing(self, sentence, return_idx2exp=False):
         index2expansion = {}
-        if return_idx2exp:
-            for i, (regex, replacement) in enumerate(self._special_tokens_to_word_regexes):
-                for match in regex.finditer(sentence):
-                    idx = match.span()[0]
-                    tokens_before_idx = len(sentence[:idx].split(' '))
-                    index2expansion[tokens_before_idx] = len(replacement.split(' '))
-        for i, (regex, replacement) in enumerate(self._special_tokens_to_word_regexes):
-            sentence = regex.sub(replacement, sentence)
+
+        def replace(match):
+            replacement = self._special_tokens_to_word_dict[match.group(1)]
+            if return_idx2exp:
+                # positions are computed on the original sentence, before any expansion
+                token_idx = match.string.count(' ', 0, match.start())
+                index2expansion[token_idx] = replacement.count(' ') + 1
+            return replacement
+
+        if self._special_tokens_to_word_regex is not None:
+            sentence = self._special_tokens_to_word_regex.sub(replace, sentence)
         # '^' is an unknown token to T5 tokenizer and will break the preprocessing.
         # '~' is also unknown to T5. Evaluating models in server mode will give wrong results since answers will not
         # go through genienlp and remain intact while predictions will be missing these tokens. We replace such tokens
@@ -775,8 +887,10 @@ class TransformerNumericalizer(object):
         if isinstance(self._tokenizer, (T5Tokenizer, T5TokenizerFast)):
             sentence = sentence.replace('%', '^^')
             sentence = sentence.replace('#', '~')
-        for regex, replacement in self._words_to_special_token_regexes:
-            sentence = regex.sub(replacement, sentence)
+        if self._words_to_special_token_regex is not None:
+            sentence = self._words_to_special_token_regex.sub(
+                lambda match: self._words_to_special_token_dict[match.group(1)], sentence
+            )
         return sentence
 
     def reverse(self, batch, field_name, skip_special_tokens=True):
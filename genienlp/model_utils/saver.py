@@ -35,29 +35,64 @@ Created on Mar 3, 2019
 import json
 import logging
 import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import torch
 
 logger = logging.getLogger(__name__)
 
 
+def snapshot_to_cpu(obj):
+    """
+    Copy all tensors in a (possibly nested) state dict to CPU, so that the copy is not affected by later updates
+    """
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: snapshot_to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot_to_cpu(v) for v in obj)
+    return obj
+
+
+def atomic_save(obj, path):
+    """
+    Save `obj` to `path` such that `path` always contains either the previous or the new version of the file,
+    even if the process crashes while writing
+    """
+    tmp_path = path + '.tmp'
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
 class Saver(object):
     '''
     Wrap pytorch's save functionality into an interface similar to tensorflow.train.Saver
 
     In particular, this class takes care of automatically cleaning up old checkpoints,
     and creating checkpoint files to keep track of which saves are valid and which are not.
+
+    Checkpoints are written on a background thread, so that saving does not stall training.
+    At most `max_pending_saves` checkpoints can be waiting to be written; further calls to `save` block until
+    the oldest one is done. Call `close` to wait for all checkpoints to be written.
     '''
 
-    def __init__(self, savedir, max_to_keep=5):
+    def __init__(self, savedir, max_to_keep=5, max_pending_saves=1):
         self._savedir = savedir
         self._max_to_keep = max_to_keep
         assert max_to_keep >= 1
+        self._max_pending_saves = max_pending_saves
+        assert max_pending_saves >= 1
 
         self._loaded_last_checkpoints = False
         self._latest_checkpoint = None
         self._all_checkpoints = None
 
+        # a single worker writes checkpoints in the order they are saved
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending_saves = deque()
+
     def _maybe_load_last_checkpoints(self):
         if self._loaded_last_checkpoints:
             return
@@ -73,7 +108,11 @@ class Saver(object):
             self._all_checkpoints = []
             self._latest_checkpoint = None
 
-    def save(self, save_model_state_dict, save_opt_state_dict, global_step):
+    def save(self, save_model_state_dict, save_opt_state_dict, global_step, save_best=False):
+        """
+        Snapshot the state dicts and write them to disk in the background.
+        If `save_best` is True, they are also written to best.pth and best_optim.pth
+        """
         self._maybe_load_last_checkpoints()
 
         model_name = 'iteration_' + str(global_step) + '.pth'
@@ -81,15 +120,68 @@ class Saver(object):
 
         self._latest_checkpoint = model_name
         self._all_checkpoints.append(model_name)
-        if len(self._all_checkpoints) > self._max_to_keep:
+        todelete = []
+        while len(self._all_checkpoints) > self._max_to_keep:
+            todelete.append(self._all_checkpoints.pop(0))
+        checkpoint_data = dict(all=list(self._all_checkpoints), latest=self._latest_checkpoint)
+
+        save_model_state_dict = snapshot_to_cpu(save_model_state_dict)
+        save_opt_state_dict = snapshot_to_cpu(save_opt_state_dict)
+
+        self._submit(
+            self._write,
+            save_model_state_dict,
+            save_opt_state_dict,
+            model_name,
+            opt_name,
+            checkpoint_data,
+            todelete,
+            save_best,
+        )
+
+    def save_best(self, save_model_state_dict, save_opt_state_dict):
+        """
+        Snapshot the state dicts and write them to best.pth and best_optim.pth in the background,
+        without adding a new checkpoint
+        """
+        save_model_state_dict = snapshot_to_cpu(save_model_state_dict)
+        save_opt_state_dict = snapshot_to_cpu(save_opt_state_dict)
+
+        self._submit(self._write_best, save_model_state_dict, save_opt_state_dict)
+
+    def _submit(self, fn, *args):
+        while len(self._pending_saves) >= self._max_pending_saves:
+            self._pending_saves.popleft().result()
+        self._pending_saves.append(self._executor.submit(fn, *args))
+
+    def _write(self, save_model_state_dict, save_opt_state_dict, model_name, opt_name, checkpoint_data, todelete, save_best):
+        atomic_save(save_model_state_dict, os.path.join(self._savedir, model_name))
+        atomic_save(save_opt_state_dict, os.path.join(self._savedir, opt_name))
+        if save_best:
+            self._write_best(save_model_state_dict, save_opt_state_dict)
+
+        # only update checkpoint.json once all the files it points to are complete
+        tmp_path = os.path.join(self._savedir, 'checkpoint.json.tmp')
+        with open(tmp_path, 'w') as fp:
+            json.dump(checkpoint_data, fp)
+        os.replace(tmp_path, os.path.join(self._savedir, 'checkpoint.json'))
+
+        for name in todelete:
             try:
-                todelete = self._all_checkpoints.pop(0)
-                os.unlink(os.path.join(self._savedir, todelete))
-                opt_todelete = todelete.rsplit('.', 1)[0] + '_optim.' + todelete.rsplit('.', 1)[1]
+                os.unlink(os.path.join(self._savedir, name))
+                opt_todelete = name.rsplit('.', 1)[0] + '_optim.' + name.rsplit('.', 1)[1]
                 os.unlink(os.path.join(self._savedir, opt_todelete))
             except (OSError, IOError) as e:
-                logging.warning('Failed to delete old checkpoint: %s', e)
-        torch.save(save_model_state_dict, os.path.join(self._savedir, model_name))
-        torch.save(save_opt_state_dict, os.path.join(self._savedir, opt_name))
-        with open(os.path.join(self._savedir, 'checkpoint.json'), 'w') as fp:
-            json.dump(dict(all=self._all_checkpoints, latest=self._latest_checkpoint), fp)
+                logger.warning('Failed to delete old checkpoint: %s', e)
+
+    def _write_best(self, save_model_state_dict, save_opt_state_dict):
+        atomic_save(save_model_state_dict, os.path.join(self._savedir, 'best.pth'))
+        atomic_save(save_opt_state_dict, os.path.join(self._savedir, 'best_optim.pth'))
+
+    def close(self):
+        """
+        Wait until all checkpoints are written. Errors that happened while writing are raised here
+        """
+        while self._pending_saves:
+            self._pending_saves.popleft().result()
+        self._executor.shutdown()
@@ -72,6 +72,16 @@ def compute_attention(sample_layer_attention, att_pooling, dim=0):
     return sample_layer_attention_pooled
 
 
+def special_token_bounds(ids, special_ids):
+    """
+    Returns, for each row of `ids`, the start and end (exclusive) of its tokens without leading and trailing special tokens
+    """
+    is_special = (ids.unsqueeze(-1) == torch.tensor(special_ids, device=ids.device)).any(dim=-1)
+    num_leading = (~is_special).long().cumsum(dim=1).eq(0).sum(dim=1)
+    num_trailing = (~is_special).long().flip(dims=[1]).cumsum(dim=1).eq(0).sum(dim=1)
+    return num_leading, torch.max(ids.size(1) - num_trailing, num_leading)
+
+
 def return_token_word_mapping(tokens, tokenizer):
     is_not_piece = [int(not tokenizer.is_piece_fn(token)) for token in tokens]
     token2word_mapping = list(np.cumsum(is_not_piece) - 1)
@@ -85,8 +95,16 @@ def return_token_word_mapping(tokens, tokenizer):
     return token2word_mapping, word2token_span_mapping
 
 
-def align_and_replace(src_tokens, tgt_tokens, tokenizer, sample_layer_attention_pooled, src_spans, remove_output_quotation):
+def align_and_replace(
+    src_tokens, tgt_tokens, tokenizer, sample_layer_attention_pooled, src_spans, remove_output_quotation, alignment=None
+):
+    """
+    `alignment`, if provided, is the index of the target token each source token attends to most, which callers can compute
+    for a whole batch at once. Otherwise, it is computed from `sample_layer_attention_pooled`
+    """
     src_quotation_symbol = '"'
+    if alignment is None:
+        alignment = torch.argmax(sample_layer_attention_pooled, dim=0).tolist()
 
     # M2M100Tokenizer has missing tokens in its fixed vocabulary and encodes them as unknown (https://github.com/pytorch/fairseq/issues/3463)
     # until that's fixed we treat unknown tokens as individual words by prepending SPIECE_UNDERLINE
@@ -148,8 +166,8 @@ def align_and_replace(src_tokens, tgt_tokens, tokenizer, sample_layer_attention_
     for src_beg, src_end in src_token_spans:
         if (src_beg, src_end) in src2tgt_token_mapping:
             continue
-        tgt_beg = torch.argmax(sample_layer_attention_pooled[:, src_beg]).item()
-        tgt_end = torch.argmax(sample_layer_attention_pooled[:, src_end]).item()
+        tgt_beg = alignment[src_beg]
+        tgt_end = alignment[src_end]
 
         # switch tgt begin and end indices
         if tgt_beg > tgt_end:
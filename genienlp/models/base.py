@@ -72,6 +72,17 @@ class GenieModel(PreTrainedModel):
 
         return model, save_dict.get('best_decascore')
 
+    @staticmethod
+    def set_gradient_checkpointing(model: PreTrainedModel, enable: bool):
+        """
+        Make `model` recompute the activations of its layers during the backward pass instead of storing them.
+        Models that do not support gradient checkpointing ignore this flag.
+        """
+        # `transformers` reads this flag from the config in the forward pass of each layer stack
+        model.config.gradient_checkpointing = enable
+        if enable:
+            logger.info(f'Gradient checkpointing is enabled for {model.__class__.__name__}')
+
     def add_new_vocab_from_data(self, tasks, resize_decoder=False):
         old_num_tokens = self.numericalizer.num_tokens
         self.numericalizer.grow_vocab(tasks)
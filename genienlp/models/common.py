@@ -207,6 +207,11 @@ class LSTMDecoderAttention(nn.Module):
         # context is batch x encoder_time x dim
         # output will be batch x decoder_time x dim
         # context_attention will be batch x decoder_time x encoder_time
+        # input can also have several consecutive rows per row of context (e.g. the hypotheses of beam search), which are
+        # then attended as extra decoder time steps of the same row, so that context never needs to be copied for each of them
+        num_rows = input.size(0)
+        if num_rows != context.size(0):
+            input = input.reshape(context.size(0), -1, input.size(-1))
 
         if not self.dot:
             targetT = self.linear_in(input)  # batch x decoder_time x dim x 1
@@ -218,16 +223,16 @@ class LSTMDecoderAttention(nn.Module):
         context_scores.masked_fill_(self.context_mask, -float('inf'))
         context_attention = F.softmax(context_scores, dim=-1) + EPSILON
 
-        # convert context_attention to batch x decoder_time x 1 x encoder_time
-        # convert context to batch x 1 x encoder_time x dim
-        # context_alignment will be batch x decoder_time x 1 x dim
-        context_alignment = torch.matmul(context_attention.unsqueeze(2), context.unsqueeze(1))
-        # squeeze out the extra dimension
-        context_alignment = context_alignment.squeeze(2)
+        # context_alignment will be batch x decoder_time x dim
+        context_alignment = torch.bmm(context_attention, context)
 
         combined_representation = torch.cat([input, context_alignment], 2)
         output = self.tanh(self.linear_out(combined_representation))
 
+        if num_rows != context.size(0):
+            output = output.view(num_rows, -1, output.size(-1))
+            context_attention = context_attention.view(num_rows, -1, context_attention.size(-1))
+
         return output, context_attention
 
 
@@ -31,6 +31,7 @@
 import torch
 from torch import nn
 from torch.nn import functional as F
+from torch.utils.checkpoint import checkpoint
 from transformers.modeling_outputs import Seq2SeqLMOutput
 
 from .common import EPSILON, CombinedEmbedding, Feedforward, LSTMDecoderAttention, MultiLSTMCell, mask
@@ -50,7 +51,11 @@ class MQANDecoder(nn.Module):
 
         if args.rnn_layers > 0:
             self.rnn_decoder = LSTMDecoder(
-                args.dimension, args.rnn_dimension, dropout=args.dropout_ratio, num_layers=args.rnn_layers
+                args.dimension,
+                args.rnn_dimension,
+                dropout=args.dropout_ratio,
+                num_layers=args.rnn_layers,
+                gradient_checkpointing=args.gradient_checkpointing,
             )
             switch_input_len = 2 * args.rnn_dimension + args.dimension
         else:
@@ -179,12 +184,13 @@ class MQANDecoder(nn.Module):
 
 
 class LSTMDecoder(nn.Module):
-    def __init__(self, d_in, d_hid, dropout=0.0, num_layers=1):
+    def __init__(self, d_in, d_hid, dropout=0.0, num_layers=1, gradient_checkpointing=False):
         super().__init__()
         self.d_hid = d_hid
         self.d_in = d_in
         self.num_layers = num_layers
         self.dropout = nn.Dropout(dropout)
+        self.gradient_checkpointing = gradient_checkpointing
 
         self.input_feed = True
         if self.input_feed:
@@ -197,33 +203,46 @@ class LSTMDecoder(nn.Module):
         self.context_attn.applyMasks(context_mask)
 
     def forward(self, input: torch.Tensor, context, output=None, hidden=None):
-        context_output = output if output is not None else self.make_init_output(context)
+        context_output = output if output is not None else self.make_init_output(input)
 
         context_outputs, vocab_pointer_switch_inputs, context_attentions = [], [], []
         for decoder_input in input.split(1, dim=1):
-            context_output = self.dropout(context_output)
-            if self.input_feed:
-                rnn_input = torch.cat([decoder_input, context_output], 2)
+            if self.gradient_checkpointing and self.training:
+                # only the inputs of each time step are kept, and its activations are recomputed during the backward pass
+                # dropout masks are reproduced since `checkpoint` restores the RNG state before recomputing
+                step_outputs = checkpoint(self.step, decoder_input, context_output, context, *hidden)
             else:
-                rnn_input = decoder_input
-
-            rnn_input = rnn_input.squeeze(1)
-            dec_state, hidden = self.rnn(rnn_input, hidden)
-            dec_state = dec_state.unsqueeze(1)
-
-            context_output, context_attention = self.context_attn(dec_state, context)
-            vocab_pointer_switch_inputs.append(torch.cat([dec_state, context_output, decoder_input], -1))
-
-            context_output = self.dropout(context_output)
+                step_outputs = self.step(decoder_input, context_output, context, *hidden)
+            context_output, vocab_pointer_switch_input, context_attention, h, c = step_outputs
+            hidden = (h, c)
+            vocab_pointer_switch_inputs.append(vocab_pointer_switch_input)
             context_outputs.append(context_output)
             context_attentions.append(context_attention)
 
         return [torch.cat(x, dim=1) for x in (context_outputs, vocab_pointer_switch_inputs, context_attentions)] + [hidden]
 
-    def make_init_output(self, context):
-        batch_size = context.size(0)
+    def step(self, decoder_input, context_output, context, h, c):
+        context_output = self.dropout(context_output)
+        if self.input_feed:
+            rnn_input = torch.cat([decoder_input, context_output], 2)
+        else:
+            rnn_input = decoder_input
+
+        rnn_input = rnn_input.squeeze(1)
+        dec_state, (h, c) = self.rnn(rnn_input, (h, c))
+        dec_state = dec_state.unsqueeze(1)
+
+        context_output, context_attention = self.context_attn(dec_state, context)
+        vocab_pointer_switch_input = torch.cat([dec_state, context_output, decoder_input], -1)
+
+        context_output = self.dropout(context_output)
+        return context_output, vocab_pointer_switch_input, context_attention, h, c
+
+    def make_init_output(self, input):
+        # one initial output per row of input, which can have more rows than context during beam search
+        batch_size = input.size(0)
         h_size = (batch_size, 1, self.d_hid)
-        return context.new_zeros(h_size)
+        return input.new_zeros(h_size)
 
 
 class MQANDecoderWrapper(object):
@@ -244,9 +263,9 @@ class MQANDecoderWrapper(object):
         expansion_factor: int,
     ):
         self.decoder_vocab = decoder_vocab
-        context = self.expand_for_beam_search(context, batch_size, expansion_factor)
-        context_padding = self.expand_for_beam_search(context_padding, batch_size, expansion_factor)
-        context_indices = self.expand_for_beam_search(context_indices, batch_size, expansion_factor)
+        # context, context_padding and context_indices are shared by all hypotheses of an input, so they are kept un-expanded
+        # and the `expansion_factor` consecutive hypotheses of each input are broadcast against them
+        # only rnn_state and decoder_output are per hypothesis
         if rnn_state is not None:
             rnn_state = self.expand_for_beam_search(rnn_state, batch_size, expansion_factor, dim=1)
         self.context = context
@@ -256,28 +275,88 @@ class MQANDecoderWrapper(object):
         self.batch_size = batch_size
         self.max_decoder_time = max_decoder_time
         self.mqan_decoder = mqan_decoder
+        self.expansion_factor = expansion_factor
 
-        if self.mqan_decoder.args.rnn_layers > 0:
-            self.mqan_decoder.rnn_decoder.applyMasks(self.context_padding)
-        else:
-            self.mqan_decoder.context_attn.applyMasks(self.context_padding)
+        # inputs whose hypotheses have all finished are dropped from the state above, so the decoder only runs on the rest
+        # active_rows are the rows (among all batch_size * expansion_factor rows) still in the state, and row_positions
+        # maps each row to its position in the state, or -1 if it has been dropped
+        self.num_rows = batch_size * expansion_factor
+        self.active_rows = torch.arange(self.num_rows, device=context.device)
+        self.row_positions = self.active_rows.clone()
+
+        self.apply_masks()
 
         self.time = 0
         self.decoder_output = None
 
-    def reorder(self, new_order):
-        # TODO only reordering rnn_state should be enough since reordering happens among beams of the same input
-        self.context = self.reorder_for_beam_search(self.context, new_order)
-        self.context_padding = self.reorder_for_beam_search(self.context_padding, new_order)
-        self.context_indices = self.reorder_for_beam_search(self.context_indices, new_order)
-        self.rnn_state = self.reorder_for_beam_search(self.rnn_state, new_order, dim=1)
-
+    def apply_masks(self):
         if self.mqan_decoder.args.rnn_layers > 0:
             self.mqan_decoder.rnn_decoder.applyMasks(self.context_padding)
         else:
             self.mqan_decoder.context_attn.applyMasks(self.context_padding)
 
+    def reorder(self, new_order):
+        # reordering only happens among hypotheses of the same input, so the un-expanded context tensors are unaffected
+        if len(self.active_rows) < self.num_rows:
+            new_order = self.row_positions[new_order.index_select(0, self.active_rows)]
+            # generate points the hypotheses of finished inputs to arbitrary rows, which may have been dropped already
+            new_order = torch.where(new_order >= 0, new_order, torch.arange(len(new_order), device=new_order.device))
+        if self.rnn_state is not None:
+            self.rnn_state = self.reorder_for_beam_search(self.rnn_state, new_order, dim=1)
+        if self.decoder_output is not None:
+            self.decoder_output = self.reorder_for_beam_search(self.decoder_output, new_order)
+
+    def drop_finished_inputs(self, current_token_id):
+        """
+        Removes from the state the inputs whose hypotheses have all emitted EOS, which `generate` then only extends with padding.
+        Returns the token ids of the remaining rows.
+        """
+        numericalizer = self.mqan_decoder.numericalizer
+        finished = (current_token_id == numericalizer.eos_id) | (current_token_id == numericalizer.pad_id)
+        finished_inputs = finished.view(-1, self.expansion_factor).all(dim=1)
+        if not finished_inputs.any():
+            return current_token_id
+
+        kept_inputs = (~finished_inputs).nonzero(as_tuple=True)[0]
+        hypothesis_offsets = torch.arange(self.expansion_factor, device=kept_inputs.device)
+        kept_rows = (kept_inputs.unsqueeze(1) * self.expansion_factor + hypothesis_offsets).view(-1)
+        self.context = self.context.index_select(0, kept_inputs)
+        self.context_padding = self.context_padding.index_select(0, kept_inputs)
+        self.context_indices = self.context_indices.index_select(0, kept_inputs)
+        if self.rnn_state is not None:
+            self.rnn_state = self.reorder_for_beam_search(self.rnn_state, kept_rows, dim=1)
+        if self.decoder_output is not None:
+            self.decoder_output = self.reorder_for_beam_search(self.decoder_output, kept_rows)
+        self.apply_masks()
+
+        self.active_rows = self.active_rows.index_select(0, kept_rows)
+        self.row_positions.fill_(-1)
+        self.row_positions[self.active_rows] = torch.arange(len(self.active_rows), device=self.active_rows.device)
+
+        return current_token_id.index_select(0, kept_rows)
+
     def next_token_probs(self, current_token_id):
+        if len(self.active_rows) < self.num_rows:
+            current_token_id = current_token_id.index_select(0, self.active_rows)
+        current_token_id = self.drop_finished_inputs(current_token_id)
+
+        probs = self.active_token_probs(current_token_id)
+        if len(self.active_rows) < self.num_rows:
+            probs = self.scatter_to_all_rows(probs)
+
+        self.time += 1
+        return probs
+
+    def scatter_to_all_rows(self, probs):
+        # generate discards the tokens of finished rows, so they just need a valid distribution; log(1) gives uniform logits
+        all_probs = probs.new_ones(self.num_rows, 1, len(self.decoder_vocab))
+        all_probs.index_copy_(0, self.active_rows, probs)
+        return all_probs
+
+    def active_token_probs(self, current_token_id):
+        if len(self.active_rows) == 0:
+            return self.context.new_empty(0, 1, len(self.decoder_vocab))
+
         embedding = self.mqan_decoder.decoder_embeddings(current_token_id)
 
         if self.mqan_decoder.args.rnn_layers > 0:
@@ -293,12 +372,16 @@ class MQANDecoderWrapper(object):
 
         vocab_pointer_switch = self.mqan_decoder.vocab_pointer_switch(vocab_pointer_switch_input)
 
+        # group the hypotheses of each input together, so that they share the row of context_indices of that input
+        num_rows, num_inputs = self.decoder_output.size(0), self.context.size(0)
         probs = self.mqan_decoder.probs(
-            self.decoder_output, vocab_pointer_switch, context_attention, self.context_indices, self.decoder_vocab
+            self.decoder_output.reshape(num_inputs, -1, self.decoder_output.size(-1)),
+            vocab_pointer_switch.reshape(num_inputs, -1, 1),
+            context_attention.reshape(num_inputs, -1, context_attention.size(-1)),
+            self.context_indices,
+            self.decoder_vocab,
         )
-
-        self.time += 1
-        return probs
+        return probs.view(num_rows, 1, probs.size(-1))
 
     def expand_for_beam_search(self, t, batch_size, num_beams, dim=0):
         if isinstance(t, tuple):
@@ -333,11 +416,6 @@ class MQANDecoderWrapper(object):
                 elements.append(self.reorder_for_beam_search(e, new_order, dim))
             return elements
 
-        p = [i for i in range(len(t.shape))]
-        p[dim] = 0
-        p[0] = dim
-        t = t.permute(*p)
-        t = t[new_order]
-        t = t.permute(*p)
+        t = t.index_select(dim, new_order)
 
         return t
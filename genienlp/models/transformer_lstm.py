@@ -104,6 +104,7 @@ class TransformerLSTM(GenieModel):
                 )
 
         self.encoder_embeddings.resize_token_embeddings(self.numericalizer.num_tokens)
+        self.set_gradient_checkpointing(self.encoder_embeddings, args.gradient_checkpointing)
 
         logger.info(f'Vocabulary has {self.numericalizer.num_tokens} tokens')
 
@@ -197,6 +198,13 @@ class TransformerLSTM(GenieModel):
         past.reorder(beam_idx)
         return past
 
+    def encode(self, batch):
+        """
+        Runs the encoder on `batch`. The output can be passed to `generate` to avoid running the encoder again when decoding
+        the same batch several times
+        """
+        return self.encoder(batch)
+
     def generate(
         self,
         batch,
@@ -211,9 +219,16 @@ class TransformerLSTM(GenieModel):
         diversity_penalty,
         no_repeat_ngram_size,
         do_sample,
+        encoder_output=None,
+        output_step_logits=False,
+        prompt_lookup_num_tokens=0,
+        cross_attention_layers=(),
     ):
+        # confidence features, prompt lookup decoding and attention outputs are not supported by this model,
+        # so `output_step_logits`, `prompt_lookup_num_tokens` and `cross_attention_layers` are ignored
 
-        encoder_output = self.encoder(batch)
+        if encoder_output is None:
+            encoder_output = self.encoder(batch)
         self.config.vocab_size = len(self.numericalizer.decoder_vocab)
         self.config.is_encoder_decoder = (
             False  # in order to make it work with `transformers` generation code, we should treat this as a decoder-only model
@@ -32,6 +32,8 @@ from typing import List
 
 import torch
 from transformers import AutoConfig, AutoModelForSeq2SeqLM, MBartTokenizer, MBartTokenizerFast
+from transformers.generation_utils import GreedySearchEncoderDecoderOutput
+from transformers.modeling_outputs import BaseModelOutput
 
 from ..data_utils.numericalizer import TransformerNumericalizer
 from ..model_utils.transformers_utils import MULTILINGUAL_TOKENIZERS
@@ -41,6 +43,12 @@ from .common import LabelSmoothingCrossEntropy
 
 logger = logging.getLogger(__name__)
 
+# maximum number of logits computed at once for MC dropout, which bounds the memory used by a forward pass
+MC_DROPOUT_MAX_LOGITS = 2 ** 28
+
+# longest end of the output that prompt lookup decoding searches for in the input
+PROMPT_LOOKUP_MAX_NGRAM_SIZE = 3
+
 
 class TransformerSeq2Seq(GenieModel):
     def __init__(self, config=None, *inputs, args, tasks, vocab_sets, save_directory=None, **kwargs):
@@ -75,6 +83,7 @@ class TransformerSeq2Seq(GenieModel):
         )
 
         self.model.resize_token_embeddings(self.numericalizer.num_tokens)
+        self.set_gradient_checkpointing(self.model, args.gradient_checkpointing)
 
         # set decoder_start_token_id for mbart
         if self.model.config.decoder_start_token_id is None and isinstance(
@@ -132,8 +141,12 @@ class TransformerSeq2Seq(GenieModel):
             # longer sequences in the batch do not drown shorter sequences.
             # (3) if `args.dropper_ratio > 0.0`, will perform Loss Truncation
             # (4) if `args.label_smoothing > 0.0`, will add label smoothing term to loss
+            # key/value caching is only useful during generation, and cannot be combined with gradient checkpointing
             outputs = self.model(
-                batch.context.value, labels=answer, attention_mask=(batch.context.value != self.numericalizer.pad_id)
+                batch.context.value,
+                labels=answer,
+                attention_mask=(batch.context.value != self.numericalizer.pad_id),
+                use_cache=False,
             )
             batch_size, vocab_size = outputs.logits.shape[0], outputs.logits.shape[2]
             loss = self.criterion(
@@ -150,6 +163,18 @@ class TransformerSeq2Seq(GenieModel):
         else:
             return self.model(**kwargs)
 
+    def encode(self, batch):
+        """
+        Runs the encoder on `batch`. The output can be passed to `generate` and `confidence_features` to avoid running the
+        encoder again when decoding the same batch several times
+        """
+        input_ids = batch.context.value
+        # same attention mask as the one generate() uses by default
+        attention_mask = self.model._prepare_attention_mask_for_generation(
+            input_ids=input_ids, pad_token_id=self.numericalizer.pad_id, eos_token_id=self.numericalizer.eos_id
+        )
+        return self.model.get_encoder()(input_ids=input_ids, attention_mask=attention_mask, return_dict=True)
+
     def generate(
         self,
         batch,
@@ -164,41 +189,249 @@ class TransformerSeq2Seq(GenieModel):
         diversity_penalty,
         no_repeat_ngram_size,
         do_sample,
+        encoder_output=None,
+        output_step_logits=False,
+        prompt_lookup_num_tokens=0,
+        cross_attention_layers=(),
     ):
+        """
+        If `cross_attention_layers` is not empty, the returned output's `cross_attentions` is a tensor of shape
+        (num_layers, batch_size * num_outputs, num_heads, output_length - 1, input_length) with the cross-attention of these
+        decoder layers at each decoding step. Otherwise, it is None and attention is not recorded at all
+        If `output_step_logits` is True, the returned output has a `step_logits` tensor of shape
+        (batch_size * num_outputs, output_length - 1, vocab_size) with the logits of the model at each decoding step, before
+        any processing like temperature or repetition penalty, which `confidence_features` can use instead of running the
+        model again. Beam search reorders and drops hypotheses in ways `transformers` does not report, so it never has them
+        If `prompt_lookup_num_tokens` > 0, greedy decoding uses `prompt_lookup_generate` with drafts of that many tokens
+        """
+
+        if prompt_lookup_num_tokens > 0 and num_beams == 1 and num_beam_groups == 1 and not do_sample and num_outputs == 1:
+            return self.prompt_lookup_generate(
+                batch,
+                max_output_length,
+                repetition_penalty,
+                no_repeat_ngram_size,
+                prompt_lookup_num_tokens,
+                encoder_output=encoder_output,
+                output_step_logits=output_step_logits,
+                cross_attention_layers=cross_attention_layers,
+            )
 
         input_ids = batch.context.value
+        model_kwargs = {}
+        if encoder_output is not None:
+            # generate() replaces the hidden states of its encoder output when expanding it for beams or multiple outputs,
+            # so it gets its own copy
+            model_kwargs['encoder_outputs'] = BaseModelOutput(last_hidden_state=encoder_output.last_hidden_state)
+
+        step_logits = []
+        step_cross_attentions = []
+        # each forward pass of the decoder during greedy decoding or sampling predicts the next token of every sequence
+        output_step_logits = output_step_logits and num_beams == 1
+
+        def record_step(module, inputs, outputs):
+            if output_step_logits:
+                # logits processors like repetition penalty modify this slice of the output in place, so it is copied
+                step_logits.append(outputs.logits[:, -1, :].clone())
+            if cross_attention_layers:
+                step_cross_attentions.append(
+                    torch.stack([outputs.cross_attentions[layer] for layer in cross_attention_layers])
+                )
+                # otherwise generate() keeps the attention of all layers at all steps until the end
+                outputs.cross_attentions = None
+                outputs.decoder_attentions = None
+
+        hook = None
+        if output_step_logits or cross_attention_layers:
+            hook = self.model.register_forward_hook(record_step)
 
         # when attention_mask is not provided to generate(), it will default to masking pad tokens, which is the correct thing
-        generated = self.model.generate(
-            input_ids=input_ids,
-            max_length=max_output_length,
-            min_length=3,  # generate at least one token after BOS and language code
-            bos_token_id=self.numericalizer.init_id,
-            pad_token_id=self.numericalizer.pad_id,
-            early_stopping=False,
-            num_return_sequences=num_outputs,
+        try:
+            generated = self.model.generate(
+                input_ids=input_ids,
+                max_length=max_output_length,
+                min_length=3,  # generate at least one token after BOS and language code
+                bos_token_id=self.numericalizer.init_id,
+                pad_token_id=self.numericalizer.pad_id,
+                early_stopping=False,
+                num_return_sequences=num_outputs,
+                repetition_penalty=repetition_penalty,
+                temperature=temperature,
+                eos_token_id=self.numericalizer.eos_id,
+                top_k=top_k,
+                top_p=top_p,
+                num_beams=num_beams,
+                num_beam_groups=num_beam_groups,
+                diversity_penalty=diversity_penalty,
+                no_repeat_ngram_size=no_repeat_ngram_size,
+                do_sample=do_sample,
+                output_scores=False,
+                output_attentions=len(cross_attention_layers) > 0,
+                output_hidden_states=False,
+                return_dict_in_generate=True,
+                **model_kwargs,
+            )
+        finally:
+            if hook is not None:
+                hook.remove()
+        if step_logits:
+            generated.step_logits = torch.stack(step_logits, dim=1)
+        if step_cross_attentions:
+            # from (output_length - 1, num_layers, batch_size, num_heads, 1, input_length)
+            generated.cross_attentions = torch.stack(step_cross_attentions).squeeze(4).permute(1, 2, 3, 0, 4)
+
+        return generated
+
+    def prompt_lookup_generate(
+        self,
+        batch,
+        max_output_length,
+        repetition_penalty,
+        no_repeat_ngram_size,
+        num_draft_tokens,
+        encoder_output=None,
+        output_step_logits=False,
+        cross_attention_layers=(),
+    ):
+        """
+        Greedy decoding with the same output as `generate`, but which checks several tokens per decoder pass.
+        The tokens that follow the end of the output in the input are proposed as a draft (see `prompt_lookup_draft`), and
+        the longest prefix of the draft that greedy decoding would produce is accepted along with the token that follows it.
+        Outputs that copy spans of the input, like quoted strings and entities in ThingTalk, then need far fewer decoder passes.
+        All sequences of a batch advance by the same number of tokens, so this works best with small batches
+        """
+        input_ids = batch.context.value
+        pad_id, eos_id = self.numericalizer.pad_id, self.numericalizer.eos_id
+        if encoder_output is None:
+            encoder_output = self.encode(batch)
+        attention_mask = self.model._prepare_attention_mask_for_generation(
+            input_ids=input_ids, pad_token_id=pad_id, eos_token_id=eos_id
+        )
+        # same processing of the logits as in generate(), including model-specific options like forced BOS and EOS tokens
+        logits_processor = self.model._get_logits_processor(
             repetition_penalty=repetition_penalty,
-            temperature=temperature,
-            eos_token_id=self.numericalizer.eos_id,
-            top_k=top_k,
-            top_p=top_p,
-            num_beams=num_beams,
-            num_beam_groups=num_beam_groups,
-            diversity_penalty=diversity_penalty,
             no_repeat_ngram_size=no_repeat_ngram_size,
-            do_sample=do_sample,
-            output_scores=False,
-            output_attentions=True,
-            output_hidden_states=False,
-            return_dict_in_generate=True,
+            encoder_no_repeat_ngram_size=None,
+            encoder_input_ids=input_ids,
+            bad_words_ids=None,
+            min_length=3,  # same as generate()
+            max_length=max_output_length,
+            eos_token_id=eos_id,
+            forced_bos_token_id=None,
+            forced_eos_token_id=None,
+            prefix_allowed_tokens_fn=None,
+            num_beams=1,
+            num_beam_groups=1,
+            diversity_penalty=None,
+            remove_invalid_values=None,
+        )
+
+        output_ids = self.model._prepare_decoder_input_ids_for_generation(input_ids, bos_token_id=self.numericalizer.init_id)
+        unfinished = torch.ones(input_ids.size(0), dtype=torch.bool, device=input_ids.device)
+        # past_key_values always covers all of output_ids except its last token
+        past_key_values = None
+        cross_attentions = []
+        step_logits = []
+        while True:
+            output_length = output_ids.size(1)
+            draft = self.prompt_lookup_draft(
+                input_ids, output_ids, min(num_draft_tokens, max_output_length - output_length - 1)
+            )
+            outputs = self.model(
+                attention_mask=attention_mask,
+                encoder_outputs=encoder_output,
+                decoder_input_ids=torch.cat((output_ids[:, -1:], draft), dim=1),
+                past_key_values=past_key_values,
+                use_cache=True,
+                output_attentions=len(cross_attention_layers) > 0,
+                return_dict=True,
+            )
+            # logits processors modify the logits in place
+            logits = outputs.logits.clone() if output_step_logits else outputs.logits
+
+            candidate_ids = torch.cat((output_ids, draft), dim=1)
+            next_tokens = torch.stack(
+                [
+                    logits_processor(candidate_ids[:, : output_length + i], outputs.logits[:, i, :]).argmax(dim=-1)
+                    for i in range(draft.size(1) + 1)
+                ],
+                dim=1,
+            )
+
+            # draft tokens of finished sequences do not matter, so they do not limit how many tokens are accepted
+            ended_in_draft = (draft == eos_id).long().cumsum(dim=1) - (draft == eos_id).long() > 0
+            matches = (next_tokens[:, :-1] == draft) | ended_in_draft | ~unfinished.unsqueeze(1)
+            num_accepted = int(matches.long().cumprod(dim=1).sum(dim=1).min()) if draft.size(1) > 0 else 0
+            new_tokens = next_tokens[:, : num_accepted + 1]
+
+            # like generate(), finished sequences are extended with padding, and decoding stops once all of them are finished
+            is_eos = new_tokens == eos_id
+            ended_before = (is_eos.long().cumsum(dim=1) - is_eos.long() > 0) | ~unfinished.unsqueeze(1)
+            new_tokens = new_tokens.masked_fill(ended_before, pad_id)
+            ended_after = ended_before | is_eos
+            all_ended = ended_after.all(dim=0).nonzero(as_tuple=True)[0]
+            if len(all_ended) > 0:
+                new_tokens = new_tokens[:, : int(all_ended[0]) + 1]
+            num_new_tokens = new_tokens.size(1)
+            unfinished = ~ended_after[:, num_new_tokens - 1]
+
+            output_ids = torch.cat((output_ids, new_tokens), dim=1)
+            if cross_attention_layers:
+                cross_attentions.append(
+                    torch.stack(
+                        [outputs.cross_attentions[layer][:, :, :num_new_tokens, :] for layer in cross_attention_layers]
+                    )
+                )
+            if output_step_logits:
+                step_logits.append(logits[:, :num_new_tokens, :])
+            # only keep the self-attention keys and values of accepted tokens
+            past_length = output_length + num_new_tokens - 1
+            past_key_values = tuple(
+                (layer[0][:, :, :past_length, :], layer[1][:, :, :past_length, :]) + layer[2:]
+                for layer in outputs.past_key_values
+            )
+
+            if not unfinished.any() or output_ids.size(1) >= max_output_length:
+                break
+
+        generated = GreedySearchEncoderDecoderOutput(
+            sequences=output_ids, cross_attentions=torch.cat(cross_attentions, dim=3) if cross_attentions else None
         )
+        if output_step_logits:
+            generated.step_logits = torch.cat(step_logits, dim=1)
 
         return generated
 
-    def confidence_features(self, batch, predictions, mc_dropout_num=0) -> List[ConfidenceFeatures]:
+    def prompt_lookup_draft(self, input_ids, output_ids, num_tokens):
+        """
+        Returns the `num_tokens` tokens that follow, in the input, the first occurrence of the longest end of the output of
+        up to PROMPT_LOOKUP_MAX_NGRAM_SIZE tokens. Sequences with no such occurrence get the last tokens of their input,
+        which are checked like any other draft
+        """
+        batch_size, input_length = input_ids.shape
+        draft_start = input_ids.new_full((batch_size,), input_length)
+        found = torch.zeros(batch_size, dtype=torch.bool, device=input_ids.device)
+        for ngram_size in range(min(PROMPT_LOOKUP_MAX_NGRAM_SIZE, output_ids.size(1), input_length), 0, -1):
+            windows = input_ids.unfold(1, ngram_size, 1)
+            matches = (windows == output_ids[:, -ngram_size:].unsqueeze(1)).all(dim=2)
+            # the highest weight is that of the first match
+            weights = torch.arange(matches.size(1), 0, -1, device=input_ids.device)
+            first_match = (matches * weights).argmax(dim=1)
+            is_new_match = matches.any(dim=1) & ~found
+            draft_start = torch.where(is_new_match, first_match + ngram_size, draft_start)
+            found |= is_new_match
+
+        positions = draft_start.unsqueeze(1) + torch.arange(num_tokens, device=input_ids.device)
+        return input_ids.gather(1, positions.clamp(max=input_length - 1))
+
+    def confidence_features(
+        self, batch, predictions, mc_dropout_num=0, encoder_output=None, step_logits=None
+    ) -> List[ConfidenceFeatures]:
         """
         predictions: Tensor of shape (batch_size, output_length)
         mc_droput_num: number of Monte Carlo samples used for the MC Dropout method. 0 disables MC dropout.
+        encoder_output: output of `encode` for `batch`, reused for the pass without dropout
+        step_logits: `step_logits` of the output of `generate` for `predictions`, which replace the pass without dropout
         """
         batch_size = predictions.shape[0]
         repetition_factor = batch_size // batch.context.value.shape[0]
@@ -206,7 +439,7 @@ class TransformerSeq2Seq(GenieModel):
             repetition_factor, dim=0
         )  # repeat to account for multiple predictions per input
 
-        prediction_lengths = self.get_length(predictions)
+        prediction_lengths = self.get_length(predictions).tolist()
 
         pad_token_id = self.numericalizer.pad_id
         attention_mask = self.model._prepare_attention_mask_for_generation(
@@ -216,67 +449,62 @@ class TransformerSeq2Seq(GenieModel):
 
         assert not self.training, 'Model should be in eval() mode before generation can start.'
 
-        batch_nodrop_logits = []
-        batch_nodrop_probs = []
-        batch_nodrop_entropies = []
-        # batch_nodrop_top1_probs = []
-        # batch_nodrop_top1_idx = []
-        # batch_nodrop_top2_probs = []
-        # batch_nodrop_top2_idx = []
-        outputs = self.model(
-            input_ids=input_ids,
-            decoder_input_ids=predictions,
-            attention_mask=attention_mask,
-            return_dict=True,
-            use_cache=False,
-        )
-        nodrop_logits = outputs.logits[:, :-1, :]  # remove the last probability distribution which is for the token after EOS
-        for i in range(batch_size):
-            batch_nodrop_logits.append(
-                nodrop_logits[i].gather(dim=1, index=truncated_predictions[i].view(-1, 1)).view(-1)[: prediction_lengths[i]]
-            )
-            probs = torch.softmax(nodrop_logits[i], dim=1)
-            batch_nodrop_probs.append(
-                probs.gather(dim=1, index=truncated_predictions[i].view(-1, 1)).view(-1)[: prediction_lengths[i]]
+        if step_logits is not None and step_logits.shape[:2] == truncated_predictions.shape:
+            # the logits computed during generation are the same as the ones of a forward pass over the predictions
+            nodrop_logits = step_logits
+        else:
+            nodrop_kwargs = {}
+            if encoder_output is not None:
+                nodrop_kwargs['encoder_outputs'] = BaseModelOutput(
+                    last_hidden_state=encoder_output.last_hidden_state.repeat_interleave(repetition_factor, dim=0)
+                )
+            outputs = self.model(
+                input_ids=input_ids,
+                decoder_input_ids=predictions,
+                attention_mask=attention_mask,
+                return_dict=True,
+                use_cache=False,
+                **nodrop_kwargs,
             )
-            batch_nodrop_entropies.append(-torch.sum(torch.log(probs) * probs, dim=1)[: prediction_lengths[i]])
-            # sorted_probs = probs.sort(dim=1)
-            # batch_nodrop_top1_probs.append(sorted_probs.values[:, -1][:prediction_lengths[i]])
-            # batch_nodrop_top2_probs.append(sorted_probs.values[:, -2][:prediction_lengths[i]])
-            # batch_nodrop_top1_idx.append(sorted_probs.indices[:, -1][:prediction_lengths[i]])
-            # batch_nodrop_top2_idx.append(sorted_probs.indices[:, -2][:prediction_lengths[i]])
+            # remove the last probability distribution which is for the token after EOS
+            nodrop_logits = outputs.logits[:, :-1, :]
+            del outputs
+        # all of the following have shape (batch_size, output_length - 1), and are cut to the length of each prediction below
+        nodrop_log_probs = torch.log_softmax(nodrop_logits, dim=2)
+        batch_nodrop_logits = nodrop_logits.gather(dim=2, index=truncated_predictions.unsqueeze(2)).squeeze(2)
+        batch_nodrop_probs = nodrop_log_probs.gather(dim=2, index=truncated_predictions.unsqueeze(2)).squeeze(2).exp()
+        batch_nodrop_entropies = -torch.sum(nodrop_log_probs.exp().mul_(nodrop_log_probs), dim=2)
+        vocab_size = nodrop_logits.shape[2]
+        del nodrop_logits, nodrop_log_probs
 
         # activate dropout layers
         self.train()
 
-        batch_drop_logits = [[] for _ in range(batch_size)]
-        batch_drop_probs = [[] for _ in range(batch_size)]
-        # batch_drop_top1_probs = [[] for _ in range(batch_size)]
-        # batch_drop_top2_probs = [[] for _ in range(batch_size)]
-        for _ in range(mc_dropout_num):
+        # all MC dropout samples of as many predictions as fit in the memory budget are computed in a single pass,
+        # each repetition of a prediction gets different dropout masks
+        samples_per_pass = max(1, MC_DROPOUT_MAX_LOGITS // (batch_size * predictions.shape[1] * vocab_size))
+        batch_drop_logits = []
+        batch_drop_probs = []
+        for start in range(0, mc_dropout_num, samples_per_pass):
+            num_samples = min(samples_per_pass, mc_dropout_num - start)
             outputs = self.model(
-                input_ids=input_ids,
-                decoder_input_ids=predictions,
-                attention_mask=attention_mask,
+                input_ids=input_ids.repeat(num_samples, 1),
+                decoder_input_ids=predictions.repeat(num_samples, 1),
+                attention_mask=attention_mask.repeat(num_samples, 1),
                 return_dict=True,
                 use_cache=False,
             )
-            drop_logits = outputs.logits[
-                :, :-1, :
-            ]  # remove the last probability distribution which is for the token after EOS
-            for i in range(batch_size):
-                batch_drop_logits[i].append(
-                    (drop_logits[i].gather(dim=1, index=truncated_predictions[i].view(-1, 1)).view(-1))[
-                        : prediction_lengths[i]
-                    ]
-                )
-                softmax = torch.softmax(drop_logits[i], dim=1)
-                drop_probs = softmax.gather(dim=1, index=truncated_predictions[i].view(-1, 1)).view(-1)[
-                    : prediction_lengths[i]
-                ]
-                batch_drop_probs[i].append(drop_probs)
-                # batch_drop_top1_probs[i].append(softmax.gather(dim=1, index=batch_nodrop_top1_idx[i].view(-1, 1)).view(-1)[:prediction_lengths[i]])
-                # batch_drop_top2_probs[i].append(softmax.gather(dim=1, index=batch_nodrop_top2_idx[i].view(-1, 1)).view(-1)[:prediction_lengths[i]])
+            drop_logits = outputs.logits[:, :-1, :]
+            index = truncated_predictions.repeat(num_samples, 1).unsqueeze(2)
+            # reshape to (num_samples, batch_size, output_length - 1)
+            batch_drop_logits.append(drop_logits.gather(dim=2, index=index).view(num_samples, batch_size, -1))
+            batch_drop_probs.append(
+                torch.log_softmax(drop_logits, dim=2).gather(dim=2, index=index).exp().view(num_samples, batch_size, -1)
+            )
+            del outputs, drop_logits
+        if mc_dropout_num > 0:
+            batch_drop_logits = torch.cat(batch_drop_logits, dim=0)
+            batch_drop_probs = torch.cat(batch_drop_probs, dim=0)
 
         confidence_features = []
         for i in range(batch_size):
@@ -287,16 +515,12 @@ class TransformerSeq2Seq(GenieModel):
                 prediction = predictions[i][1 : prediction_lengths[i] + 1]  # remove token before BOS, +1 to include EOS
             confidence_features.append(
                 ConfidenceFeatures(
-                    drop_logits=batch_drop_logits[i] if mc_dropout_num > 0 else None,
-                    drop_probs=batch_drop_probs[i] if mc_dropout_num > 0 else None,
-                    #  drop_top1_probs=batch_drop_top1_probs[i] if mc_dropout_num > 0 else None,
-                    #  drop_top2_probs=batch_drop_top2_probs[i] if mc_dropout_num > 0 else None,
+                    drop_logits=list(batch_drop_logits[:, i, : prediction_lengths[i]]) if mc_dropout_num > 0 else None,
+                    drop_probs=list(batch_drop_probs[:, i, : prediction_lengths[i]]) if mc_dropout_num > 0 else None,
                     gold_answer=batch.answer.value[i // repetition_factor][: batch.answer.length[i // repetition_factor]],
                     prediction=prediction,
                     nodrop_logits=batch_nodrop_logits[i][: prediction_lengths[i]],
                     nodrop_probs=batch_nodrop_probs[i][: prediction_lengths[i]],
-                    #  nodrop_top1_probs=batch_nodrop_top1_probs[i][:prediction_lengths[i]],
-                    #  nodrop_top2_probs=batch_nodrop_top2_probs[i][:prediction_lengths[i]],
                     nodrop_entropies=batch_nodrop_entropies[i][: prediction_lengths[i]],
                     context=batch.context.value[i // repetition_factor][: batch.context.length[i // repetition_factor]],
                 )
@@ -84,6 +84,7 @@ class TransformerForTokenClassification(GenieModel):
         )
 
         self.model.resize_token_embeddings(self.numericalizer.num_tokens)
+        self.set_gradient_checkpointing(self.model, args.gradient_checkpointing)
 
         self.numericalizer.answer_pad_id = -100
 
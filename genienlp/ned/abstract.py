@@ -31,7 +31,7 @@ import os
 
 import ujson
 
-from ..data_utils.example import Entity
+from ..data_utils.example import EntityFeatures
 
 logger = logging.getLogger(__name__)
 
@@ -96,35 +96,38 @@ class AbstractEntityDisambiguator(object):
             features += [pad_id] * (max_size - len(features))
         return features
 
-    def convert_entities_to_strings(self, feat):
+    def convert_entities_to_strings(self, features, i):
         final_types = ''
         if 'type_id' in self.args.entity_attributes:
-            all_types = ' | '.join(sorted(self.typeqid_to_type_vocab[self.id2typeqid[id]] for id in feat.type_id if id != 0))
+            all_types = ' | '.join(
+                sorted(self.typeqid_to_type_vocab[self.id2typeqid[id]] for id in features.type_id[i].tolist() if id != 0)
+            )
             final_types = '( ' + all_types + ' )'
         final_qids = ''
         if 'qid' in self.args.entity_attributes:
-            all_qids = ' | '.join(sorted('Q' + str(id) for id in feat.qid if id != -1))
+            all_qids = ' | '.join(sorted('Q' + str(id) for id in features.qid[i].tolist() if id != -1))
             final_qids = '[ ' + all_qids + ' ]'
 
         return final_types, final_qids
 
     def add_entities_to_text(self, sentence, features):
         sentence_tokens = sentence.split(' ')
-        assert len(sentence_tokens) == len(features)
+        assert len(sentence_tokens) == features.num_tokens
+        is_entity = features.type_id.any(axis=1).tolist()
         sentence_plus_types_tokens = []
         i = 0
         if self.args.add_entities_to_text == 'insert':
             while i < len(sentence_tokens):
                 token = sentence_tokens[i]
-                feat = features[i]
                 # token is an entity
-                if any([val != 0 for val in feat.type_id]):
+                if is_entity[i]:
+                    start = i
                     final_token = '<e> '
-                    final_types, final_qids = self.convert_entities_to_strings(feat)
+                    final_types, final_qids = self.convert_entities_to_strings(features, start)
                     final_token += final_types + final_qids + token
                     # concat all entities with the same type
                     i += 1
-                    while i < len(sentence_tokens) and features[i] == feat:
+                    while i < len(sentence_tokens) and features.same_entity(i, start):
                         final_token += ' ' + sentence_tokens[i]
                         i += 1
                     final_token += ' </e>'
@@ -137,13 +140,13 @@ class AbstractEntityDisambiguator(object):
             sentence_plus_types_tokens.extend(sentence_tokens)
             sentence_plus_types_tokens.append('<e>')
             while i < len(sentence_tokens):
-                feat = features[i]
                 # token is an entity
-                if any([val != 0 for val in feat.type_id]):
-                    final_types, final_qids = self.convert_entities_to_strings(feat)
+                if is_entity[i]:
+                    start = i
+                    final_types, final_qids = self.convert_entities_to_strings(features, start)
                     all_tokens = []
                     # concat all entities with the same type
-                    while i < len(sentence_tokens) and features[i] == feat:
+                    while i < len(sentence_tokens) and features.same_entity(i, start):
                         all_tokens.append(sentence_tokens[i])
                         i += 1
                     final_token = ' '.join(filter(lambda token: token != '', [*all_tokens, final_types, final_qids, ';']))
@@ -163,12 +166,12 @@ class AbstractEntityDisambiguator(object):
         for n, (ex, tokens_type_ids, tokens_type_probs, tokens_qids) in enumerate(
             zip(examples, all_token_type_ids, all_token_type_probs, all_token_qids)
         ):
-            features = [Entity(*tup) for tup in zip(tokens_type_ids, tokens_type_probs, tokens_qids)]
+            features = EntityFeatures.from_lists(tokens_type_ids, tokens_type_probs, tokens_qids)
             if utterance_field == 'question':
                 assert len(tokens_type_ids) == len(tokens_type_probs) == len(tokens_qids) == len(ex.question.split(' '))
                 examples[n].question_feature = features
                 # use pad features for non-utterance field
-                examples[n].context_feature = [Entity.get_pad_entity(self.max_features_size)] * len(ex.context.split(' '))
+                examples[n].context_feature = EntityFeatures.get_pad(len(ex.context.split(' ')), self.max_features_size)
                 # override original question with entities added to it
                 examples[n].question = self.add_entities_to_text(ex.question, features)
 
@@ -176,6 +179,6 @@ class AbstractEntityDisambiguator(object):
                 assert len(tokens_type_ids) == len(tokens_type_probs) == len(tokens_qids) == len(ex.context.split(' '))
                 examples[n].context_feature = features
                 # use pad features for non-utterance field
-                examples[n].question_feature = [Entity.get_pad_entity(self.max_features_size)] * len(ex.question.split(' '))
+                examples[n].question_feature = EntityFeatures.get_pad(len(ex.question.split(' ')), self.max_features_size)
                 # override original context with entities added to it
                 examples[n].context = self.add_entities_to_text(ex.context, features)
@@ -139,14 +139,14 @@ class BaseEntityDisambiguator(AbstractEntityDisambiguator):
 
                     # match found
                     found = True
-                    tokens_type_ids.extend([[self.typeqid2id[type] * self.max_features_size] for _ in range(i, cur)])
+                    tokens_type_ids.extend([[self.typeqid2id[type]] * self.max_features_size for _ in range(i, cur)])
 
                     # move i to current unprocessed position
                     i = cur
                     break
 
             if not found:
-                tokens_type_ids.append([self.unk_id * self.max_features_size])
+                tokens_type_ids.append([self.unk_id] * self.max_features_size)
                 i += 1
 
         return tokens_type_ids
@@ -165,7 +165,7 @@ class BaseEntityDisambiguator(AbstractEntityDisambiguator):
                     # match found
                     found = True
                     tokens_type_ids.extend(
-                        [[self.typeqid2id[self.alias2type[tokens_str]] * self.max_features_size] for _ in range(i, end)]
+                        [[self.typeqid2id[self.alias2type[tokens_str]]] * self.max_features_size for _ in range(i, end)]
                     )
                     # move i to current unprocessed position
                     i = end
@@ -173,7 +173,7 @@ class BaseEntityDisambiguator(AbstractEntityDisambiguator):
                 else:
                     end -= 1
             if not found:
-                tokens_type_ids.append([self.unk_id * self.max_features_size])
+                tokens_type_ids.append([self.unk_id] * self.max_features_size)
                 i += 1
             found = False
 
@@ -32,11 +32,12 @@ import copy
 import json
 import logging
 import os
-import shutil
+import queue
+import traceback
 from collections import defaultdict
 from pprint import pformat
 
-from torch.multiprocessing import Process, set_start_method
+from torch.multiprocessing import Process, Queue, set_start_method
 
 try:
     set_start_method('spawn')
@@ -48,19 +49,12 @@ import torch
 from . import models
 from .arguments import check_and_update_generation_args
 from .calibrate import ConfidenceEstimator
+from .data_utils.example import NumericalizedExamples
+from .data_utils.progbar import progress_bar
 from .ned.ned_utils import init_ned_model
 from .tasks.registry import get_tasks
-from .util import (
-    combine_folders_on_disk,
-    get_devices,
-    get_part_path,
-    load_config_json,
-    log_model_size,
-    make_data_loader,
-    set_seed,
-    split_folder_on_disk,
-)
-from .validate import calculate_and_reduce_metrics, generate_with_model
+from .util import get_devices, load_config_json, log_model_size, make_data_loader, set_seed
+from .validate import calculate_and_reduce_metrics, finalize_generation_output, generate_with_model
 
 logger = logging.getLogger(__name__)
 
@@ -89,6 +83,12 @@ def parse_argv(parser):
         type=int,
         help='a list of devices that can be used for prediction. By default, all devices will be used.',
     )
+    parser.add_argument(
+        '--cpu_workers',
+        default=1,
+        type=int,
+        help='when running on CPU, split the batches across this many processes, each using an equal share of the CPU threads',
+    )
     parser.add_argument('--seed', default=123, type=int, help='Random seed.')
     parser.add_argument('--data', default='.data/', type=str, help='where to load data from.')
     parser.add_argument('--embeddings', default='.embeddings/', type=str, help='where to save embeddings.')
@@ -101,6 +101,11 @@ def parse_argv(parser):
     parser.add_argument('--skip_cache', action='store_true', help='whether use exisiting cached splits or generate new ones')
     parser.add_argument('--eval_dir', type=str, required=True, help='use this directory to store eval results')
     parser.add_argument('--cache', default='.cache', type=str, help='where to save cached files')
+    parser.add_argument(
+        '--cache_input_data',
+        action='store_true',
+        help='Cache examples from input data, and their numericalized version, for faster subsequent predictions',
+    )
     parser.add_argument('--subsample', default=20000000, type=int, help='subsample the eval/test datasets')
 
     parser.add_argument(
@@ -165,6 +170,13 @@ def parse_argv(parser):
         help='ngrams of this size cannot be repeated in the output. 0 disables it.',
     )
     parser.add_argument('--max_output_length', default=150, type=int, help='maximum output length for generation')
+    parser.add_argument(
+        '--prompt_lookup_num_tokens',
+        default=0,
+        type=int,
+        help='number of tokens copied from the input that greedy decoding checks at once, for models that support it. '
+        'Outputs are identical, but decoding is faster when they copy from the input. 0 disables it.',
+    )
 
     # These are used for confidence calibration
     parser.add_argument(
@@ -246,6 +258,12 @@ def set_default_values(args):
 
 def check_args(args):
 
+    if args.cpu_workers < 1:
+        raise ValueError('--cpu_workers should be at least 1')
+
+    if args.prompt_lookup_num_tokens < 0:
+        raise ValueError('--prompt_lookup_num_tokens should not be negative')
+
     if len(args.task_names) != len(args.pred_src_languages):
         raise ValueError(
             'You have to define prediction languages for each task'
@@ -286,6 +304,7 @@ def prepare_data(args, device, src_lang):
         kwargs.update(
             {
                 'skip_cache': args.skip_cache,
+                'cache_input_data': args.cache_input_data,
                 'subsample': args.subsample,
                 'cached_path': os.path.join(args.cache, task.name),
                 'all_dirs': task_languages,
@@ -364,7 +383,7 @@ def prepare_data_iterators(args, val_sets, numericalizer, device):
     return iters
 
 
-def run(args, device):
+def load_model(args, device):
     # TODO handle multiple languages
     src_lang = args.pred_src_languages[0]
     tgt_lang = args.pred_tgt_languages[0]
@@ -380,17 +399,163 @@ def run(args, device):
         tgt_lang=tgt_lang,
     )
 
+    return model
+
+
+def generation_worker(args, device, task_queue, result_queue, num_threads=None):
+    """
+    Loads the model on `device` and generates outputs for the batches received through `task_queue`, until it receives None.
+    Outputs (or the traceback of an error) are sent back through `result_queue`, together with the index of their batch
+    """
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    try:
+        # new embeddings are initialized randomly, so every worker needs the same seed to end up with the same model
+        set_seed(args)
+        model = load_model(args, device)
+        # the tasks were sent after preparing the data, so they have the special tokens the coordinator added
+        model.add_new_vocab_from_data(args.tasks)
+        model.to(device)
+        model.eval()
+        # split sentences are stitched back together by the coordinator, once it has the outputs of all batches
+        worker_args = copy.copy(args)
+        worker_args.translate_example_split = False
+        with torch.no_grad():
+            for task_idx, batch_idx, examples, output_confidence_features in iter(task_queue.get, None):
+                batch = NumericalizedExamples.collate_batches(examples, model.numericalizer, device)
+                with torch.cuda.amp.autocast(enabled=args.mixed_precision):
+                    output = generate_with_model(
+                        model,
+                        [batch],
+                        model.numericalizer,
+                        args.tasks[task_idx],
+                        worker_args,
+                        output_confidence_features=output_confidence_features,
+                    )
+                result_queue.put((batch_idx, output))
+    except Exception:
+        result_queue.put((None, traceback.format_exc()))
+
+
+class ShardedGenerator(object):
+    """
+    Generates outputs with one worker process per device. Batches are handed out through a queue to whichever worker is
+    idle, so that devices that get shorter batches or are faster process more of them
+    """
+
+    def __init__(self, args, devices, num_threads=None):
+        self._task_queue = Queue()
+        self._result_queue = Queue()
+        # workers are daemons, so they do not keep waiting for batches if the coordinator fails
+        self._workers = [
+            Process(
+                target=generation_worker,
+                args=(args, device, self._task_queue, self._result_queue, num_threads),
+                daemon=True,
+            )
+            for device in devices
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def generate(
+        self, data_loader, numericalizer, task, args, original_order, output_confidence_features, confidence_estimators
+    ):
+        sampler = data_loader.batch_sampler
+        task_idx = args.tasks.index(task)
+        # confidence scores are computed from confidence features
+        need_confidence_features = output_confidence_features or confidence_estimators is not None
+        num_batches = 0
+        for batch_idx, indices in enumerate(sampler):
+            examples = [sampler.data_source[i] for i in indices]
+            self._task_queue.put((task_idx, batch_idx, examples, need_confidence_features))
+            num_batches += 1
+
+        batch_outputs = [None] * num_batches
+        for _ in progress_bar(range(num_batches), desc='Generating'):
+            batch_idx, output = self._get_result()
+            batch_outputs[batch_idx] = output
+
+        # concatenate the outputs in the order of the data loader, like generate_with_model does
+        example_ids, predictions, answers, contexts, confidence_features = [], [], [], [], []
+        for output in batch_outputs:
+            example_ids += output.example_ids
+            predictions += output.predictions
+            answers += output.answers
+            contexts += output.contexts
+            confidence_features += output.confidence_features or [[] for _ in output.example_ids]
+
+        return finalize_generation_output(
+            example_ids,
+            predictions,
+            answers,
+            contexts,
+            confidence_features,
+            numericalizer,
+            args,
+            output_confidence_features=output_confidence_features,
+            original_order=original_order,
+            confidence_estimators=confidence_estimators,
+        )
+
+    def _get_result(self):
+        while True:
+            try:
+                batch_idx, output = self._result_queue.get(timeout=10)
+                break
+            except queue.Empty:
+                if any(worker.exitcode is not None for worker in self._workers):
+                    raise RuntimeError('A generation worker exited unexpectedly')
+        if batch_idx is None:
+            raise RuntimeError(f'A generation worker failed:\n{output}')
+        return batch_idx, output
+
+    def close(self):
+        for _ in self._workers:
+            self._task_queue.put(None)
+        for worker in self._workers:
+            worker.join()
+
+
+def run(args, devices):
+    # TODO handle multiple languages
+    src_lang = args.pred_src_languages[0]
+    tgt_lang = args.pred_tgt_languages[0]
+
+    # with multiple workers, the data is prepared once, here, and batches are sent to the workers as soon as they are done
+    # with the previous one, so the model is only needed here for its numericalizer
+    device = torch.device('cpu') if len(devices) > 1 else devices[0]
+    model = load_model(args, device)
+
     val_sets = prepare_data(args, device, src_lang)
     model.add_new_vocab_from_data(args.tasks)
-
-    iters = prepare_data_iterators(args, val_sets, model.numericalizer, device)
+    numericalizer = model.numericalizer
+    iters = prepare_data_iterators(args, val_sets, numericalizer, device)
 
     log_model_size(logger, model, args.model)
-    model.to(device)
+
+    # workers are only started now, so that the tasks they receive carry the state collected while preprocessing the data
+    # (special tokens, and what postprocessing needs, like the input spans of translation or paraphrasing's reverse maps)
+    if len(devices) > 1 or (devices[0].type == 'cpu' and args.cpu_workers > 1):
+        # each worker loads its own copy of the weights, so the ones loaded here are freed before starting them
+        model = None
+    if len(devices) > 1:
+        logger.info(f'Independent multi-GPU generation on following devices: {devices}')
+        sharded_generator = ShardedGenerator(args, devices)
+    elif devices[0].type == 'cpu' and args.cpu_workers > 1:
+        # a single process does not make good use of many cores with small models and short inputs, since each operation
+        # is too small to be split efficiently across threads
+        num_threads = max(1, torch.get_num_threads() // args.cpu_workers)
+        logger.info(f'CPU generation with {args.cpu_workers} processes using {num_threads} threads each')
+        sharded_generator = ShardedGenerator(args, devices * args.cpu_workers, num_threads=num_threads)
+    else:
+        logger.info(f'Single device generation on: {devices[0]}')
+        model.to(device)
+        model.eval()
+        sharded_generator = None
 
     decaScore = []
     task_scores = defaultdict(list)
-    model.eval()
 
     eval_dir = os.path.join(args.eval_dir, args.evaluate)
     os.makedirs(eval_dir, exist_ok=True)
@@ -425,18 +590,29 @@ def run(args, device):
                     logger.info('Loading confidence estimator "%s" from %s', estimator.name, path)
             else:
                 confidence_estimators = None
-            with torch.cuda.amp.autocast(enabled=args.mixed_precision):
-                generation_output = generate_with_model(
-                    model,
+            if sharded_generator is not None:
+                generation_output = sharded_generator.generate(
                     it,
-                    model.numericalizer,
+                    numericalizer,
                     task,
                     args,
                     original_order=original_order,
                     output_confidence_features=args.save_confidence_features,
                     confidence_estimators=confidence_estimators,
-                    disable_progbar=False,
                 )
+            else:
+                with torch.cuda.amp.autocast(enabled=args.mixed_precision):
+                    generation_output = generate_with_model(
+                        model,
+                        it,
+                        numericalizer,
+                        task,
+                        args,
+                        original_order=original_order,
+                        output_confidence_features=args.save_confidence_features,
+                        confidence_estimators=confidence_estimators,
+                        disable_progbar=False,
+                    )
 
             if args.save_confidence_features:
                 torch.save(generation_output.confidence_features, args.confidence_feature_path)
@@ -484,6 +660,9 @@ def run(args, device):
 
                 task_scores[task].append((len(generation_output.answers), metrics[task.metrics[0]]))
 
+    if sharded_generator is not None:
+        sharded_generator.close()
+
     for task in task_scores.keys():
         decaScore.append(
             sum([length * score for length, score in task_scores[task]]) / sum([length for length, score in task_scores[task]])
@@ -518,31 +697,4 @@ def main(args):
             metrics = [m if m != 'sacrebleu' else 'casedbleu' for m in metrics]
             task.metrics = metrics
 
-    if len(devices) > 1:
-        logger.info(f'Independent multi-GPU generation on following devices: {devices}')
-        all_processes = []
-        all_data_folders = split_folder_on_disk(args.data, len(devices))
-        if args.do_ned and args.ned_retrieve_method == 'bootleg':
-            all_bootleg_data_folders = split_folder_on_disk(args.bootleg_output_dir, len(devices))
-
-        for device_id in range(len(devices)):
-            copy_args = copy.copy(args)
-            copy_args.data = all_data_folders[device_id]
-            if args.do_ned and args.ned_retrieve_method == 'bootleg':
-                copy_args.bootleg_output_dir = all_bootleg_data_folders[device_id]
-            copy_args.eval_dir = get_part_path(args.eval_dir, device_id)
-
-            p = Process(target=run, args=(copy_args, devices[device_id]))
-            all_processes.append(p)
-            p.start()
-
-        for p in all_processes:
-            p.join()
-
-        for folder in all_data_folders:
-            shutil.rmtree(folder)
-        combine_folders_on_disk(args.eval_dir, len(devices), line_group_size=1, delete=True)
-
-    else:
-        logger.info(f'Single device generation on: {devices[0]}')
-        run(args, devices[0])
+    run(args, devices)
@@ -90,6 +90,13 @@ def parse_argv(parser):
         help='ngrams of this size cannot be repeated in the output. 0 disables it.',
     )
     parser.add_argument('--max_output_length', default=150, type=int, help='maximum output length for generation')
+    parser.add_argument(
+        '--prompt_lookup_num_tokens',
+        default=0,
+        type=int,
+        help='number of tokens copied from the input that greedy decoding checks at once, for models that support it. '
+        'Outputs are identical, but decoding is faster when they copy from the input. 0 disables it.',
+    )
 
     # for confidence estimation:
     parser.add_argument(
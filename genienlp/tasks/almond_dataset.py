@@ -40,13 +40,16 @@ from .generic_dataset import CQA
 
 logger = logging.getLogger(__name__)
 
+# number of lines whose examples are constructed and preprocessed together
+EXAMPLE_BATCH_SIZE = 1000
+
 
 class AlmondDataset(CQA):
     """Obtaining dataset for Almond semantic parsing task"""
 
     base_url = None
 
-    def __init__(self, path, *, make_example, **kwargs):
+    def __init__(self, path, *, make_examples, **kwargs):
 
         # TODO fix cache_path for multilingual task
         subsample = kwargs.get('subsample')
@@ -87,8 +90,8 @@ class AlmondDataset(CQA):
                             'in_file': chunk_file_paths[i],
                             'chunk_size': chunk_size,
                             'dir_name': dir_name,
-                            'example_batch_size': 1,
-                            'make_process_example': make_example,
+                            'example_batch_size': EXAMPLE_BATCH_SIZE,
+                            'make_process_examples': make_examples,
                             'kwargs': kwargs,
                         }
                         for i in range(num_chunks)
@@ -105,8 +108,8 @@ class AlmondDataset(CQA):
                     'in_file': path,
                     'chunk_size': max_examples,
                     'dir_name': dir_name,
-                    'example_batch_size': 1,
-                    'make_process_example': make_example,
+                    'example_batch_size': EXAMPLE_BATCH_SIZE,
+                    'make_process_examples': make_examples,
                     'kwargs': kwargs,
                 }
                 examples = create_examples_from_file(process_args)
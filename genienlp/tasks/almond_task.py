@@ -34,6 +34,10 @@ from collections import defaultdict
 import torch
 
 from ..data_utils.almond_utils import (
+    ENTITY_OR_PROGRAM_TOKEN_REGEX,
+    ENTITY_TOKEN_REGEX,
+    PROGRAM_TOKEN_REGEX,
+    PUNCTUATION_SPACE_REGEX,
     ISO_to_LANG,
     detokenize_cjk_chars,
     is_device,
@@ -43,7 +47,7 @@ from ..data_utils.almond_utils import (
     tokenize_cjk_chars,
 )
 from ..data_utils.example import Example
-from ..model_utils.translation import align_and_replace, compute_attention
+from ..model_utils.translation import align_and_replace, compute_attention, special_token_bounds
 from ..paraphrase.data_utils import input_heuristics, output_heuristics
 from .almond_dataset import AlmondDataset
 from .base_dataset import Split
@@ -86,11 +90,33 @@ class BaseAlmondTask(BaseTask):
     def _is_program_field(self, field_name):
         raise NotImplementedError()
 
-    def _make_example(self, parts, dir_name, **kwargs):
+    def _parse_example(self, parts, dir_name, **kwargs):
+        """
+        Returns the example_id, context, question and answer of the example in the tab-separated `parts` of a line
+        """
         raise NotImplementedError()
 
+    def _make_example(self, parts, dir_name=None, **kwargs):
+        example_id, context, question, answer = self._parse_example(parts, dir_name, **kwargs)
+        return Example.from_raw(example_id, context, question, answer, preprocess=self.preprocess_field, lower=False)
+
+    def _make_examples(self, batch, dir_name=None, **kwargs):
+        """
+        Batched version of `_make_example()`. All lines are parsed first, then each field is preprocessed for the whole batch
+        """
+        example_ids, contexts, questions, answers = [], [], [], []
+        for parts in batch:
+            example_id, context, question, answer = self._parse_example(parts, dir_name, **kwargs)
+            example_ids.append(example_id)
+            contexts.append(context)
+            questions.append(question)
+            answers.append(answer)
+        return Example.from_raw_batch(
+            example_ids, contexts, questions, answers, preprocess=self.batch_preprocess_field, lower=False
+        )
+
     def get_splits(self, root, **kwargs):
-        return AlmondDataset.return_splits(path=os.path.join(root, 'almond'), make_example=self._make_example, **kwargs)
+        return AlmondDataset.return_splits(path=os.path.join(root, 'almond'), make_examples=self._make_examples, **kwargs)
 
     def batch_postprocess_prediction_ids(self, batch_example_ids, batch_src_ids, batch_tgt_ids, **kwargs):
         return batch_tgt_ids
@@ -114,72 +140,96 @@ class BaseAlmondTask(BaseTask):
         return new_prediction
 
     def preprocess_field(self, sentence, field_name=None, answer=None, example_id=None, preprocess_entities=True):
+        return self.batch_preprocess_field([sentence], field_name, [answer], [example_id], preprocess_entities)[0]
+
+    def batch_preprocess_field(self, sentences, field_name=None, answers=None, example_ids=None, preprocess_entities=True):
         if self.override_context is not None and field_name == 'context':
-            return self.override_context
+            return [self.override_context] * len(sentences)
         if self.override_question is not None and field_name == 'question':
-            return self.override_question
-        if not sentence:
-            return ''
+            return [self.override_question] * len(sentences)
 
-        tokens = sentence.split(' ')
         is_program = self._is_program_field(field_name)
-        new_tokens = []
-        for token in tokens:
-            if (is_entity(token) and preprocess_entities) or (is_program and (is_device(token) or is_entity_marker(token))):
-                if token.startswith('QUOTED_STRING_'):
-                    token = token[len('QUOTED_') :]
-                elif token.startswith('GENERIC_ENTITY_'):
-                    token = token[len('GENERIC_') :]
-
-                self.special_tokens.add(token)
-            new_tokens.append(token)
-        tokens = new_tokens
-        new_sentence = ' '.join(tokens)
+        if preprocess_entities and is_program:
+            special_token_regex = ENTITY_OR_PROGRAM_TOKEN_REGEX
+        elif preprocess_entities:
+            special_token_regex = ENTITY_TOKEN_REGEX
+        elif is_program:
+            special_token_regex = PROGRAM_TOKEN_REGEX
+        else:
+            special_token_regex = None
+
+        # special tokens of the whole batch are collected here and added to the task at the end
+        special_tokens = set()
+
+        def replace_special_token(match):
+            token = match.group(0)
+            if token.startswith('QUOTED_STRING_'):
+                token = token[len('QUOTED_') :]
+            elif token.startswith('GENERIC_ENTITY_'):
+                token = token[len('GENERIC_') :]
+            special_tokens.add(token)
+            return token
+
+        new_sentences = []
+        for sentence in sentences:
+            if not sentence:
+                new_sentences.append('')
+                continue
+
+            if special_token_regex is not None:
+                new_sentence = special_token_regex.sub(replace_special_token, sentence)
+            else:
+                new_sentence = sentence
 
-        if self._almond_detokenize_sentence:
+            if self._almond_detokenize_sentence:
+
+                # BERT tokenizers by default add whitespace around any CJK character
+                # SPM-based tokenizers are trained on raw text and do better when receive untokenized text
+                # In genienlp we detokenize CJK characters and leave tokenization to the model's tokenizer
+                # NOTE: input datasets for almond are usually pretokenized using genie-toolkit which
+                # inserts whitespace around any CJK character. This detokenization ensures that SPM-based tokenizers
+                # see the text without space between those characters
+                new_sentence = detokenize_cjk_chars(new_sentence)
 
-            # BERT tokenizers by default add whitespace around any CJK character
-            # SPM-based tokenizers are trained on raw text and do better when receive untokenized text
-            # In genienlp we detokenize CJK characters and leave tokenization to the model's tokenizer
-            # NOTE: input datasets for almond are usually pretokenized using genie-toolkit which
-            # inserts whitespace around any CJK character. This detokenization ensures that SPM-based tokenizers
-            # see the text without space between those characters
-            new_sentence = detokenize_cjk_chars(new_sentence)
-            tokens = new_sentence.split(' ')
-
-            new_sentence = ''
-            in_string = False
-            for token in tokens:
                 if is_program:
+                    tokens = new_sentence.split(' ')
+                    new_sentence = ''
+                    in_string = False
+                    for token in tokens:
+                        if token == '"':
+                            in_string = not in_string
+                        if not in_string:
+                            new_sentence += ' ' + token
+                            continue
+                        if token in (',', '.', '?', '!', ':', ')', ']', '}') or token.startswith("'"):
+                            new_sentence += token
+                        else:
+                            new_sentence += ' ' + token
+                else:
+                    new_sentence = PUNCTUATION_SPACE_REGEX.sub('', new_sentence)
+            elif is_program and field_name != 'answer':
+                tokens = new_sentence.split(' ')
+                new_tokens = []
+                in_string = False
+                for token in tokens:
                     if token == '"':
                         in_string = not in_string
-                    if not in_string:
-                        new_sentence += ' ' + token
+                    if in_string:
+                        new_tokens.append(token)
                         continue
-                if token in (',', '.', '?', '!', ':', ')', ']', '}') or token.startswith("'"):
-                    new_sentence += token
-                else:
-                    new_sentence += ' ' + token
-        elif is_program and field_name != 'answer':
-            new_tokens = []
-            in_string = False
-            for token in tokens:
-                if token == '"':
-                    in_string = not in_string
-                if in_string:
-                    new_tokens.append(token)
-                    continue
-
-                if not is_entity(token) and not is_entity_marker(token) and not is_device(token):
-                    for word in token.split('_'):
-                        new_tokens.append(word)
-                else:
-                    new_tokens.append(token)
-            new_sentence = ' '.join(new_tokens)
 
-        new_sentence = new_sentence.strip()
+                    if not is_entity(token) and not is_entity_marker(token) and not is_device(token):
+                        for word in token.split('_'):
+                            new_tokens.append(word)
+                    else:
+                        new_tokens.append(token)
+                new_sentence = ' '.join(new_tokens)
+
+            new_sentences.append(new_sentence.strip())
 
-        return new_sentence
+        self.special_tokens.update(special_tokens)
+
+        return new_sentences
 
 
 @register_task('almond')
@@ -194,7 +244,7 @@ class Almond(BaseAlmondTask):
     def utterance_field(self):
         return 'context'
 
-    def _make_example(self, parts, dir_name=None, **kwargs):
+    def _parse_example(self, parts, dir_name=None, **kwargs):
         # the question is irrelevant, so the question says English and ThingTalk even if we're doing
         # a different language (like Chinese)
         if self._almond_has_multiple_programs:
@@ -204,9 +254,7 @@ class Almond(BaseAlmondTask):
         question = 'translate from english to thingtalk'
         context = sentence
         answer = target_code
-        return Example.from_raw(
-            self.name + '/' + example_id, context, question, answer, preprocess=self.preprocess_field, lower=False
-        )
+        return self.name + '/' + example_id, context, question, answer
 
 
 @register_task('almond_natural_seq2seq')
@@ -228,7 +276,7 @@ class NaturalSeq2Seq(BaseAlmondTask):
     def utterance_field(self):
         return 'context'
 
-    def _make_example(self, parts, dir_name=None, **kwargs):
+    def _parse_example(self, parts, dir_name=None, **kwargs):
         # the question is irrelevant
         if len(parts) == 2:
             input_sequence, target_sequence = parts
@@ -240,15 +288,13 @@ class NaturalSeq2Seq(BaseAlmondTask):
         question = 'translate from input to output'
         context = input_sequence
         answer = target_sequence
-        return Example.from_raw(
-            self.name + '/' + example_id, context, question, answer, preprocess=self.preprocess_field, lower=False
-        )
+        return self.name + '/' + example_id, context, question, answer
 
-    def preprocess_field(self, sentence, field_name=None, answer=None, example_id=None, preprocess_entities=False):
-        return super().preprocess_field(sentence, field_name, answer, example_id, preprocess_entities=False)
+    def batch_preprocess_field(self, sentences, field_name=None, answers=None, example_ids=None, preprocess_entities=False):
+        return super().batch_preprocess_field(sentences, field_name, answers, example_ids, preprocess_entities=False)
 
     def get_splits(self, root, **kwargs):
-        return AlmondDataset.return_splits(path=os.path.join(root, 'almond'), make_example=self._make_example, **kwargs)
+        return AlmondDataset.return_splits(path=os.path.join(root, 'almond'), make_examples=self._make_examples, **kwargs)
 
 
 @register_task('almond_paraphrase')
@@ -265,7 +311,7 @@ class Paraphrase(NaturalSeq2Seq):
     def postprocess_prediction(self, example_id, prediction):
         return output_heuristics(prediction, self.reverse_maps[example_id])
 
-    def _make_example(self, parts, dir_name=None, **kwargs):
+    def _parse_example(self, parts, dir_name=None, **kwargs):
         if len(parts) == 3:
             example_id, sentence, thingtalk = parts
         elif len(parts) == 4:
@@ -285,7 +331,7 @@ class Paraphrase(NaturalSeq2Seq):
         context = sentence
         answer = sentence  # means we calculate self-bleu
 
-        return Example.from_raw(example_id, context, question, answer, preprocess=self.preprocess_field, lower=False)
+        return example_id, context, question, answer
 
 
 def inside_spans(start, spans):
@@ -334,102 +380,112 @@ class Translate(NaturalSeq2Seq):
         self.all_ids = set()
         self._metrics = ['casedbleu']
 
-    def preprocess_field(self, sentence, field_name=None, answer=None, example_id=None, preprocess_entities=True):
-        assert example_id
+    @property
+    def cross_attention_layers(self):
+        # the last layer is used for alignment and heatmaps
+        if self.args.do_alignment or self.args.plot_heatmaps:
+            return [-1]
+        return []
+
+    def batch_preprocess_field(self, sentences, field_name=None, answers=None, example_ids=None, preprocess_entities=True):
+        assert example_ids and all(example_ids)
         if field_name != 'answer':
-            if field_name + '-' + example_id in self.all_ids:
-                logger.warning(
-                    f'example id: {example_id} is repeated in the dataset. If using alignment, ids between all data splits have to be unique'
-                )
-                example_id += '+'
-
-            self.all_ids.add(field_name + '-' + example_id)
+            new_sentences = []
+            for sentence, example_id in zip(sentences, example_ids):
+                if field_name + '-' + example_id in self.all_ids:
+                    logger.warning(
+                        f'example id: {example_id} is repeated in the dataset. If using alignment, ids between all data splits have to be unique'
+                    )
+                    example_id += '+'
 
-            src_quotation_symbol = '"'
-            src_tokens = sentence.split(" ")
-            src_spans_ind = [index for index, token in enumerate(src_tokens) if token == src_quotation_symbol]
+                self.all_ids.add(field_name + '-' + example_id)
 
-            if len(src_spans_ind) % 2 != 0:
-                raise ValueError(f'Corrupted span in sentence: [{sentence}]')
+                src_quotation_symbol = '"'
+                src_tokens = sentence.split(" ")
+                src_spans_ind = [index for index, token in enumerate(src_tokens) if token == src_quotation_symbol]
 
-            if self.args.align_preserve_input_quotation:
-                src_spans = [(src_spans_ind[i] + 1, src_spans_ind[i + 1] - 1) for i in range(0, len(src_spans_ind), 2)]
-            else:
-                src_tokens = [token for token in src_tokens if token != src_quotation_symbol]
-                src_spans = [
-                    (src_spans_ind[i] + 1 - (i + 1), src_spans_ind[i + 1] - 1 - (i + 1))
-                    for i in range(0, len(src_spans_ind), 2)
-                ]
+                if len(src_spans_ind) % 2 != 0:
+                    raise ValueError(f'Corrupted span in sentence: [{sentence}]')
 
-            # remove illegal src_spans (caused by inputs such as " ")
-            src_spans = [span for span in src_spans if span[0] <= span[1]]
+                if self.args.align_preserve_input_quotation:
+                    src_spans = [(src_spans_ind[i] + 1, src_spans_ind[i + 1] - 1) for i in range(0, len(src_spans_ind), 2)]
+                else:
+                    src_tokens = [token for token in src_tokens if token != src_quotation_symbol]
+                    src_spans = [
+                        (src_spans_ind[i] + 1 - (i + 1), src_spans_ind[i + 1] - 1 - (i + 1))
+                        for i in range(0, len(src_spans_ind), 2)
+                    ]
 
-            sentence = " ".join(src_tokens)
-            src_spans_flatten = [val for tup in src_spans for val in tup]
+                # remove illegal src_spans (caused by inputs such as " ")
+                src_spans = [span for span in src_spans if span[0] <= span[1]]
 
-            # append question spans to context spans
-            if example_id in self.input_spans:
-                self.input_spans[example_id] += src_spans_flatten
-            else:
-                self.input_spans[example_id] = src_spans_flatten
+                new_sentences.append(" ".join(src_tokens))
+                src_spans_flatten = [val for tup in src_spans for val in tup]
 
-        sentence = super().preprocess_field(sentence, field_name, answer, preprocess_entities)
+                # append question spans to context spans
+                if example_id in self.input_spans:
+                    self.input_spans[example_id] += src_spans_flatten
+                else:
+                    self.input_spans[example_id] = src_spans_flatten
+            sentences = new_sentences
 
-        return sentence
+        return super().batch_preprocess_field(sentences, field_name, answers, example_ids, preprocess_entities)
 
     def batch_postprocess_prediction_ids(self, batch_example_ids, batch_src_ids, batch_tgt_ids, **kwargs):
 
         numericalizer = kwargs.pop('numericalizer')
-        cross_attentions = kwargs.pop('cross_attentions')
+        # only provided if requested by `cross_attention_layers`, and if the model supports it
+        cross_attentions = kwargs.pop('cross_attentions', None)
         num_outputs = len(batch_tgt_ids) // len(batch_src_ids)
 
         # TODO _tokenizer should not be private
         tokenizer = numericalizer._tokenizer
 
-        all_src_tokens = numericalizer.convert_ids_to_tokens(batch_src_ids, skip_special_tokens=False)
-        all_tgt_tokens = numericalizer.convert_ids_to_tokens(batch_tgt_ids, skip_special_tokens=False)
-
-        # remove input_prefix from the beginning of src_tokens and shift layer_attention
+        # remove input_prefix from the beginning of source and shift layer_attention
         len_prefix_wp = len(tokenizer.tokenize(numericalizer.input_prefix))
-        all_src_tokens = [tokens[len_prefix_wp:] for tokens in all_src_tokens]
-        cross_attentions = cross_attentions[:, :, :, len_prefix_wp:]
-
-        cross_attention_pooled = compute_attention(cross_attentions, att_pooling=self.args.att_pooling, dim=1)
-
-        all_text_outputs = []
-        # post-process predictions ids
-        for i, (tgt_tokens, cross_att) in enumerate(zip(all_tgt_tokens, cross_attention_pooled)):
+        batch_src_ids = batch_src_ids[:, len_prefix_wp:]
 
-            src_tokens = all_src_tokens[i // num_outputs]
-            example_id = batch_example_ids[i // num_outputs]
+        all_src_tokens = numericalizer.convert_ids_to_tokens(batch_src_ids, skip_special_tokens=False)
+        all_tgt_tokens = numericalizer.convert_ids_to_tokens(batch_tgt_ids, skip_special_tokens=False)
 
-            # shift target tokens left to match the attention positions (since eos_token is prepended not generated)
-            if tgt_tokens[0] in tokenizer.all_special_tokens:
-                tgt_tokens = tgt_tokens[1:]
+        # remove all beginning and trailing special tokens from source and target
+        src_starts, src_ends = special_token_bounds(batch_src_ids, tokenizer.all_special_ids)
+        tgt_starts, tgt_ends = special_token_bounds(batch_tgt_ids, tokenizer.all_special_ids)
+        # the first target token is prepended, not generated, so attention starts at the second one
+        att_tgt_starts = (tgt_starts - 1).clamp(min=0)
 
-            # remove all beginning special tokens from target and shift attention too
-            while tgt_tokens[0] in tokenizer.all_special_tokens:
-                tgt_tokens = tgt_tokens[1:]
-                cross_att = cross_att[1:, :]
+        cross_attention_pooled = None
+        if cross_attentions is not None:
+            cross_attentions = cross_attentions[:, :, :, len_prefix_wp:]
+            cross_attention_pooled = compute_attention(cross_attentions, att_pooling=self.args.att_pooling, dim=1)
 
-            # remove all beginning special tokens from source and shift attention too
-            while src_tokens[0] in tokenizer.all_special_tokens:
-                src_tokens = src_tokens[1:]
-                cross_att = cross_att[:, 1:]
+            # align each source token to the kept target token it attends to most, for the whole batch at once
+            tgt_positions = torch.arange(cross_attention_pooled.size(1), device=cross_attention_pooled.device)
+            att_tgt_ends = att_tgt_starts + (tgt_ends - tgt_starts)
+            is_kept = (tgt_positions >= att_tgt_starts.unsqueeze(1)) & (tgt_positions < att_tgt_ends.unsqueeze(1))
+            alignments = cross_attention_pooled.masked_fill(~is_kept.unsqueeze(2), -float('inf')).argmax(dim=1)
+            alignments = (alignments - att_tgt_starts.unsqueeze(1)).tolist()
 
-            # remove all trailing special tokens from source
-            while src_tokens[-1] in tokenizer.all_special_tokens:
-                src_tokens = src_tokens[:-1]
+        src_starts, src_ends = src_starts.tolist(), src_ends.tolist()
+        tgt_starts, tgt_ends, att_tgt_starts = tgt_starts.tolist(), tgt_ends.tolist(), att_tgt_starts.tolist()
 
-            # remove all trailing special tokens from target
-            while tgt_tokens[-1] in tokenizer.all_special_tokens:
-                tgt_tokens = tgt_tokens[:-1]
+        all_text_outputs = []
+        # post-process predictions ids
+        for i, tgt_tokens in enumerate(all_tgt_tokens):
+            src_index = i // num_outputs
+            src_start, src_end = src_starts[src_index], src_ends[src_index]
+            src_tokens = all_src_tokens[src_index][src_start:src_end]
+            tgt_tokens = tgt_tokens[tgt_starts[i] : tgt_ends[i]]
+            example_id = batch_example_ids[src_index]
 
             # crop to match src and tgt new lengths
-            cross_att = cross_att[: len(tgt_tokens), : len(src_tokens)]
+            cross_att = None
+            if cross_attention_pooled is not None:
+                att_tgt_start = att_tgt_starts[i]
+                cross_att = cross_attention_pooled[i][att_tgt_start : att_tgt_start + len(tgt_tokens), src_start:src_end]
 
             # plot cross-attention heatmap
-            if self.args.plot_heatmaps:
+            if self.args.plot_heatmaps and cross_att is not None:
                 import matplotlib.pyplot as plt
                 import seaborn as sns
 
@@ -445,22 +501,27 @@ class Translate(NaturalSeq2Seq):
                 )
                 plt.show()
 
-            if self.args.do_alignment:
+            if self.args.do_alignment and cross_att is not None:
                 src_spans = self.input_spans[example_id]
                 text = align_and_replace(
-                    src_tokens, tgt_tokens, tokenizer, cross_att, src_spans, self.args.align_remove_output_quotation
+                    src_tokens,
+                    tgt_tokens,
+                    tokenizer,
+                    cross_att,
+                    src_spans,
+                    self.args.align_remove_output_quotation,
+                    alignment=alignments[i][src_start:src_end],
                 )
             else:
                 text = tokenizer.convert_tokens_to_string(tgt_tokens)
 
             all_text_outputs.append(text)
 
-            with tokenizer.as_target_tokenizer():
-                partial_batch_prediction_ids = tokenizer.batch_encode_plus(
-                    all_text_outputs, padding=True, return_tensors='pt'
-                )['input_ids']
+        # re-encode the whole batch at once
+        with tokenizer.as_target_tokenizer():
+            encoded = tokenizer.batch_encode_plus(all_text_outputs, padding=True, return_tensors='pt')
 
-        return partial_batch_prediction_ids
+        return encoded['input_ids']
 
     def _make_example(self, parts, dir_name=None, **kwargs):
         # answer has to be provided by default unless doing prediction
@@ -525,6 +586,17 @@ class Translate(NaturalSeq2Seq):
 
         return examples
 
+    def _make_examples(self, batch, dir_name=None, **kwargs):
+        # a line can be split into several examples, so examples are made one line at a time
+        examples = []
+        for parts in batch:
+            line_examples = self._make_example(parts, dir_name, **kwargs)
+            if isinstance(line_examples, list):
+                examples.extend(line_examples)
+            else:
+                examples.append(line_examples)
+        return examples
+
 
 @register_task('contextual_almond')
 class ContextualAlmond(BaseAlmondTask):
@@ -537,16 +609,14 @@ class ContextualAlmond(BaseAlmondTask):
     def utterance_field(self):
         return 'question'
 
-    def _make_example(self, parts, dir_name=None, **kwargs):
+    def _parse_example(self, parts, dir_name=None, **kwargs):
         if self._almond_has_multiple_programs:
             example_id, context, sentence, target_code = parts[:4]
         else:
             example_id, context, sentence, target_code = parts
         answer = target_code
         question = sentence
-        return Example.from_raw(
-            self.name + '/' + example_id, context, question, answer, preprocess=self.preprocess_field, lower=False
-        )
+        return self.name + '/' + example_id, context, question, answer
 
 
 @register_task('reverse_almond')
@@ -565,31 +635,34 @@ class ReverseAlmond(BaseAlmondTask):
     def _is_program_field(self, field_name):
         return field_name == 'context'
 
-    def _make_example(self, parts, dir_name=None, **kwargs):
+    def _parse_example(self, parts, dir_name=None, **kwargs):
         # the question is irrelevant, so the question says English and ThingTalk even if we're doing
         # a different language (like Chinese)
         example_id, sentence, target_code = parts
         question = 'translate from thingtalk to english'
         context = target_code
         answer = sentence
-        return Example.from_raw(
-            self.name + '/' + example_id, context, question, answer, preprocess=self.preprocess_field, lower=False
-        )
+        return self.name + '/' + example_id, context, question, answer
 
 
 # TODO add a similar preprocessing step to Multilingual dialogue tasks as well
 class BaseAlmondDialogueNLUTask(BaseAlmondTask):
-    def preprocess_field(self, sentence, field_name=None, answer=None, example_id=None, preprocess_entities=True):
-        if not sentence:
-            return sentence
-
+    def batch_preprocess_field(self, sentences, field_name=None, answers=None, example_ids=None, preprocess_entities=True):
         # remove the $dialogue at the start of the dialogue
         # this is safe because we know we're processing dialogues, so the answer
         # always starts with $dialogue and the context is either `null` or also
         # starts with $dialogue
-        if field_name in ['context', 'answer'] and sentence.startswith('$dialogue '):
-            sentence = sentence[len('$dialogue ') :]
-        return super().preprocess_field(sentence, field_name, answer, example_id, preprocess_entities)
+        stripped_sentences = sentences
+        if field_name in ['context', 'answer']:
+            stripped_sentences = [
+                sentence[len('$dialogue ') :] if sentence and sentence.startswith('$dialogue ') else sentence
+                for sentence in sentences
+            ]
+        new_sentences = super().batch_preprocess_field(
+            stripped_sentences, field_name, answers, example_ids, preprocess_entities
+        )
+        # empty sentences are returned as is
+        return [new_sentence if sentence else sentence for sentence, new_sentence in zip(sentences, new_sentences)]
 
     def postprocess_prediction(self, example_id, prediction):
         prediction = super().postprocess_prediction(example_id, prediction)
@@ -612,7 +685,7 @@ class AlmondDialogueNLU(BaseAlmondDialogueNLUTask):
     def utterance_field(self):
         return 'question'
 
-    def _make_example(self, parts, dir_name=None, **kwargs):
+    def _parse_example(self, parts, dir_name=None, **kwargs):
         if self._almond_has_multiple_programs:
             example_id, context, sentence, target_code = parts[:4]
         else:
@@ -620,12 +693,10 @@ class AlmondDialogueNLU(BaseAlmondDialogueNLUTask):
 
         answer = target_code
         question = sentence
-        return Example.from_raw(
-            self.name + '/' + example_id, context, question, answer, preprocess=self.preprocess_field, lower=False
-        )
+        return self.name + '/' + example_id, context, question, answer
 
     def get_splits(self, root, **kwargs):
-        return AlmondDataset.return_splits(path=os.path.join(root, 'almond/user'), make_example=self._make_example, **kwargs)
+        return AlmondDataset.return_splits(path=os.path.join(root, 'almond/user'), make_examples=self._make_examples, **kwargs)
 
 
 @register_task('almond_dialogue_nlu_agent')
@@ -643,19 +714,19 @@ class AlmondDialogueNLUAgent(BaseAlmondDialogueNLUTask):
     def utterance_field(self):
         return 'question'
 
-    def _make_example(self, parts, dir_name=None, **kwargs):
+    def _parse_example(self, parts, dir_name=None, **kwargs):
         if self._almond_has_multiple_programs:
             example_id, context, sentence, target_code = parts[:4]
         else:
             example_id, context, sentence, target_code = parts
         answer = target_code
         question = sentence
-        return Example.from_raw(
-            self.name + '/' + example_id, context, question, answer, preprocess=self.preprocess_field, lower=False
-        )
+        return self.name + '/' + example_id, context, question, answer
 
     def get_splits(self, root, **kwargs):
-        return AlmondDataset.return_splits(path=os.path.join(root, 'almond/agent'), make_example=self._make_example, **kwargs)
+        return AlmondDataset.return_splits(
+            path=os.path.join(root, 'almond/agent'), make_examples=self._make_examples, **kwargs
+        )
 
 
 @register_task('almond_dialogue_nlg')
@@ -676,17 +747,15 @@ class AlmondDialogueNLG(BaseAlmondTask):
     def utterance_field(self):
         return 'answer'
 
-    def _make_example(self, parts, dir_name=None, **kwargs):
+    def _parse_example(self, parts, dir_name=None, **kwargs):
         # the question is irrelevant for this task
         example_id, context, sentence, target_code = parts
         question = target_code
         answer = sentence
-        return Example.from_raw(
-            self.name + '/' + example_id, context, question, answer, preprocess=self.preprocess_field, lower=False
-        )
+        return self.name + '/' + example_id, context, question, answer
 
     def get_splits(self, root, **kwargs):
-        return AlmondDataset.return_splits(path=os.path.join(root, 'almond/nlg'), make_example=self._make_example, **kwargs)
+        return AlmondDataset.return_splits(path=os.path.join(root, 'almond/nlg'), make_examples=self._make_examples, **kwargs)
 
 
 @register_task('almond_dialogue_policy')
@@ -706,17 +775,17 @@ class AlmondDialoguePolicy(BaseAlmondTask):
     def utterance_field(self):
         return 'question'
 
-    def _make_example(self, parts, dir_name=None, **kwargs):
+    def _parse_example(self, parts, dir_name=None, **kwargs):
         # the question is irrelevant for this task, and the sentence is intentionally ignored
         example_id, context, _sentence, target_code = parts
         question = 'what should the agent do ?'
         answer = target_code
-        return Example.from_raw(
-            self.name + '/' + example_id, context, question, answer, preprocess=self.preprocess_field, lower=False
-        )
+        return self.name + '/' + example_id, context, question, answer
 
     def get_splits(self, root, **kwargs):
-        return AlmondDataset.return_splits(path=os.path.join(root, 'almond/agent'), make_example=self._make_example, **kwargs)
+        return AlmondDataset.return_splits(
+            path=os.path.join(root, 'almond/agent'), make_examples=self._make_examples, **kwargs
+        )
 
 
 class BaseAlmondMultiLingualTask(BaseAlmondTask):
@@ -753,7 +822,7 @@ class BaseAlmondMultiLingualTask(BaseAlmondTask):
 
         for dir in all_dirs:
             splits, paths = AlmondDataset.return_splits(
-                path=os.path.join(root, 'almond/{}'.format(dir)), make_example=self._make_example, **kwargs
+                path=os.path.join(root, 'almond/{}'.format(dir)), make_examples=self._make_examples, **kwargs
             )
             all_datasets.append(splits)
             all_paths.append(paths)
@@ -803,7 +872,7 @@ class AlmondMultiLingual(BaseAlmondMultiLingualTask):
     def utterance_field(self):
         return 'context'
 
-    def _make_example(self, parts, dir_name, **kwargs):
+    def _parse_example(self, parts, dir_name, **kwargs):
         if self._almond_has_multiple_programs:
             example_id, sentence, target_code = parts[:3]
         else:
@@ -815,14 +884,7 @@ class AlmondMultiLingual(BaseAlmondMultiLingualTask):
             question = 'translate from english to thingtalk'
         context = sentence
         answer = target_code
-        return Example.from_raw(
-            self.name + '/' + dir_name + '/' + example_id,
-            context,
-            question,
-            answer,
-            preprocess=self.preprocess_field,
-            lower=False,
-        )
+        return self.name + '/' + dir_name + '/' + example_id, context, question, answer
 
 
 @register_task('almond_dialogue_multilingual_nlu')
@@ -840,21 +902,14 @@ class AlmondDialogMultiLingualNLU(BaseAlmondMultiLingualTask):
     def utterance_field(self):
         return 'question'
 
-    def _make_example(self, parts, dir_name=None, **kwargs):
+    def _parse_example(self, parts, dir_name=None, **kwargs):
         if self._almond_has_multiple_programs:
             example_id, context, sentence, target_code = parts
         else:
             example_id, context, sentence, target_code = parts[:4]
         answer = target_code
         question = sentence
-        return Example.from_raw(
-            self.name + '/' + dir_name + '/' + example_id,
-            context,
-            question,
-            answer,
-            preprocess=self.preprocess_field,
-            lower=False,
-        )
+        return self.name + '/' + dir_name + '/' + example_id, context, question, answer
 
 
 @register_task('almond_dialogue_multilingual_nlg')
@@ -872,17 +927,10 @@ class AlmondDialogMultiLingualNLG(BaseAlmondTask):
     def utterance_field(self):
         return 'question'
 
-    def _make_example(self, parts, dir_name=None, **kwargs):
+    def _parse_example(self, parts, dir_name=None, **kwargs):
         # the question is irrelevant for this task
         example_id, context, sentence, target_code = parts
         question = 'what should the agent say ?'
         context = context + ' ' + target_code
         answer = sentence
-        return Example.from_raw(
-            self.name + '/' + dir_name + '/' + example_id,
-            context,
-            question,
-            answer,
-            preprocess=self.preprocess_field,
-            lower=False,
-        )
+        return self.name + '/' + dir_name + '/' + example_id, context, question, answer
@@ -70,6 +70,13 @@ class BaseTask(object):
         """
         return generic_dataset.JSON.splits(root=root, name=self.name, **kwargs)
 
+    @property
+    def cross_attention_layers(self):
+        """
+        Indices of the decoder layers whose cross-attention `batch_postprocess_prediction_ids` needs, averaged over layers
+        """
+        return []
+
     def batch_postprocess_prediction_ids(self, batch_example_ids, batch_src_ids, batch_tgt_ids, **kwargs):
         return batch_tgt_ids
 
@@ -83,6 +90,19 @@ class BaseTask(object):
             return self.override_question
         return sentence
 
+    def batch_preprocess_field(self, sentences, field_name=None, answers=None, example_ids=None):
+        """
+        Batched version of `preprocess_field()`
+        """
+        if answers is None:
+            answers = [None] * len(sentences)
+        if example_ids is None:
+            example_ids = [None] * len(sentences)
+        return [
+            self.preprocess_field(sentence, field_name, answer, example_id)
+            for sentence, answer, example_id in zip(sentences, answers, example_ids)
+        ]
+
     @property
     def metrics(self):
         """
@@ -29,17 +29,20 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 
+import contextlib
 import logging
 import logging.handlers
 import math
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 from functools import partial
 from pprint import pformat
 
 import numpy as np
 import torch
+from torch.distributed.optim import ZeroRedundancyOptimizer
 from torch.utils.tensorboard import SummaryWriter
 from transformers import (
     AdamW,
@@ -51,31 +54,52 @@ from transformers import (
 from . import arguments, models
 from .arguments import save_args
 from .model_utils.parallel_utils import NamedTupleCompatibleDataParallel
-from .model_utils.saver import Saver
+from .model_utils.saver import Saver, snapshot_to_cpu
 from .ned.ned_utils import init_ned_model
 from .util import (
+    PhaseTimer,
+    all_reduce_mean,
+    autocast,
+    clip_grad_norm,
     elapsed_time,
     get_devices,
+    get_peak_memory,
+    get_rank,
+    get_rng_state,
     get_trainable_params,
+    get_world_size,
+    init_distributed,
+    is_main_process,
+    is_oom_error,
     log_model_size,
     make_data_loader,
     ned_dump_entity_type_pairs,
+    reset_peak_memory,
+    scale_gradients,
+    set_rng_state,
     set_seed,
+    subsample_dataset,
 )
-from .validate import print_results, validate
+from .validate import generate_with_model, print_results, validate
+
+logger = logging.getLogger(__name__)
 
 
 def initialize_logger(args):
     # set up file logger
     logger = logging.getLogger(__name__)
-    logger.setLevel(logging.DEBUG)
-    handler = logging.handlers.RotatingFileHandler(
-        os.path.join(args.log_dir, 'train.log'), maxBytes=1024 * 1024 * 10, backupCount=1
-    )
-    handler.setLevel(logging.DEBUG)
     formatter = logging.Formatter('%(name)s - %(message)s')
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
+    if is_main_process():
+        logger.setLevel(logging.DEBUG)
+        handler = logging.handlers.RotatingFileHandler(
+            os.path.join(args.log_dir, 'train.log'), maxBytes=1024 * 1024 * 10, backupCount=1
+        )
+        handler.setLevel(logging.DEBUG)
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
+    else:
+        # in distributed training, other processes only report problems
+        logger.setLevel(logging.WARNING)
     handler = logging.StreamHandler()
     handler.setFormatter(formatter)
     handler.setLevel(logging.DEBUG)
@@ -171,40 +195,243 @@ def prepare_data(args, logger):
 
 
 accumulated_batch_lengths = 0
+# set when running out of memory discarded the gradients accumulated by earlier iterations of the current update
+discard_accumulated_update = False
 
+# number of consecutive iterations with a loss close to zero after which training stops
+ZERO_LOSS_PATIENCE = 100
 
-def train_step(model, batch, iteration, opt, devices, lr_scheduler=None, grad_clip=None, gradient_accumulation_steps=1):
+
+def train_step(
+    model,
+    batch,
+    iteration,
+    opt,
+    scaler,
+    devices,
+    lr_scheduler=None,
+    grad_clip=None,
+    gradient_accumulation_steps=1,
+    mixed_precision=False,
+    timer=None,
+):
     # Since the batch size is different in each call to this function due to dynamic batching, we need to keep track of
     # the total batch size
-    global accumulated_batch_lengths
+    global accumulated_batch_lengths, discard_accumulated_update
+    if timer is None:
+        timer = PhaseTimer(devices[0])
     model.train()
     if (iteration) % gradient_accumulation_steps == 0:
         opt.zero_grad()
-    loss = model(batch).loss
-    if torch.isnan(loss).any():
-        raise RuntimeError('Got NaN loss %s', str(loss))
-    if len(devices) > 1:
-        loss = loss.mean()
-    non_accumulated_loss = loss.item()
-    loss = loss * len(batch[0])
-    accumulated_batch_lengths += len(batch[0])
+    should_update = (iteration + 1) % gradient_accumulation_steps == 0
+    if isinstance(model, torch.nn.parallel.DistributedDataParallel) and not should_update:
+        # gradients are synchronized across processes only once they are fully accumulated
+        sync_context = model.no_sync()
+    else:
+        sync_context = contextlib.nullcontext()
+
+    with sync_context:
+        previous_batch_lengths = accumulated_batch_lengths
+        num_micro_batches = 1
+        while True:
+            try:
+                micro_batches = batch.split(num_micro_batches) if num_micro_batches > 1 else [batch]
+                loss = sum(
+                    forward_backward(model, micro_batch, scaler, devices, mixed_precision, timer)
+                    for micro_batch in micro_batches
+                )
+                loss = loss / len(batch[0])
+                break
+            except RuntimeError as e:
+                # in distributed training, other processes would wait forever for the gradients of this one
+                if not is_oom_error(e) or get_world_size() > 1 or num_micro_batches >= len(batch[0]):
+                    raise
+            # ran out of memory; free the memory held by the failed attempt outside of the except clause, which keeps
+            # references to it. Gradients of the examples processed so far cannot be separated from the ones of previous
+            # iterations of this update, so if there were any, the update is skipped instead of using only part of its data
+            opt.zero_grad()
+            accumulated_batch_lengths = 0
+            if previous_batch_lengths > 0:
+                discard_accumulated_update = True
+            torch.cuda.empty_cache()
+            num_micro_batches *= 2
+            logger.warning(
+                f'Ran out of memory in iteration {iteration}; splitting the batch into {num_micro_batches} micro-batches'
+            )
+        # in distributed training, report the loss averaged over all processes so they agree e.g. on when to stop
+        # the loss is kept on the device, so that the host does not wait for this iteration to finish before starting the next
+        non_accumulated_loss = all_reduce_mean(loss)
 
-    loss.backward()
     grad_norm = None
-    if (iteration + 1) % gradient_accumulation_steps == 0:
-        for p in model.parameters():
-            if p.grad is None:
-                continue
-            p.grad /= accumulated_batch_lengths
+    if should_update and discard_accumulated_update:
+        logger.warning(
+            f'Skipping the update of iteration {iteration}, since running out of memory discarded the gradients of '
+            'previous iterations it accumulated'
+        )
+        opt.zero_grad()
         accumulated_batch_lengths = 0
-        if grad_clip > 0.0:
-            grad_norm = torch.nn.utils.clip_grad_norm_(model.params, grad_clip)
-        opt.step()
+        discard_accumulated_update = False
+        # the learning rate schedule still follows the number of iterations
         lr_scheduler.step()
+    elif should_update:
+        with timer.time('optimizer'):
+            # gradients need to be in their true scale before averaging and clipping them
+            scaler.unscale_(opt)
+            # the batch size is only known once all gradients are accumulated, so it cannot be folded into the loss
+            batch_lengths = accumulated_batch_lengths
+            if get_world_size() > 1:
+                # DistributedDataParallel averages gradients over processes, so we divide by the average batch size of a process
+                batch_lengths = all_reduce_mean(torch.tensor(float(batch_lengths), device=devices[0]))
+            accumulated_batch_lengths = 0
+            if grad_clip > 0.0:
+                # normalizing by the batch size is folded into the clipping coefficient, so gradients are only scaled once
+                grad_norm = clip_grad_norm(model.params, grad_clip, scale=1 / batch_lengths)
+            else:
+                scale_gradients(model.params, 1 / batch_lengths)
+            # skips the update if gradients overflowed, and adjusts the loss scale for the next iterations
+            scaler.step(opt)
+            scaler.update()
+            lr_scheduler.step()
 
     return non_accumulated_loss, grad_norm
 
 
+def forward_backward(model, batch, scaler, devices, mixed_precision, timer):
+    """
+    Adds the gradients of the loss of `batch`, weighted by its number of examples, to the accumulated gradients.
+    Returns the weighted loss
+    """
+    global accumulated_batch_lengths
+    with timer.time('forward'), autocast(devices[0], mixed_precision):
+        loss = model(batch).loss
+    if len(devices) > 1:
+        loss = loss.mean()
+    loss = loss * len(batch[0])
+    accumulated_batch_lengths += len(batch[0])
+
+    # unless training in float16, the scaler is disabled and this reduces to the regular backward pass and optimizer step
+    with timer.time('backward'):
+        scaler.scale(loss).backward()
+    return loss.detach()
+
+
+def find_max_batch_size(probe, batch_size, device, max_factor=64):
+    """
+    Returns the largest batch size for which `probe(batch_size)` runs without running out of memory, among the powers of two
+    times `batch_size`, up to `max_factor` times `batch_size`. `probe` returns False if the batch cannot grow any further.
+    """
+    largest, candidate = None, batch_size
+    while candidate <= max_factor * batch_size:
+        out_of_memory = False
+        try:
+            can_grow = probe(candidate)
+        except RuntimeError as e:
+            if not is_oom_error(e):
+                raise
+            out_of_memory = True
+        torch.cuda.empty_cache()
+        if out_of_memory:
+            if largest is not None:
+                break
+            # even the configured batch size is too large
+            if candidate // 2 < 1:
+                raise RuntimeError(f'Ran out of memory on {device} even with a batch size of 1')
+            candidate //= 2
+            continue
+        largest = candidate
+        if not can_grow or candidate < batch_size:
+            break
+        candidate *= 2
+    return largest
+
+
+def autotune_batch_sizes(
+    args, model, val_model, opt, train_loaders, aux_loaders, val_loaders, fast_val_loaders, device, val_device
+):
+    """
+    Pick the largest --train_batch_tokens and --val_batch_size that fit in memory, by running training steps and generation
+    on batches made of the longest examples of each dataset, and update the data loaders accordingly
+    """
+    if device.type != 'cuda':
+        logger.warning('Batch sizes can only be tuned on GPUs; using the ones provided')
+        return
+    # the optimizer state is only allocated in the first step, so reserve the memory it will use (two moments for Adam)
+    reserved = None
+    local_opt = opt.optim if isinstance(opt, ZeroRedundancyOptimizer) else opt
+    if not local_opt.state:
+        num_bytes = 2 * sum(p.numel() * p.element_size() for p in model.params)
+        if local_opt is not opt:
+            # each process only keeps the state of its share of the parameters
+            num_bytes //= get_world_size()
+        reserved = torch.empty(num_bytes, dtype=torch.uint8, device=device)
+
+    def make_batch(data_loader, batch_size):
+        sampler = data_loader.batch_sampler
+        indices = sampler.first_batch(batch_size)
+        can_grow = len(indices) < len(sampler.data_source)
+        if not indices:
+            return None, can_grow
+        return data_loader.collate_fn([sampler.data_source[i] for i in indices]), can_grow
+
+    def train_probe(data_loader, batch_size):
+        batch, can_grow = make_batch(data_loader, batch_size)
+        if batch is None:
+            return can_grow
+        model.train()
+        # gradients must not be synchronized, since other processes may be probing a different batch size
+        if isinstance(model, torch.nn.parallel.DistributedDataParallel):
+            sync_context = model.no_sync()
+        else:
+            sync_context = contextlib.nullcontext()
+        try:
+            with sync_context:
+                with autocast(device, args.mixed_precision):
+                    loss = model(batch).loss
+                loss.mean().backward()
+        finally:
+            opt.zero_grad()
+        return can_grow
+
+    def val_probe(task, data_loader, batch_size):
+        batch, can_grow = make_batch(data_loader, batch_size)
+        if batch is None:
+            return can_grow
+        with torch.no_grad():
+            val_model.eval()
+            generate_with_model(val_model, [batch], val_model.numericalizer, task, args)
+        return can_grow
+
+    tuned_sizes = []
+    for task, data_loader in train_loaders:
+        batch_size = data_loader.batch_sampler.batch_size
+        tuned_sizes.append(find_max_batch_size(partial(train_probe, data_loader), batch_size, device))
+    del reserved
+    for task, data_loader in val_loaders:
+        batch_size = data_loader.batch_sampler.batch_size
+        if val_device.type == 'cuda':
+            tuned_sizes.append(find_max_batch_size(partial(val_probe, task, data_loader), batch_size, val_device))
+        else:
+            tuned_sizes.append(batch_size)
+    torch.cuda.empty_cache()
+
+    if get_world_size() > 1:
+        # all processes use the batch sizes that fit on every one of them
+        tuned_sizes = torch.tensor(tuned_sizes, device=device)
+        torch.distributed.all_reduce(tuned_sizes, op=torch.distributed.ReduceOp.MIN)
+        tuned_sizes = tuned_sizes.tolist()
+
+    for (task, data_loader), batch_size in zip(train_loaders + val_loaders, tuned_sizes):
+        data_loader.batch_sampler.set_batch_size(batch_size)
+    # auxiliary datasets of the curriculum belong to the training tasks, and fast validation uses subsets of the validation sets
+    for (task, data_loader), batch_size in zip(aux_loaders, tuned_sizes):
+        data_loader.batch_sampler.set_batch_size(batch_size)
+    for (task, data_loader), batch_size in zip(fast_val_loaders, tuned_sizes[len(train_loaders) :]):
+        data_loader.batch_sampler.set_batch_size(batch_size)
+    args.train_batch_tokens = tuned_sizes[: len(train_loaders)]
+    args.val_batch_size = tuned_sizes[len(train_loaders) :]
+    logger.info(f'Tuned batch sizes: train_batch_tokens={args.train_batch_tokens}, val_batch_size={args.val_batch_size}')
+
+
 def update_fraction(args, task_iteration):
     if args.curriculum_strategy == 'linear':
         next_fraction = args.curriculum_rate * task_iteration
@@ -268,10 +495,78 @@ def do_validate(
     return deca_score
 
 
+class BackgroundValidator(object):
+    """
+    Validates a snapshot of the model on a separate device and on a background thread, so that training can continue
+    while validating. At most one validation runs at a time. When a validation finishes with a new best score,
+    its snapshot is saved as the best checkpoint.
+    """
+
+    def __init__(self, model, device, *, saver, best_decascore, logger):
+        self.model = deepcopy(model).to(device)
+        self.best_decascore = best_decascore
+        self._saver = saver
+        self._logger = logger
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending = None
+
+    def submit(self, iteration, validate_fn, model, save_opt_state_dict, use_for_best):
+        """
+        Start validating the current weights of `model` by calling `validate_fn` with the snapshot model and its numericalizer.
+        Waits for the previous validation to finish first
+        """
+        self.wait()
+        self.model.load_state_dict(model.state_dict())
+        # the optimizer state is needed in case this snapshot turns out to be the best one
+        save_opt_state_dict = snapshot_to_cpu(save_opt_state_dict) if use_for_best else None
+        future = self._executor.submit(validate_fn, model=self.model, numericalizer=self.model.numericalizer)
+        self._pending = (iteration, future, save_opt_state_dict)
+
+    def poll(self):
+        if self._pending is not None and self._pending[1].done():
+            self.wait()
+
+    def wait(self):
+        if self._pending is None:
+            return
+        iteration, future, save_opt_state_dict = self._pending
+        self._pending = None
+        deca_score = future.result()
+
+        if save_opt_state_dict is not None and (self.best_decascore is None or self.best_decascore < deca_score):
+            self.best_decascore = deca_score
+            self._logger.info(f'{elapsed_time(self._logger)}:iteration_{iteration}: saving new best model')
+            save_model_state_dict = {'model_state_dict': self.model.state_dict(), 'best_decascore': deca_score}
+            self._saver.save_best(save_model_state_dict, save_opt_state_dict)
+            self.model.numericalizer.save(self._saver._savedir)
+
+    def close(self):
+        self.wait()
+        self._executor.shutdown()
+
+
+def consolidate_opt_state(opt):
+    """
+    Gathers the shards of a sharded optimizer state on the main process, so that `opt.state_dict()` can be saved there.
+    Needs to be called by all processes
+    """
+    if isinstance(opt, ZeroRedundancyOptimizer):
+        opt.consolidate_state_dict(to=0)
+
+
+def get_save_opt_state_dict(iteration, opt, scaler, train_state=None):
+    save_opt_state_dict = opt.state_dict()
+    save_opt_state_dict.update({'start_iteration': iteration, 'scaler_state_dict': scaler.state_dict()})
+    if train_state is not None:
+        save_opt_state_dict['train_state'] = train_state
+    return save_opt_state_dict
+
+
 def maybe_save(
     iteration,
     model,
     opt,
+    scaler,
     deca_score,
     best_decascore,
     *,
@@ -281,8 +576,8 @@ def maybe_save(
     round_progress,
     task_progress,
     timestamp,
-    log_dir,
     model_parallel,
+    train_state=None,
 ):
     should_save_best = False
     if deca_score is not None and (best_decascore is None or best_decascore < deca_score):
@@ -297,19 +592,15 @@ def maybe_save(
         # to load this model later
         model_state_dict = model.module.state_dict()
 
-    model_state_dict = {k: v.cpu() for k, v in model_state_dict.items()}
-
     save_model_state_dict = {'model_state_dict': model_state_dict, 'best_decascore': best_decascore}
-    save_opt_state_dict = opt.state_dict()
-    save_opt_state_dict.update({'start_iteration': iteration})
+    save_opt_state_dict = get_save_opt_state_dict(iteration, opt, scaler, train_state)
 
-    saver.save(save_model_state_dict, save_opt_state_dict, global_step=iteration)
+    # the saver copies the state dicts to CPU before returning, and writes them to disk in the background
+    saver.save(save_model_state_dict, save_opt_state_dict, global_step=iteration, save_best=should_save_best)
     if should_save_best:
         logger.info(
             f'{timestamp}:{elapsed_time(logger)}:iteration_{iteration}:{round_progress}train_{train_task.name}:{task_progress} saving new best model'
         )
-        torch.save(save_model_state_dict, os.path.join(log_dir, 'best.pth'))
-        torch.save(save_opt_state_dict, os.path.join(log_dir, 'best_optim.pth'))
 
         if model_parallel:
             model.numericalizer.save(saver._savedir)
@@ -336,10 +627,20 @@ def do_log_training_loss(
     timestamp,
     writer,
     log_prefix,
+    tokens_per_second,
+    examples_per_second,
+    padding_ratio,
+    phase_times,
+    peak_memory=None,
 ):
     avg_batch_size = f'avbatch_{num_examples:.0f}_{len_contexts:.0f}_{len_answers:.0f}:'
+    throughput = f'tokps_{tokens_per_second:.0f}:exps_{examples_per_second:.1f}:pad_{padding_ratio:.2f}:'
+    # seconds spent in each phase since the last log
+    throughput += ''.join(f'{phase}_{seconds:.1f}s:' for phase, seconds in phase_times.items())
+    if peak_memory is not None:
+        throughput += f'peakmem_{peak_memory / 2 ** 20:.0f}MiB:'
     logger.info(
-        f'{timestamp}:{elapsed_time(logger)}:iteration_{iteration}:epoch_{epochs:.2f}:{round_progress}train_{train_task.name}:{task_progress}{avg_batch_size}{log_prefix}/loss_{loss:.4f}'
+        f'{timestamp}:{elapsed_time(logger)}:iteration_{iteration}:epoch_{epochs:.2f}:{round_progress}train_{train_task.name}:{task_progress}{avg_batch_size}{throughput}{log_prefix}/loss_{loss:.4f}'
     )
 
     if writer is not None:
@@ -349,6 +650,13 @@ def do_log_training_loss(
             writer.add_scalar(f'{log_prefix}/lr', np.array(lr_scheduler.get_last_lr()), iteration)
         if grad_norm is not None:
             writer.add_scalar(f'{log_prefix}/norm', grad_norm, iteration)
+        writer.add_scalar(f'{log_prefix}/tokens_per_second', tokens_per_second, iteration)
+        writer.add_scalar(f'{log_prefix}/examples_per_second', examples_per_second, iteration)
+        writer.add_scalar(f'{log_prefix}/padding_ratio', padding_ratio, iteration)
+        for phase, seconds in phase_times.items():
+            writer.add_scalar(f'{log_prefix}/time/{phase}', seconds, iteration)
+        if peak_memory is not None:
+            writer.add_scalar(f'{log_prefix}/peak_memory', peak_memory, iteration)
 
 
 def np_coin(prob):
@@ -376,6 +684,7 @@ def train(
     devices,
     model,
     opt,
+    scaler,
     lr_scheduler,
     train_sets,
     train_iterations,
@@ -394,9 +703,10 @@ def train(
     rnd=1,
     best_decascore,
     use_curriculum,
+    train_state=None,
 ):
     """main training function"""
-    local_loss, num_examples, len_contexts, len_answers, iteration = 0, 0, 0, 0, 1
+    local_loss, num_examples, len_contexts, len_answers, num_tokens, num_real_tokens, iteration = 0, 0, 0, 0, 0, 0, 1
 
     train_iter_deep = deepcopy(train_iterations)
 
@@ -418,38 +728,115 @@ def train(
 
     logger.info('Preparing iterators')
     main_device = devices[0]
+    # in distributed training, each process iterates over its own share of the batches
+    rank, world_size = get_rank(), get_world_size()
 
     t0 = time.time()
-    train_iters = [
-        (task, make_data_loader(dataset, numericalizer, tok, main_device, train=True))
+    train_loaders = [
+        (task, make_data_loader(dataset, numericalizer, tok, main_device, train=True, rank=rank, world_size=world_size))
         for task, dataset, tok in zip(args.train_tasks, train_sets, args.train_batch_tokens)
     ]
     t1 = time.time()
     logger.info('Preparing iterators took {:.2f} seconds'.format(t1 - t0))
 
-    train_iters = [(task, iter(train_iter)) for task, train_iter in train_iters]
+    samplers = [train_loader.batch_sampler for task, train_loader in train_loaders]
+    train_iters = [(task, iter(train_loader)) for task, train_loader in train_loaders]
     # save memory
     del train_sets
 
+    if args.val_device is None:
+        val_device = main_device
+    elif args.val_device >= 0:
+        val_device = get_devices([args.val_device])[0]
+    else:
+        val_device = torch.device('cpu')
     val_iters = [
-        (task, make_data_loader(dataset, numericalizer, bs, main_device, train=False))
+        (task, make_data_loader(dataset, numericalizer, bs, val_device, train=False, rank=rank, world_size=world_size))
         for task, dataset, bs in zip(args.val_tasks, val_sets, args.val_batch_size)
     ]
+    fast_val_iters = []
+    if args.fast_val_size is not None:
+        # the same subset is used every time, so that scores of different iterations are comparable
+        fast_val_iters = [
+            (
+                task,
+                make_data_loader(
+                    subsample_dataset(dataset, args.fast_val_size, args.seed),
+                    numericalizer,
+                    bs,
+                    val_device,
+                    train=False,
+                    rank=rank,
+                    world_size=world_size,
+                ),
+            )
+            for task, dataset, bs in zip(args.val_tasks, val_sets, args.val_batch_size)
+        ]
     # save memory
     del val_sets
 
-    aux_iters = []
+    background_validator = None
+    if args.val_device is not None:
+        background_validator = BackgroundValidator(
+            model.module, val_device, saver=saver, best_decascore=best_decascore, logger=logger
+        )
+
+    aux_loaders, aux_iters = [], []
     if use_curriculum:
-        aux_iters = [
-            (name, make_data_loader(dataset, numericalizer, tok, main_device, train=True))
+        aux_loaders = [
+            (name, make_data_loader(dataset, numericalizer, tok, main_device, train=True, rank=rank, world_size=world_size))
             for name, dataset, tok in zip(args.train_tasks, aux_sets, args.train_batch_tokens)
         ]
-        aux_iters = [(task, iter(aux_iter)) for task, aux_iter in aux_iters]
+        samplers += [aux_loader.batch_sampler for task, aux_loader in aux_loaders]
+        aux_iters = [(task, iter(aux_loader)) for task, aux_loader in aux_loaders]
         # save memory
         del aux_sets
 
+    if args.autotune_batch_size:
+        autotune_batch_sizes(
+            args,
+            model,
+            background_validator.model if background_validator is not None else model.module,
+            opt,
+            train_loaders,
+            aux_loaders,
+            val_iters,
+            fast_val_iters,
+            main_device,
+            val_device,
+        )
+
     zero_loss = 0
+    resume_task_idx = None
+    if train_state is not None:
+        # jump straight to the iteration after the one where the checkpoint was saved, instead of replaying all previous batches
+        # this needs to happen after creating the iterators, since creating them draws from the random number generators
+        iteration = train_state['iteration'] + 1
+        start_iteration = iteration
+        rnd = train_state['round']
+        resume_task_idx = train_state['task_idx']
+        per_task_iterations = train_state['per_task_iterations']
+        zero_loss = train_state['zero_loss']
+        for task_idx, task in enumerate(args.train_tasks):
+            task_iteration[task] = train_state['task_iteration'][task.name] + (task_idx == resume_task_idx)
+            task_done[task] = train_state['task_done'][task.name]
+            task_fraction[task] = train_state['task_fraction'][task.name]
+            task_total_num_examples[task] = train_state['task_total_num_examples'][task.name]
+        for sampler, sampler_state in zip(samplers, train_state['samplers']):
+            sampler.load_state_dict(sampler_state)
+        lr_scheduler.load_state_dict(train_state['lr_scheduler_state_dict'])
+        set_rng_state(train_state['rng_state'], main_device)
+        logger.info(f'Resuming {log_prefix} from iteration {iteration}')
+
+    # loss statistics are accumulated on the device, and only read when logging or checking whether to stop
+    zero_loss = torch.tensor(zero_loss, device=main_device)
+    found_zero_loss = torch.tensor(False, device=main_device)
+    found_nan_loss = torch.tensor(False, device=main_device)
+
     logger.info(f'Begin {log_prefix}')
+    log_start_time = time.time()
+    reset_peak_memory(main_device)
+    timer = PhaseTimer(main_device)
 
     if any(train_iterations):
         while not all(task_done.values()):
@@ -465,6 +852,10 @@ def train(
                 train_iterations = train_iter_deep
 
             for task_idx, (task, train_iter) in enumerate(train_iters):
+                if resume_task_idx is not None:
+                    # these tasks were already trained in the round during which the checkpoint was saved
+                    if task_idx <= resume_task_idx:
+                        continue
                 task_iterations = train_iterations[task_idx] if train_iterations is not None else None
                 if task_iterations == 0:
                     continue
@@ -472,17 +863,23 @@ def train(
                     task_done[task] = True
                     continue
 
+                if background_validator is not None:
+                    # pick up the result of the last validation, if it is done
+                    background_validator.poll()
+                    best_decascore = background_validator.best_decascore
+
                 # load batches even if (args.resume == True) and we are going to skip the iteration
                 # this makes runs that are resumed have the exact same behavior as runs that are
                 # finished in one pass (given that the random seed is the same).
-                batch = get_next_batch(
-                    train_iter,
-                    aux_iters,
-                    task=task,
-                    task_idx=task_idx,
-                    task_fraction=task_fraction,
-                    use_curriculum=use_curriculum,
-                )
+                with timer.time('data', on_device=False):
+                    batch = get_next_batch(
+                        train_iter,
+                        aux_iters,
+                        task=task,
+                        task_idx=task_idx,
+                        task_fraction=task_fraction,
+                        use_curriculum=use_curriculum,
+                    )
 
                 if iteration < start_iteration:
                     # skip this iteration (this is done to ensure iterators are at the same position when resuming)
@@ -490,6 +887,8 @@ def train(
                     iteration += 1
                     if (iteration + 1) % args.gradient_accumulation_steps == 0:
                         lr_scheduler.step()  # update the learning rate
+                    log_start_time = time.time()
+                    timer.reset()
                     continue
 
                 task_progress = f'{task_iteration[task]}/{task_iterations}:' if task_iterations is not None else ''
@@ -501,21 +900,32 @@ def train(
                     batch,
                     iteration,
                     opt,
+                    scaler,
                     devices,
                     lr_scheduler=lr_scheduler,
                     grad_clip=args.grad_clip,
                     gradient_accumulation_steps=args.gradient_accumulation_steps,
+                    mixed_precision=args.mixed_precision,
+                    timer=timer,
                 )
-                if loss is None:
-                    logger.info('Encountered NAN loss during training. Continue training ignoring the current batch')
-                    continue
-                if loss < 1e-6:
-                    zero_loss += 1
-                    if zero_loss >= 100:
-                        logger.info('Found loss less than 1e-6 for 100 steps, stopping.')
+                zero_loss = torch.where(loss < 1e-6, zero_loss + 1, torch.zeros_like(zero_loss))
+                found_zero_loss |= zero_loss >= ZERO_LOSS_PATIENCE
+                found_nan_loss |= torch.isnan(loss)
+                if (
+                    iteration % ZERO_LOSS_PATIENCE == 0
+                    or should_log(iteration, log_every)
+                    or should_validate(iteration, val_every, resume=args.resume, start_iteration=start_iteration)
+                ):
+                    # all processes see the same averaged loss, so they stop together
+                    nan_loss, stop = torch.stack([found_nan_loss, found_zero_loss]).tolist()
+                    if nan_loss:
+                        raise RuntimeError(f'Got NaN loss before iteration {iteration}')
+                    if stop:
+                        logger.info(f'Found loss less than 1e-6 for {ZERO_LOSS_PATIENCE} steps, stopping.')
+                        if background_validator is not None:
+                            background_validator.close()
+                        saver.close()
                         return
-                else:
-                    zero_loss = 0
 
                 # update curriculum fraction
                 if args.use_curriculum:
@@ -528,11 +938,21 @@ def train(
                 num_examples += batch.context.value.size(0)
                 len_contexts += batch.context.value.size(1)
                 len_answers += batch.answer.value.size(1)
+                # padding tokens count too, since they are processed like any other token
+                num_tokens += batch.context.value.numel() + batch.answer.value.numel()
+                # kept on the device until the next log, to avoid waiting for it in every iteration
+                num_real_tokens += batch.context.length.sum() + batch.answer.length.sum()
 
                 task_total_num_examples[task] += batch.context.value.size(0)
 
                 if should_log(iteration, log_every):
-                    local_loss /= log_every
+                    # in distributed training, each process reports its own throughput and memory usage
+                    phase_times = timer.get_times()
+                    log_time = time.time() - log_start_time
+                    tokens_per_second = num_tokens / log_time
+                    examples_per_second = num_examples / log_time
+                    padding_ratio = 1 - float(num_real_tokens) / num_tokens
+                    local_loss = local_loss.item() / log_every
                     num_examples /= log_every
                     len_contexts /= log_every
                     len_answers /= log_every
@@ -552,14 +972,25 @@ def train(
                         task_progress=task_progress,
                         timestamp=args.timestamp,
                         log_prefix=log_prefix,
+                        tokens_per_second=tokens_per_second,
+                        examples_per_second=examples_per_second,
+                        padding_ratio=padding_ratio,
+                        phase_times=phase_times,
+                        peak_memory=get_peak_memory(main_device),
                     )
                     num_examples = 0
                     len_contexts = 0
                     len_answers = 0
+                    num_tokens = 0
+                    num_real_tokens = 0
                     local_loss = 0
+                    log_start_time = time.time()
+                    reset_peak_memory(main_device)
+                    timer.reset()
 
                 # validate
                 if should_validate(iteration, val_every, resume=args.resume, start_iteration=start_iteration):
+                    validation_start_time = time.time()
                     if args.print_train_examples_too:
                         names = ['answer', 'context']
                         values = [
@@ -569,25 +1000,61 @@ def train(
                         num_print = min(len(values[0]), args.num_print)
                         print_results(names, values, num_print=num_print)
 
-                    deca_score = do_validate(
+                    full_validation = args.fast_val_size is None or (
+                        args.full_val_every is not None and iteration % args.full_val_every == 0
+                    )
+                    # scores of full and fast validations are not comparable, so only one of them is used to select the best model
+                    use_for_best = full_validation or args.full_val_every is None
+                    validate_fn = partial(
+                        do_validate,
                         iteration,
                         args,
-                        model,
-                        numericalizer,
-                        val_iters,
+                        val_iters=val_iters if full_validation else fast_val_iters,
                         train_task=task,
                         round_progress=round_progress,
                         task_progress=task_progress,
                         writer=writer,
                         logger=logger,
                     )
+                    if background_validator is not None:
+                        background_validator.submit(
+                            iteration,
+                            validate_fn,
+                            model.module,
+                            get_save_opt_state_dict(iteration, opt, scaler),
+                            use_for_best,
+                        )
+                        # the best model is saved when the validation finishes
+                        deca_score = None
+                    else:
+                        deca_score = validate_fn(model=model, numericalizer=numericalizer)
+                        if not use_for_best:
+                            deca_score = None
 
                     # saving
                     if should_save(iteration, save_every):
+                        consolidate_opt_state(opt)
+                    if should_save(iteration, save_every) and is_main_process():
+                        # everything needed to continue training after this iteration when resuming
+                        train_state = {
+                            'iteration': iteration,
+                            'round': rnd,
+                            'task_idx': task_idx,
+                            'per_task_iterations': per_task_iterations,
+                            'zero_loss': zero_loss.item(),
+                            'task_iteration': {t.name: v for t, v in task_iteration.items()},
+                            'task_done': {t.name: v for t, v in task_done.items()},
+                            'task_fraction': {t.name: v for t, v in task_fraction.items()},
+                            'task_total_num_examples': {t.name: v for t, v in task_total_num_examples.items()},
+                            'samplers': [sampler.state_dict() for sampler in samplers],
+                            'lr_scheduler_state_dict': lr_scheduler.state_dict(),
+                            'rng_state': get_rng_state(main_device),
+                        }
                         best_decascore = maybe_save(
                             iteration,
                             model,
                             opt,
+                            scaler,
                             deca_score,
                             best_decascore,
                             saver=saver,
@@ -596,15 +1063,22 @@ def train(
                             round_progress=round_progress,
                             task_progress=task_progress,
                             timestamp=args.timestamp,
-                            log_dir=args.log_dir,
                             model_parallel=args.model_parallel,
+                            train_state=train_state,
                         )
 
+                    # do not count the time spent on validation and saving towards training throughput,
+                    # but report it separately
+                    validation_time = time.time() - validation_start_time
+                    timer.add('validation', validation_time)
+                    log_start_time += validation_time
+
                 # book keeping
                 task_iteration[task] += 1
                 iteration += 1
 
             # book keeping
+            resume_task_idx = None
             per_task_iterations += 1
             rnd += 1
 
@@ -613,11 +1087,15 @@ def train(
     else:
         # Save pretrained models as is without any finetuning
         # Useful for doing prediction/ generation on those models with genienlp
+        consolidate_opt_state(opt)
         for task in args.train_tasks:
+            if not is_main_process():
+                break
             maybe_save(
                 0,
                 model,
                 opt,
+                scaler,
                 deca_score=0,
                 best_decascore=-1,
                 saver=saver,
@@ -626,12 +1104,15 @@ def train(
                 round_progress=0,
                 task_progress=0,
                 timestamp=args.timestamp,
-                log_dir=args.log_dir,
                 model_parallel=args.model_parallel,
             )
 
         logger.info(f'{args.pretrained_model} model is saved to {args.save} without any fine-tuning')
 
+    if background_validator is not None:
+        background_validator.close()
+    saver.close()
+
 
 def get_transformer_learning_rate(i, *, dimension, warmup):
     i += 1
@@ -645,26 +1126,32 @@ def get_sgd_learning_rate(i, *, warmup):
 
 def init_opt(args, model, logger):
     if args.optimizer == 'adam':
+        opt_class = torch.optim.Adam
         # Adam with transformer schedule has a different set of default hyperparameters:
         if args.lr_schedule == 'transformer':
-            opt = torch.optim.Adam(
-                model.params, lr=args.lr_multiply, betas=(0.9, 0.98), eps=1e-9, weight_decay=args.weight_decay
-            )
+            opt_kwargs = dict(lr=args.lr_multiply, betas=(0.9, 0.98), eps=1e-9, weight_decay=args.weight_decay)
         else:
-            opt = torch.optim.Adam(
-                model.params, lr=args.lr_multiply, betas=(args.beta0, 0.999), weight_decay=args.weight_decay
-            )
+            opt_kwargs = dict(lr=args.lr_multiply, betas=(args.beta0, 0.999), weight_decay=args.weight_decay)
     elif args.optimizer == 'adamw':
-        opt = AdamW(model.params, lr=args.lr_multiply, weight_decay=args.weight_decay)
+        opt_class = AdamW
+        opt_kwargs = dict(lr=args.lr_multiply, weight_decay=args.weight_decay)
     elif args.optimizer == 'radam':
         import radam
 
         if args.warmup > 1:
             logger.warning('With RAdam optimizer, warmup is never applied')
-        opt = radam.RAdam(model.params, lr=args.lr_multiply, betas=(args.beta0, 0.999), weight_decay=args.weight_decay)
+        opt_class = radam.RAdam
+        opt_kwargs = dict(lr=args.lr_multiply, betas=(args.beta0, 0.999), weight_decay=args.weight_decay)
     else:
         assert args.optimizer == 'sgd'
-        opt = torch.optim.SGD(model.params, lr=args.lr_multiply, weight_decay=args.weight_decay)
+        opt_class = torch.optim.SGD
+        opt_kwargs = dict(lr=args.lr_multiply, weight_decay=args.weight_decay)
+
+    if args.shard_optimizer_state:
+        # each process updates its share of the parameters and broadcasts them to the other processes
+        opt = ZeroRedundancyOptimizer(model.params, optimizer_class=opt_class, **opt_kwargs)
+    else:
+        opt = opt_class(model.params, **opt_kwargs)
 
     if args.lr_schedule == 'transformer':
         lr_lambda = partial(get_transformer_learning_rate, dimension=args.dimension, warmup=args.warmup)
@@ -699,14 +1186,32 @@ def main(args):
     if args is None:
         return
 
+    if args.distributed and 'WORLD_SIZE' not in os.environ:
+        # spawn one process per device; a stale file from a previous run would break their synchronization
+        if os.path.exists(args.dist_sync_file):
+            os.remove(args.dist_sync_file)
+        torch.multiprocessing.spawn(run, args=(args,), nprocs=len(args.devices))
+    else:
+        # processes started by a launcher like torchrun get their device on this node from the environment
+        run(int(os.environ.get('LOCAL_RANK', 0)), args)
+
+
+def run(local_rank, args):
     set_seed(args)
     devices = get_devices(args.devices)
+    if args.distributed:
+        devices = [devices[local_rank % len(devices)]]
+        init_distributed(args, local_rank, devices[0])
     logger = initialize_logger(args)
     logger.info(f'Arguments:\n{pformat(vars(args))}')
 
     model_name = args.model
     model_class = getattr(models, model_name)
 
+    if not is_main_process():
+        # let the main process preprocess and cache the data, and download the pretrained model first
+        torch.distributed.barrier()
+
     tasks = set(args.train_tasks) | set(args.val_tasks)
     train_sets, val_sets, aux_sets = prepare_data(args, logger)
 
@@ -742,8 +1247,11 @@ def main(args):
         logger.info(f'Initializing a new {model_name}')
         model = model_class(args=args, vocab_sets=train_sets + val_sets, tasks=tasks, src_lang=src_lang, tgt_lang=tgt_lang)
 
+    if args.distributed and is_main_process():
+        torch.distributed.barrier()
+
     # dump entities if required
-    if args.ned_dump_entity_type_pairs and args.add_entities_to_text == 'append':
+    if args.ned_dump_entity_type_pairs and args.add_entities_to_text == 'append' and is_main_process():
         for task, train_set, val_set in zip(tasks, train_sets, val_sets):
             ned_dump_entity_type_pairs(train_set, args.data, 'train', task.utterance_field)
             ned_dump_entity_type_pairs(val_set, args.data, 'eval', task.utterance_field)
@@ -780,6 +1288,14 @@ def main(args):
         device_map = dict(zip(args.devices, layers_list))
         model.model.parallelize(device_map)
         logger.info(f'Model parallel is used with following device map: {model.model.device_map}')
+    elif args.distributed:
+        model.to(devices[0])
+        # inputs are already on the device of this process, so DistributedDataParallel does not need to move them
+        # parameters that do not contribute to the loss of some batches must not block the reduction of gradients
+        model = torch.nn.parallel.DistributedDataParallel(model, find_unused_parameters=True)
+        if args.gradient_checkpointing:
+            # recomputing activations during the backward pass would otherwise mark the same parameters ready twice
+            model._set_static_graph()
     else:
         model.to(devices[0])
         model = NamedTupleCompatibleDataParallel(model, device_ids=devices)
@@ -787,7 +1303,10 @@ def main(args):
     ##########
 
     opt, lr_scheduler = init_opt(args, model, logger)
+    # loss scaling is only needed for float16, i.e. on GPUs
+    scaler = torch.cuda.amp.GradScaler(enabled=args.mixed_precision and devices[0].type == 'cuda')
     start_iteration = 1
+    train_state = None
 
     if args.resume:
         logger.info(f'Resuming training from {os.path.splitext(args.load)[0]}_optim.pth')
@@ -795,9 +1314,16 @@ def main(args):
         opt_state_dict = torch.load(os.path.join(args.save, f'{os.path.splitext(args.load)[0]}_optim.pth'), map_location='cpu')
         start_iteration = opt_state_dict.pop('start_iteration')
         logger.info(f'Starting iteration is {start_iteration}')
+        # the scaler state is empty if the checkpoint was saved without mixed precision, or missing if it predates it
+        scaler_state_dict = opt_state_dict.pop('scaler_state_dict', None)
+        # checkpoints saved before the training state was added need to replay all batches up to `start_iteration`
+        train_state = opt_state_dict.pop('train_state', None)
+        # checkpoints always hold the whole optimizer state; with --shard_optimizer_state each process keeps its share of it
         opt.load_state_dict(opt_state_dict)
+        if scaler_state_dict:
+            scaler.load_state_dict(scaler_state_dict)
 
-    if hasattr(args, 'tensorboard') and args.tensorboard:
+    if hasattr(args, 'tensorboard') and args.tensorboard and is_main_process():
         logger.info('Initializing Writer')
         writer = SummaryWriter(log_dir=args.tensorboard_dir, purge_step=start_iteration, flush_secs=60)
     else:
@@ -808,6 +1334,7 @@ def main(args):
         devices,
         model,
         opt,
+        scaler,
         lr_scheduler,
         train_sets,
         args.train_iterations,
@@ -824,7 +1351,11 @@ def main(args):
         use_curriculum=args.use_curriculum,
         best_decascore=best_decascore,
         log_prefix='training',
+        train_state=train_state,
     )
 
     if writer is not None:
         writer.close()  # otherwise the last written value may not be flushed
+
+    if args.distributed:
+        torch.distributed.destroy_process_group()
@@ -28,6 +28,9 @@
 # OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import contextlib
+import copy
+import hashlib
 import json
 import logging
 import os
@@ -35,6 +38,7 @@ import random
 import re
 import shutil
 import time
+from collections import defaultdict
 from json.decoder import JSONDecodeError
 from typing import List, Optional
 
@@ -538,6 +542,190 @@ def get_devices(devices=None):
     return [torch.device(ordinal) for ordinal in devices]
 
 
+def init_distributed(args, local_rank, device):
+    """
+    Joins the process group of distributed training. If the process was started by a launcher like `torchrun` (possibly
+    on multiple nodes), the rank and the address of the main process are read from the environment, otherwise processes
+    are spawned on this machine, one per device, and synchronize through a file in the log directory
+    """
+    if 'WORLD_SIZE' in os.environ:
+        init_method = 'env://'
+        rank = int(os.environ['RANK'])
+        world_size = int(os.environ['WORLD_SIZE'])
+    else:
+        init_method = 'file://' + os.path.abspath(args.dist_sync_file)
+        rank = local_rank
+        world_size = len(args.devices)
+
+    backend = args.dist_backend
+    if backend is None:
+        backend = 'nccl' if device.type == 'cuda' else 'gloo'
+    if device.type == 'cuda':
+        torch.cuda.set_device(device)
+
+    torch.distributed.init_process_group(backend, init_method=init_method, rank=rank, world_size=world_size)
+    logger.info(f'Initialized process {rank} of {world_size} on {device} with {backend} backend')
+
+
+def get_rank():
+    if not torch.distributed.is_available() or not torch.distributed.is_initialized():
+        return 0
+    return torch.distributed.get_rank()
+
+
+def get_world_size():
+    if not torch.distributed.is_available() or not torch.distributed.is_initialized():
+        return 1
+    return torch.distributed.get_world_size()
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def all_reduce_mean(tensor):
+    """
+    Returns the average of `tensor` over all processes of distributed training
+    """
+    if get_world_size() == 1:
+        return tensor
+    tensor = tensor.detach().clone()
+    torch.distributed.all_reduce(tensor)
+    return tensor / get_world_size()
+
+
+def scale_gradients(parameters, factor):
+    """
+    Multiplies the gradients of `parameters` by `factor` in place, with one fused multi-tensor kernel per device when
+    available. Tensors are applied without reading their value, which would make the host wait for the device
+    """
+    device_grads = defaultdict(list)
+    for p in parameters:
+        if p.grad is not None:
+            device_grads[p.grad.device].append(p.grad)
+    for device, grads in device_grads.items():
+        device_factor = factor.to(device) if isinstance(factor, torch.Tensor) else factor
+        if not hasattr(torch, '_foreach_mul_'):
+            for grad in grads:
+                grad.mul_(device_factor)
+        elif isinstance(factor, torch.Tensor):
+            torch._foreach_mul_(grads, [device_factor] * len(grads))
+        else:
+            torch._foreach_mul_(grads, device_factor)
+
+
+def clip_grad_norm(parameters, max_norm, scale=1.0):
+    """
+    Same as `torch.nn.utils.clip_grad_norm_` for the L2 norm of the gradients multiplied by `scale`, except that gradients are
+    always multiplied by `scale` and the clipping coefficient (capped to 1), in a single pass, instead of checking on the host
+    whether they need to be clipped. Returns the norm of the scaled gradients
+    """
+    parameters = [p for p in parameters if p.grad is not None]
+    if len(parameters) == 0:
+        return torch.tensor(0.0)
+    device = parameters[0].grad.device
+    total_norm = torch.norm(torch.stack([torch.norm(p.grad.detach()).to(device) for p in parameters])) * scale
+    scale_gradients(parameters, scale * torch.clamp(max_norm / (total_norm + 1e-6), max=1.0))
+    return total_norm
+
+
+def all_gather_lists(values):
+    """
+    Concatenates the list `values` of all processes of distributed training, in the order of their ranks
+    """
+    if get_world_size() == 1:
+        return values
+    all_values = [None] * get_world_size()
+    torch.distributed.all_gather_object(all_values, values)
+    return [value for process_values in all_values for value in process_values]
+
+
+# autocast is entered at every training step, so the lack of CPU support is only reported once
+_warned_no_cpu_mixed_precision = False
+
+
+def autocast(device, enabled):
+    """
+    Context manager running its body in mixed precision on `device` if `enabled`:
+    float16 on GPUs, and bfloat16 on CPUs if the installed version of pytorch supports it
+    """
+    global _warned_no_cpu_mixed_precision
+    if device.type == 'cuda':
+        return torch.cuda.amp.autocast(enabled=enabled)
+    if enabled and hasattr(torch, 'cpu') and hasattr(torch.cpu, 'amp'):
+        return torch.cpu.amp.autocast(dtype=torch.bfloat16)
+    if enabled and not _warned_no_cpu_mixed_precision:
+        logger.warning('This version of pytorch does not support mixed precision on CPU; using full precision instead')
+        _warned_no_cpu_mixed_precision = True
+    return contextlib.nullcontext()
+
+
+def is_oom_error(exception):
+    return isinstance(exception, RuntimeError) and 'out of memory' in str(exception)
+
+
+def get_peak_memory(device):
+    """
+    Returns the maximum number of bytes allocated on `device` since the last call to `reset_peak_memory`,
+    or None if `device` does not keep track of its memory
+    """
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device)
+    return None
+
+
+def reset_peak_memory(device):
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+
+
+class PhaseTimer(object):
+    """
+    Accumulates the time spent in each phase of training. Phases that run on a GPU are timed with CUDA events, so timing
+    them does not make the host wait for the device until the times are read with `get_times`
+    """
+
+    def __init__(self, device):
+        self.use_events = device.type == 'cuda'
+        self.reset()
+
+    def reset(self):
+        self._times = {}
+        self._events = []
+
+    @contextlib.contextmanager
+    def time(self, phase, on_device=True):
+        if self.use_events and on_device:
+            start = torch.cuda.Event(enable_timing=True)
+            end = torch.cuda.Event(enable_timing=True)
+            start.record()
+            try:
+                yield
+            finally:
+                end.record()
+                self._events.append((phase, start, end))
+        else:
+            start = time.time()
+            try:
+                yield
+            finally:
+                self.add(phase, time.time() - start)
+
+    def add(self, phase, seconds):
+        self._times[phase] = self._times.get(phase, 0.0) + seconds
+
+    def get_times(self):
+        """
+        Returns the number of seconds spent in each phase since the last call to `reset`
+        """
+        if self._events:
+            self._events[-1][2].synchronize()
+            for phase, start, end in self._events:
+                self.add(phase, start.elapsed_time(end) / 1000)
+            self._events = []
+        return dict(self._times)
+
+
 def set_seed(args):
     np.random.seed(args.seed)
     random.seed(args.seed)
@@ -545,6 +733,24 @@ def set_seed(args):
     torch.cuda.manual_seed_all(args.seed)
 
 
+def get_rng_state(device):
+    """
+    Returns the state of all random number generators used during training, so that they can be restored with `set_rng_state`
+    """
+    state = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if device.type == 'cuda':
+        state['cuda'] = torch.cuda.get_rng_state(device)
+    return state
+
+
+def set_rng_state(state, device):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and device.type == 'cuda':
+        torch.cuda.set_rng_state(state['cuda'], device)
+
+
 def get_trainable_params(model, name=False):
     # TODO is always called with name=False, so remove the if statement
     if name:
@@ -570,9 +776,76 @@ def elapsed_time(log):
     return f'{day:02}:{hour:02}:{minutes:02}:{seconds:02}'
 
 
-def make_data_loader(dataset, numericalizer, batch_size, device=None, train=False, return_original_order=False):
+def numericalize_examples(dataset, numericalizer):
+    """
+    Same as `NumericalizedExamples.from_examples`, but reuses numericalized examples cached under `--cache` by an earlier
+    train, validation or prediction run on the same data.
+    The cache is content-addressed: it is keyed by the text and features of each example, the settings that affect how they
+    are numericalized (including NED settings), and the fingerprint of the tokenizer, which changes when the vocabulary grows.
+    """
+    args = numericalizer.args
+    use_features = args.do_ned and args.add_entities_to_text == 'no'
+
+    data_hash = hashlib.sha1()
+    data_hash.update(
+        json.dumps(
+            [
+                numericalizer.fingerprint(),
+                getattr(dataset, 'is_classification', False),
+                getattr(dataset, 'is_sequence_classification', False),
+                args.no_separator,
+                args.do_ned,
+                args.add_entities_to_text,
+                args.max_features_size,
+            ]
+        ).encode('utf-8')
+    )
+    for ex in dataset:
+        data_hash.update(json.dumps([ex.context, ex.question, ex.answer]).encode('utf-8') + b'\0')
+        if use_features:
+            for array in (*ex.context_feature, *ex.question_feature):
+                data_hash.update(array.tobytes())
+    cache_name = os.path.join(args.cache, 'numericalized', data_hash.hexdigest())
+
+    if os.path.exists(cache_name) and not args.skip_cache:
+        logger.info(f'Loading cached numericalized examples from {cache_name}')
+        fields = torch.load(cache_name)
+        return [NumericalizedExamples([ex.example_id], context, answer) for ex, (context, answer) in zip(dataset, fields)]
+
     all_features = NumericalizedExamples.from_examples(dataset, numericalizer)
 
+    if args.cache_input_data:
+        os.makedirs(os.path.dirname(cache_name), exist_ok=True)
+        logger.info(f'Caching numericalized examples to {cache_name}')
+        # example ids are not part of the key, so they are not cached either
+        torch.save([(ex.context, ex.answer) for ex in all_features], cache_name)
+
+    return all_features
+
+
+def subsample_dataset(dataset, size, seed):
+    """
+    Returns a copy of `dataset` with `size` randomly chosen examples, or `dataset` itself if it is not larger than that.
+    With sentence batching, where the dataset is the concatenation of one block of examples per language, the same examples
+    are chosen from every block.
+    The choice only depends on `seed`, and does not affect the global random number generators
+    """
+    groups = getattr(dataset, 'groups', None) or 1
+    block_size = len(dataset.examples) // groups
+    sample_size = max(size // groups, 1)
+    if sample_size >= block_size:
+        return dataset
+    chosen = sorted(random.Random(seed).sample(range(block_size), sample_size))
+    subsampled_dataset = copy.copy(dataset)
+    subsampled_dataset.examples = [dataset.examples[block * block_size + i] for block in range(groups) for i in chosen]
+    return subsampled_dataset
+
+
+def make_data_loader(
+    dataset, numericalizer, batch_size, device=None, train=False, return_original_order=False, rank=0, world_size=1
+):
+    all_features = numericalize_examples(dataset, numericalizer)
+
     context_lengths = [ex.context.length for ex in all_features]
     answer_lengths = [ex.answer.length for ex in all_features]
 
@@ -591,6 +864,8 @@ def make_data_loader(dataset, numericalizer, batch_size, device=None, train=Fals
         sort_key_fn=dataset.sort_key_fn,
         batch_size_fn=dataset.batch_size_fn,
         groups=dataset.groups,
+        rank=rank,
+        world_size=world_size,
     )
     # get the sorted data_source
     all_f = sampler.data_source
@@ -797,6 +1072,7 @@ def load_config_json(args):
             'crossner_domains',
             'hf_test_overfit',
             'override_valid_metrics',
+            'gradient_checkpointing',
         ]
 
         # train and predict scripts have these arguments in common. We use the values from train only if they are not provided in predict
@@ -838,6 +1114,7 @@ def load_config_json(args):
                 'preprocess_special_tokens',
                 'no_fast_tokenizer',
                 'force_fast_tokenizer',
+                'gradient_checkpointing',
             ):
                 setattr(args, r, False)
             elif r in ('num_db_types', 'db_unk_id', 'num_workers'):
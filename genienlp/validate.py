@@ -36,7 +36,7 @@ import torch
 from .data_utils.progbar import progress_bar
 from .metrics import compute_metrics
 from .models import TransformerForSequenceClassification, TransformerForTokenClassification
-from .util import GenerationOutput, merge_translated_sentences
+from .util import GenerationOutput, all_gather_lists, is_main_process, merge_translated_sentences
 
 
 def generate_with_model(
@@ -120,6 +120,8 @@ def generate_with_seq2seq_model(
             batch_answer = numericalizer.reverse(batch.answer.value.data, 'answer')
             answers += batch_answer
 
+        # the encoder output is the same for all decoding hyperparameters
+        encoder_output = model.encode(batch)
         for hyperparameter_idx in range(len(args.temperature)):
             generated = model.generate(
                 batch,
@@ -134,31 +136,34 @@ def generate_with_seq2seq_model(
                 diversity_penalty=args.diversity_penalty[hyperparameter_idx],
                 no_repeat_ngram_size=args.no_repeat_ngram_size[hyperparameter_idx],
                 do_sample=args.temperature[hyperparameter_idx] != 0,  # if temperature==0, we do not sample
+                encoder_output=encoder_output,
+                output_step_logits=output_confidence_features or output_confidence_scores,
+                prompt_lookup_num_tokens=getattr(args, 'prompt_lookup_num_tokens', 0),
+                cross_attention_layers=task.cross_attention_layers,
             )
             partial_batch_prediction_ids = generated.sequences
+            # only recorded for the layers the task asked for, with shape
+            # (num_layers, batch_size, num_heads, max_output_length, max_input_length)
             cross_attentions = getattr(generated, 'cross_attentions', None)
 
+            # postprocess prediction ids
+            kwargs = {'numericalizer': numericalizer}
             if cross_attentions is not None:
-                # stack tensors to shape (max_output_length, num_layers, batch_size, num_heads, 1, max_input_length)
-                cross_attentions = torch.stack(([torch.stack(tuple) for tuple in cross_attentions]))
-
-                # reshape to (num_layers, batch_size, num_heads, max_output_length, max_input_length)
-                cross_attentions = cross_attentions.squeeze(4)
-                cross_attentions = cross_attentions.permute(1, 2, 3, 0, 4).contiguous()
-
-                # choose only last layer attentions
-                # cross_attentions = torch.mean(cross_attentions[-3:, ...], dim=0)
-                cross_attentions = cross_attentions[-1, ...]
-
-                # postprocess prediction ids
-                kwargs = {'numericalizer': numericalizer, 'cross_attentions': cross_attentions}
-                partial_batch_prediction_ids = task.batch_postprocess_prediction_ids(
-                    batch_example_ids, batch.context.value.data, partial_batch_prediction_ids, **kwargs
-                )
+                kwargs['cross_attentions'] = torch.mean(cross_attentions, dim=0)
+            partial_batch_prediction_ids = task.batch_postprocess_prediction_ids(
+                batch_example_ids, batch.context.value.data, partial_batch_prediction_ids, **kwargs
+            )
 
             if output_confidence_features or output_confidence_scores:
                 partial_batch_confidence_features = model.confidence_features(
-                    batch=batch, predictions=partial_batch_prediction_ids, mc_dropout_num=args.mc_dropout_num
+                    batch=batch,
+                    predictions=partial_batch_prediction_ids,
+                    mc_dropout_num=args.mc_dropout_num,
+                    encoder_output=encoder_output,
+                    # unless postprocessing changed the predictions, the logits of generation can be reused
+                    step_logits=getattr(generated, 'step_logits', None)
+                    if partial_batch_prediction_ids is generated.sequences
+                    else None,
                 )
 
             partial_batch_prediction = numericalizer.reverse(partial_batch_prediction_ids, 'answer')
@@ -181,6 +186,39 @@ def generate_with_seq2seq_model(
         predictions += batch_prediction
         confidence_features += batch_confidence_features
 
+    return finalize_generation_output(
+        example_ids,
+        predictions,
+        answers,
+        contexts,
+        confidence_features,
+        numericalizer,
+        args,
+        output_predictions_only=output_predictions_only,
+        output_confidence_features=output_confidence_features,
+        original_order=original_order,
+        confidence_estimators=confidence_estimators,
+    )
+
+
+def finalize_generation_output(
+    example_ids,
+    predictions,
+    answers,
+    contexts,
+    confidence_features,
+    numericalizer,
+    args,
+    output_predictions_only=False,
+    output_confidence_features=False,
+    original_order=None,
+    confidence_estimators=None,
+) -> GenerationOutput:
+    """
+    Sorts the outputs of generation (in the order of the data iterator) back to `original_order`, stitches split sentences back
+    together and computes confidence scores. Outputs of several data iterators can be concatenated before calling this
+    """
+    output_confidence_scores = confidence_estimators is not None
     if original_order is not None:
         # sort back to the original order
         original_order, example_ids, predictions, answers, contexts, confidence_features = [
@@ -317,7 +355,7 @@ def print_results(keys, values, num_print=1):
 def validate(task, val_iter, model, numericalizer, args, num_print=10):
     with torch.no_grad():
         model.eval()
-        if isinstance(model, torch.nn.DataParallel):
+        if isinstance(model, (torch.nn.DataParallel, torch.nn.parallel.DistributedDataParallel)):
             # get rid of the DataParallel wrapper
             model = model.module
 
@@ -325,10 +363,18 @@ def validate(task, val_iter, model, numericalizer, args, num_print=10):
 
         output = generate_with_model(model, val_iter, numericalizer, task, args)
 
+        # in distributed training, each process generates for its share of the validation set
+        # metrics like BLEU are not averages over examples, so we compute them over the outputs of all processes
+        output.example_ids = all_gather_lists(output.example_ids)
+        output.predictions = all_gather_lists(output.predictions)
+        output.answers = all_gather_lists(output.answers)
+        output.contexts = all_gather_lists(output.contexts)
+
         metrics = calculate_and_reduce_metrics(
             output.predictions, output.answers, task.metrics, args.reduce_metrics, model.tgt_lang
         )
-        results = [output.predictions, output.answers, output.contexts]
-        print_results(names, results, num_print=num_print)
+        if is_main_process():
+            results = [output.predictions, output.answers, output.contexts]
+            print_results(names, results, num_print=num_print)
 
         return output, metrics
@@ -20,6 +20,70 @@ do
         exit 1
     fi
 
+    # check that confidence features computed from the logits of generation match the ones of a separate forward pass,
+    # with a repetition penalty so that the logits are processed during generation
+    python3 - <<EOF
+import argparse
+
+import torch
+
+from genienlp import predict
+from genienlp.arguments import check_and_update_generation_args
+from genienlp.tasks.registry import get_tasks
+from genienlp.util import load_config_json, set_seed
+
+parser = argparse.ArgumentParser()
+predict.parse_argv(parser)
+args = parser.parse_args(
+    ['--tasks', 'almond', '--evaluate', 'test', '--path', '$workdir/model_$i', '--data', '$SRCDIR/dataset/',
+     '--embeddings', '$EMBEDDING_DIR', '--skip_cache', '--repetition_penalty', '1.5', '--mc_dropout_num', '4']
+)
+load_config_json(args)
+check_and_update_generation_args(args)
+predict.check_args(args)
+predict.set_default_values(args)
+set_seed(args)
+args.tasks = list(get_tasks(args.task_names, args).values())
+
+device = torch.device('cpu')
+model = predict.load_model(args, device)
+val_sets = predict.prepare_data(args, device, args.pred_src_languages[0])
+model.add_new_vocab_from_data(args.tasks)
+model.eval()
+iters = predict.prepare_data_iterators(args, val_sets, model.numericalizer, device)
+
+with torch.no_grad():
+    for task, language, it, original_order in iters:
+        for batch in it:
+            generated = model.generate(
+                batch,
+                max_output_length=args.max_output_length,
+                num_outputs=1,
+                temperature=1.0,
+                repetition_penalty=args.repetition_penalty[0],
+                top_k=args.top_k[0],
+                top_p=args.top_p[0],
+                num_beams=1,
+                num_beam_groups=1,
+                diversity_penalty=args.diversity_penalty[0],
+                no_repeat_ngram_size=args.no_repeat_ngram_size[0],
+                do_sample=False,
+                output_step_logits=True,
+            )
+            reused = model.confidence_features(
+                batch, generated.sequences, mc_dropout_num=args.mc_dropout_num, step_logits=generated.step_logits
+            )
+            forward = model.confidence_features(batch, generated.sequences)
+            for r, f in zip(reused, forward):
+                for name in ('nodrop_logits', 'nodrop_probs', 'nodrop_entropies'):
+                    assert torch.allclose(getattr(r, name), getattr(f, name), atol=1e-4), name
+                # dropout masks are random, so MC dropout samples can only be checked for their shape and range
+                for name in ('drop_logits', 'drop_probs'):
+                    assert getattr(r, name).shape == (args.mc_dropout_num, len(r.nodrop_logits)), name
+                    assert torch.isfinite(getattr(r, name)).all(), name
+                assert ((r.drop_probs >= 0) & (r.drop_probs <= 1)).all()
+EOF
+
     # calibrate
     genienlp calibrate --confidence_path $workdir/model_$i/confidences.pkl --save $workdir/model_$i --testing --name_prefix test_calibrator
 
@@ -35,9 +35,42 @@ do
     if [ $i == 2 ] ; then
       # check if predictions matches expected_results
       diff -u $SRCDIR/expected_results/almond/bert_base_cased_beam.tsv $workdir/model_$i/eval_results/test/almond.tsv
+
+      # prediction split across CPU worker processes should match as well
+      genienlp predict --tasks almond --evaluate test --path $workdir/model_$i --overwrite --eval_dir $workdir/model_$i/eval_results_workers/ --data $SRCDIR/dataset/ --embeddings $EMBEDDING_DIR --skip_cache --cpu_workers 2
+      diff -u $SRCDIR/expected_results/almond/bert_base_cased_beam.tsv $workdir/model_$i/eval_results_workers/test/almond.tsv
     fi
 
     rm -rf $workdir/model_$i $workdir/model_"$i"_exported
 
     i=$((i+1))
 done
+
+# test prediction with multiple workers, for tasks whose postprocessing needs the state collected while preprocessing the data
+mkdir -p $workdir/translation/almond
+cp -r $SRCDIR/dataset/translation/en-de $workdir/translation
+mv $workdir/translation/en-de/dev_marian_aligned.tsv $workdir/translation/almond/train.tsv
+cp $workdir/translation/almond/train.tsv $workdir/translation/almond/eval.tsv
+
+# paraphrasing
+genienlp train --train_tasks almond_natural_seq2seq --train_batch_tokens 100 --val_batch_size 100 --train_iterations 6 --preserve_case --save_every 2 --log_every 2 --val_every 2 --save $workdir/model_$i --data $SRCDIR/dataset/ --model TransformerSeq2Seq --pretrained_model sshleifer/bart-tiny-random --exist_ok --skip_cache --embeddings $EMBEDDING_DIR --no_commit
+
+genienlp predict --tasks almond_paraphrase --evaluate test --path $workdir/model_$i --overwrite --eval_dir $workdir/model_$i/eval_results/ --data $SRCDIR/dataset/ --embeddings $EMBEDDING_DIR --skip_cache
+genienlp predict --tasks almond_paraphrase --evaluate test --path $workdir/model_$i --overwrite --eval_dir $workdir/model_$i/eval_results_workers/ --data $SRCDIR/dataset/ --embeddings $EMBEDDING_DIR --skip_cache --cpu_workers 2
+
+# check if predictions match the ones of a single process
+diff -u $workdir/model_$i/eval_results/test/almond_paraphrase.tsv $workdir/model_$i/eval_results_workers/test/almond_paraphrase.tsv
+
+rm -rf $workdir/model_$i
+i=$((i+1))
+
+# translation with alignment
+genienlp train --train_tasks almond_translate --do_alignment --train_languages en --train_tgt_languages de --eval_languages en --eval_tgt_languages de --model TransformerSeq2Seq --pretrained_model Helsinki-NLP/opus-mt-en-de --train_batch_tokens 100 --val_batch_size 100 --train_iterations 6 --preserve_case --save_every 2 --log_every 2 --val_every 2 --save $workdir/model_$i --data $workdir/translation/ --exist_ok --skip_cache --embeddings $EMBEDDING_DIR --no_commit
+
+genienlp predict --tasks almond_translate --evaluate valid --pred_languages en --pred_tgt_languages de --path $workdir/model_$i --overwrite --eval_dir $workdir/model_$i/eval_results/ --data $workdir/translation/ --embeddings $EMBEDDING_DIR --skip_cache --cpu_workers 2
+
+# check if result file exists and matches expected_result
+echo '{"casedbleu": 95.12283373900253}' | diff -u - $workdir/model_$i/eval_results/valid/almond_translate.results.json
+
+rm -rf $workdir/model_$i $workdir/translation
+i=$((i+1))